@@ -105,8 +105,7 @@ class KarmaSMBServer(Thread):
         # ask for shares using MS-RAP.
 
         self.__srvsServer = SRVSServer()
-        self.__srvsServer.daemon = True
-        self.server.registerNamedPipe('srvsvc',('127.0.0.1',self.__srvsServer.getListenPort()))
+        self.server.registerNamedPipe('srvsvc',self.__srvsServer)
 
     def findFirst2(self, connId, smbServer, recvPacket, parameters, data, maxDataCount):
         connData = smbServer.getConnectionData(connId)
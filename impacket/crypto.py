@@ -171,6 +171,78 @@ def AES_CMAC(K, M, length):
 
     return T
 
+class AES_CMAC_Signer:
+    """
+    AES_CMAC() for many messages under the same key. The key schedule and subkeys are
+    computed once, and the blocks chained by the cipher in CBC mode. Not thread safe,
+    each thread should have its own
+    """
+    def __init__(self, K):
+        self.__K = K
+        K1, K2 = Generate_Subkey(K)
+        self.__K1 = unpack('>QQ', K1)
+        self.__K2 = unpack('>QQ', K2)
+        # CBC goes on from the last block encrypted, the previous message's MAC. XORing
+        # it into each message's first block too cancels it, as if starting from const_Zero
+        self.__cipher = AES.new(K, AES.MODE_CBC, '\x00'*16)
+        self.__last = (0, 0)
+
+    def getKey(self):
+        return self.__K
+
+    def __xor(self, block, value):
+        high, low = value
+        blockHigh, blockLow = unpack('>QQ', block)
+        return pack('>QQ', blockHigh ^ high, blockLow ^ low)
+
+    def __bytes(self, M, M2, start, end):
+        # Bytes start to end of M followed by M2, without joining them
+        length = len(M)
+        if end <= length:
+            return M[start:end]
+        if start >= length:
+            return M2[start-length:end-length]
+        return M[start:] + M2[:end-length]
+
+    def sign(self, M, M2 = ''):
+        """
+        :param string M: the message to authenticate, a buffer works too
+        :param string M2: more of the message, authenticated as if it followed M. Large
+            data doesn't need to be joined to a header this way
+
+        :return: their AES-CMAC
+        """
+        # n blocks and then M_last, chained by the cipher
+        length = len(M) + len(M2)
+        if length > 0 and (length % 16) == 0:
+            n = length / 16 - 1
+            M_last = self.__xor(self.__bytes(M, M2, n*16, length), self.__K1)
+        else:
+            n = length / 16
+            M_last = self.__xor(PAD(str(self.__bytes(M, M2, n*16, length))), self.__K2)
+
+        if n > 0:
+            self.__cipher.encrypt(self.__xor(self.__bytes(M, M2, 0, 16), self.__last))
+            offset = 16
+            while offset < n*16:
+                if offset + 16 <= len(M):
+                    # Whole blocks of M
+                    size = (min(n*16, len(M)) - offset) & ~15
+                    self.__cipher.encrypt(buffer(M, offset, size))
+                elif offset < len(M):
+                    # The block across M and M2
+                    size = 16
+                    self.__cipher.encrypt(self.__bytes(M, M2, offset, offset + 16))
+                else:
+                    size = n*16 - offset
+                    self.__cipher.encrypt(buffer(M2, offset - len(M), size))
+                offset += size
+            T = self.__cipher.encrypt(M_last)
+        else:
+            T = self.__cipher.encrypt(self.__xor(M_last, self.__last))
+        self.__last = unpack('>QQ', T)
+        return T
+
 def AES_CMAC_PRF_128(VK, M, VKlen, Mlen):
 #   +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 #   +                        AES-CMAC-PRF-128                           +
@@ -421,6 +493,16 @@ if __name__ == '__main__':
     print "Example 4: len = 45"
     print "M               " , pp(M[:45*2])
     print "AES-CMAC        " , pp(hexlify(AES_CMAC(unhexlify(K),unhexlify(M),45)))
+    print 
+    print "AES_CMAC_Signer, same examples with one signer"
+    K = "2b7e151628aed2a6abf7158809cf4f3c"
+    M = "6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e5130c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710"
+    signer = AES_CMAC_Signer(unhexlify(K))
+    for length in (0, 16, 40, 64, 40):
+        print "len = %-2d        " % length, pp(hexlify(signer.sign(unhexlify(M)[:length])))
+    print "AES_CMAC_Signer, len = 64 split in two"
+    for split in (0, 7, 16, 40, 64):
+        print "split = %-2d      " % split, pp(hexlify(signer.sign(unhexlify(M)[:split], buffer(unhexlify(M), split))))
 
 #   ------------------------------------------------------------
 #
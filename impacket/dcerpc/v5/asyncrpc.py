@@ -0,0 +1,852 @@
+# Copyright (c) 2003-2014 CORE Security Technologies
+#
+# This software is provided under under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# $Id$
+#
+# Description:
+#   Non blocking DCE/RPC client. A single EventLoop drives many associations
+#   at once out of one thread. Operations return Futures, and code using them
+#   is written as generators that yield the Future they want to wait for, e.g.
+#
+#   def lookup(loop, host):
+#       rpctransport = asyncrpc.DCERPCTransportFactory(loop, r'ncacn_ip_tcp:%s[135]' % host)
+#       dce = rpctransport.get_dce_rpc()
+#       yield dce.connect()
+#       yield dce.bind(epm.MSRPC_UUID_PORTMAP)
+#       resp = yield dce.request(request)
+#       yield dce.disconnect()
+#
+#   loop = asyncrpc.EventLoop()
+#   tasks = [loop.spawn(lookup(loop, host)) for host in hosts]
+#   loop.run()
+#
+#   Requests and responses are the same NDR structures the blocking
+#   DCERPC_v5 uses. ncacn_ip_tcp is done by the loop itself, ncacn_np (SMB2
+#   and later) by a couple of threads per pipe sharing the SMB connection.
+#
+
+import errno
+import heapq
+import select
+import socket
+import threading
+import time
+import Queue
+from collections import deque
+from struct import unpack_from
+
+from impacket import smb, nmb
+from impacket.smbconnection import SMBConnection
+from impacket.dcerpc.v5 import transport, rpcrt
+
+class Future:
+    """
+    The outcome of an operation that might not have finished yet
+    """
+    def __init__(self):
+        self.__done = False
+        self.__result = None
+        self.__error = None
+        self.__callbacks = []
+
+    def done(self):
+        return self.__done
+
+    def result(self):
+        if self.__done is False:
+            raise Exception('Operation still in progress')
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+    def error(self):
+        return self.__error
+
+    def addCallback(self, callback):
+        # callback(future) is called once the future is done
+        if self.__done is True:
+            callback(self)
+        else:
+            self.__callbacks.append(callback)
+
+    def setResult(self, result):
+        self.__result = result
+        self.__finish()
+
+    def setError(self, error):
+        self.__error = error
+        self.__finish()
+
+    def __finish(self):
+        self.__done = True
+        callbacks = self.__callbacks
+        self.__callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+class Task(Future):
+    """
+    Runs a generator, resuming it with the result of every Future it yields
+    (or raising its error in it). Anything else yielded is sent back as is.
+    The task is done when the generator ends
+    """
+    def __init__(self, generator):
+        Future.__init__(self)
+        self.__generator = generator
+
+    def _step(self, value = None, error = None):
+        while True:
+            try:
+                if error is not None:
+                    waitFor = self.__generator.throw(error)
+                else:
+                    waitFor = self.__generator.send(value)
+            except StopIteration:
+                self.setResult(None)
+                return
+            except Exception, e:
+                self.setError(e)
+                return
+            if not isinstance(waitFor, Future):
+                value, error = waitFor, None
+            elif waitFor.done():
+                value, error = self.__outcome(waitFor)
+            else:
+                waitFor.addCallback(self.__wakeUp)
+                return
+
+    def __wakeUp(self, future):
+        value, error = self.__outcome(future)
+        self._step(value, error)
+
+    def __outcome(self, future):
+        if future.error() is not None:
+            return None, future.error()
+        return future.result(), None
+
+class EventLoop:
+    """
+    Does the I/O of every transport created with it, out of run()
+    """
+    def __init__(self):
+        self.__transports = {}
+        self.__tasks = []
+        # Only where select.poll() is there, select() is used otherwise
+        self.__poller = None
+        if hasattr(select, 'poll'):
+            self.__poller = select.poll()
+        # filenos of the transports with something to send
+        self.__writers = set()
+        # (deadline, transport) heap. A transport's deadline moves forward with every
+        # activity, so entries are just when to check it again
+        self.__deadlines = []
+        self.__scheduled = set()
+
+    def spawn(self, generator):
+        """
+        starts running a generator as a Task
+
+        :param generator generator: the code to run
+
+        :return: the Task, done when the generator ends
+        """
+        task = Task(generator)
+        self.__tasks.append(task)
+        task._step()
+        return task
+
+    def _add(self, transport):
+        self.__transports[transport.fileno()] = transport
+        if self.__poller is not None:
+            self.__poller.register(transport.fileno(), select.POLLIN)
+        self._watch(transport)
+        self._schedule(transport)
+
+    def _remove(self, transport):
+        fd = transport.fileno()
+        del(self.__transports[fd])
+        self.__writers.discard(fd)
+        self.__scheduled.discard(transport)
+        if self.__poller is not None:
+            self.__poller.unregister(fd)
+
+    def _watch(self, transport):
+        # Waits for the transport to be writable as well as readable, or not anymore,
+        # as transport._wantsWrite() says
+        fd = transport.fileno()
+        writing = transport._wantsWrite()
+        if writing is (fd in self.__writers):
+            return
+        if writing is True:
+            self.__writers.add(fd)
+        else:
+            self.__writers.discard(fd)
+        if self.__poller is not None:
+            if writing is True:
+                self.__poller.modify(fd, select.POLLIN | select.POLLOUT)
+            else:
+                self.__poller.modify(fd, select.POLLIN)
+
+    def _schedule(self, transport):
+        # To be called whenever transport._deadline() might have stopped being None
+        if transport in self.__scheduled:
+            return
+        deadline = transport._deadline()
+        if deadline is not None:
+            self.__scheduled.add(transport)
+            heapq.heappush(self.__deadlines, (deadline, transport))
+
+    def run(self):
+        """
+        runs until every spawned task is done
+        """
+        while True:
+            self.__tasks = [task for task in self.__tasks if task.done() is False]
+            if len(self.__tasks) == 0:
+                break
+            if len(self.__transports) == 0:
+                raise Exception('Tasks waiting for something that will never happen')
+            self.__poll()
+
+    def __expire(self):
+        # Times out the transports past their deadline. Returns how long until the next one
+        now = time.time()
+        while len(self.__deadlines) > 0:
+            deadline, transport = self.__deadlines[0]
+            if transport not in self.__scheduled:
+                heapq.heappop(self.__deadlines)
+                continue
+            if deadline > now:
+                return deadline - now
+            heapq.heappop(self.__deadlines)
+            deadline = transport._deadline()
+            if deadline is None:
+                self.__scheduled.discard(transport)
+            elif deadline > now:
+                heapq.heappush(self.__deadlines, (deadline, transport))
+            else:
+                self.__scheduled.discard(transport)
+                transport._timedOut()
+        return None
+
+    def __poll(self):
+        timeout = self.__expire()
+        if len(self.__transports) == 0:
+            return
+
+        if self.__poller is not None:
+            # select() can't take descriptors past FD_SETSIZE
+            if timeout is not None:
+                timeout = int(timeout*1000) + 1
+            try:
+                events = self.__poller.poll(timeout)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    return
+                raise
+            readable = [fd for fd, event in events if event & (select.POLLIN | select.POLLERR | select.POLLHUP)]
+            writable = [fd for fd, event in events if event & (select.POLLOUT | select.POLLERR | select.POLLHUP)]
+        else:
+            try:
+                readable, writable, dummy = select.select(self.__transports.keys(), list(self.__writers), [], timeout)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    return
+                raise
+
+        for fd in writable:
+            if self.__transports.has_key(fd):
+                self.__transports[fd]._onWritable()
+        for fd in readable:
+            if self.__transports.has_key(fd):
+                self.__transports[fd]._onReadable()
+
+class DCERPCTransport(transport.DCERPCTransport):
+    """
+    What the non blocking transports have in common: the PDUs received, and
+    the handler (the DCERPC_v5) told about them
+    """
+    def __init__(self, loop, dstip, dstport):
+        transport.DCERPCTransport.__init__(self, dstip, dstport)
+        self._loop = loop
+        self._handler = None
+        self._inBuffer = bytearray()
+        self._lastActivity = 0
+        self.set_connect_timeout(30)
+
+    def get_dce_rpc(self):
+        return DCERPC_v5(self)
+
+    def _setHandler(self, handler):
+        # handler._dataReceived() is called whenever there's new data, and
+        # handler._connectionLost(error) when the connection goes away
+        self._handler = handler
+
+    def send(self, data, forceWriteAndx = 0, forceRecv = 0):
+        self.send_buffers([data])
+
+    def recv(self, forceRecv = 0, count = 0):
+        # Only called once hasPDU() says there's a whole PDU buffered.
+        # count = 0 means that PDU
+        if count == 0:
+            count = self.__pduLength()
+        if count is None or len(self._inBuffer) < count:
+            raise Exception('Not enough data received')
+        data = str(self._inBuffer[:count])
+        del(self._inBuffer[:count])
+        return data
+
+    def hasPDU(self):
+        length = self.__pduLength()
+        return length is not None and len(self._inBuffer) >= length
+
+    def __pduLength(self):
+        if len(self._inBuffer) < rpcrt.MSRPCRespHeader._SIZE:
+            return None
+        # frag_len, as MSRPCHeader decodes it
+        return unpack_from('<H', buffer(self._inBuffer), 8)[0]
+
+    def _received(self, data):
+        self._lastActivity = time.time()
+        self._inBuffer += data
+        if self._handler is not None:
+            self._handler._dataReceived()
+
+    def _waiting(self):
+        return self._handler is not None and self._handler._waiting()
+
+    def _answerDue(self):
+        # The handler started waiting for something, so _deadline() counts from now on
+        self._loop._schedule(self)
+
+class TCPTransport(DCERPCTransport):
+    "Non blocking implementation of ncacn_ip_tcp protocol sequence"
+
+    def __init__(self, loop, dstip, dstport = 135):
+        DCERPCTransport.__init__(self, loop, dstip, dstport)
+        self.__socket = None
+        self.__connecting = None
+        self.__outBuffer = bytearray()
+
+    def fileno(self):
+        return self.__socket.fileno()
+
+    def connect(self):
+        future = Future()
+        try:
+            af, socktype, proto, canonname, sa = socket.getaddrinfo(self.get_dip(), self.get_dport(), 0, socket.SOCK_STREAM)[0]
+            self.__socket = socket.socket(af, socktype, proto)
+            self.__socket.setblocking(0)
+            error = self.__socket.connect_ex(sa)
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise socket.error(error, errno.errorcode.get(error, str(error)))
+        except socket.error, msg:
+            if self.__socket is not None:
+                self.__socket.close()
+                self.__socket = None
+            future.setError(Exception("Could not connect: %s" % msg))
+            return future
+        self.__connecting = future
+        self._lastActivity = time.time()
+        self._loop._add(self)
+        return future
+
+    def disconnect(self):
+        future = Future()
+        if self.__socket is not None:
+            self.__close(Exception('Connection closed'))
+        future.setResult(1)
+        return future
+
+    def send_buffers(self, buffers, forceWriteAndx = 0, forceRecv = 0):
+        if self.__socket is None:
+            raise Exception('Not connected')
+        for data in buffers:
+            self.__outBuffer += data
+        if self.__connecting is None:
+            self._onWritable()
+
+    def _deadline(self):
+        if self.__connecting is not None or self._waiting():
+            return self._lastActivity + self.get_connect_timeout()
+        return None
+
+    def _wantsWrite(self):
+        return self.__connecting is not None or len(self.__outBuffer) > 0
+
+    def _timedOut(self):
+        self.__close(socket.timeout('timed out'))
+
+    def _onWritable(self):
+        if self.__connecting is not None:
+            error = self.__socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error != 0:
+                self.__close(Exception("Could not connect: %s" % socket.error(error, errno.errorcode.get(error, str(error)))))
+                return
+            future = self.__connecting
+            self.__connecting = None
+            self._lastActivity = time.time()
+            future.setResult(1)
+            if self.__socket is None:
+                # Whoever waited for it disconnected already
+                return
+        while len(self.__outBuffer) > 0:
+            try:
+                sent = self.__socket.send(self.__outBuffer)
+            except socket.error, e:
+                if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.__close(e)
+                return
+            del(self.__outBuffer[:sent])
+            self._lastActivity = time.time()
+        self._loop._watch(self)
+
+    def _onReadable(self):
+        if self.__connecting is not None:
+            self._onWritable()
+            return
+        try:
+            data = self.__socket.recv(65536)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.__close(e)
+            return
+        if data == '':
+            self.__close(Exception('Connection closed by peer'))
+            return
+        self._received(data)
+
+    def __close(self, error):
+        self._loop._remove(self)
+        try:
+            self.__socket.close()
+        except socket.error:
+            pass
+        self.__socket = None
+        self.__outBuffer = bytearray()
+        if self.__connecting is not None:
+            future = self.__connecting
+            self.__connecting = None
+            future.setError(error)
+        if self._handler is not None:
+            self._handler._connectionLost(error)
+
+class SMBTransport(DCERPCTransport):
+    """
+    Non blocking implementation of ncacn_np protocol sequence, SMB2 and later only.
+    The SMB3 connection runs its dispatcher (see SMB3.startDispatcher()), so a thread
+    writing to the pipe and another one reading from it can share it with anyone else.
+    What they get done is handed over to the loop through a socket pair
+    """
+    def __init__(self, loop, dstip, dstport = 445, filename = '', username='', password='', domain = '', lmhash='', nthash='', aesKey = '', remote_name='', smb_connection = 0, doKerberos = False):
+        DCERPCTransport.__init__(self, loop, dstip, dstport)
+        self.set_credentials(username, password, domain, lmhash, nthash, aesKey)
+        self.set_kerberos(doKerberos)
+        self.__filename = filename
+        self.__remote_name = remote_name
+        self.__smb_connection = smb_connection
+        self.__existing_smb = smb_connection != 0
+        if self.__existing_smb is True:
+            self.set_credentials(*smb_connection.getCredentials())
+        self.__tid = 0
+        self.__handle = 0
+        # What the threads got done, for the loop
+        self.__events = None
+        # ('write', data) or ('disconnect', None) for the writing thread
+        self.__jobs = None
+        # True for the reading thread to read once, None to stop
+        self.__reads = None
+        self.__reading = False
+        self.__wakeUp = None
+        self.__connecting = None
+        self.__disconnecting = None
+
+    def get_smb_connection(self):
+        return self.__smb_connection
+
+    def doesSupportNTLMv2(self):
+        return self.__smb_connection.doesSupportNTLMv2()
+
+    def fileno(self):
+        return self.__wakeUp[0].fileno()
+
+    def connect(self):
+        future = Future()
+        self.__wakeUp = rpcrt._socketPair()
+        self.__wakeUp[0].setblocking(0)
+        self.__wakeUp[1].setblocking(0)
+        self.__jobs = Queue.Queue()
+        self.__reads = Queue.Queue()
+        self.__connecting = future
+        self._lastActivity = time.time()
+        self._loop._add(self)
+        # A queue of their own for the threads, in case this transport connects again
+        self.__events = Queue.Queue()
+        writer = threading.Thread(target = self.__write, args = (self.__jobs, self.__reads, self.__events, self.__wakeUp[1]))
+        writer.daemon = True
+        writer.start()
+        return future
+
+    def disconnect(self):
+        future = Future()
+        if self.__wakeUp is None or self.__disconnecting is not None:
+            future.setResult(1)
+            return future
+        # Once the writing thread is done with what's before it
+        self.__disconnecting = future
+        self.__jobs.put(('disconnect', None))
+        return future
+
+    def send_buffers(self, buffers, forceWriteAndx = 0, forceRecv = 0):
+        if self.__wakeUp is None or self.__disconnecting is not None:
+            raise Exception('Not connected')
+        self.__jobs.put(('write', ''.join([str(buf) for buf in buffers])))
+        self._lastActivity = time.time()
+
+    def _answerDue(self):
+        DCERPCTransport._answerDue(self)
+        self.__readIfWaiting()
+
+    def __readIfWaiting(self):
+        if self.__reading is False and self.__connecting is None and self._waiting():
+            self.__reading = True
+            self.__reads.put(True)
+
+    def _deadline(self):
+        if self.__connecting is not None or self.__disconnecting is not None or self._waiting():
+            return self._lastActivity + self.get_connect_timeout()
+        return None
+
+    def _wantsWrite(self):
+        return False
+
+    def _timedOut(self):
+        self.__close(socket.timeout('timed out'))
+
+    def _onWritable(self):
+        pass
+
+    def _onReadable(self):
+        try:
+            while self.__wakeUp[0].recv(4096) != '':
+                pass
+        except socket.error:
+            pass
+        while self.__wakeUp is not None:
+            try:
+                event, value = self.__events.get_nowait()
+            except Queue.Empty:
+                return
+            if event == 'connected':
+                future = self.__connecting
+                self.__connecting = None
+                self._lastActivity = time.time()
+                future.setResult(1)
+            elif event == 'data':
+                self.__reading = False
+                self._received(value)
+                if self.__wakeUp is not None:
+                    self.__readIfWaiting()
+            elif event == 'disconnected':
+                self.__close(Exception('Connection closed'))
+            elif self.__disconnecting is None:
+                self.__close(value)
+
+    def __post(self, events, wakeUp, event, value = None):
+        # From the threads, wakes the loop up to deal with what they did
+        events.put((event, value))
+        try:
+            wakeUp.send('\x00')
+        except socket.error:
+            # Full of wake ups already, or the loop is done with this pipe
+            pass
+
+    def __write(self, jobs, reads, events, wakeUp):
+        try:
+            self.__connectPipe()
+        except Exception, e:
+            self.__post(events, wakeUp, 'error', Exception('Could not connect: %s' % e))
+            return
+        reader = threading.Thread(target = self.__read, args = (reads, events, wakeUp))
+        reader.daemon = True
+        reader.start()
+        self.__post(events, wakeUp, 'connected')
+        while True:
+            job, data = jobs.get()
+            if job == 'disconnect':
+                reads.put(None)
+                self.__disconnectPipe()
+                self.__post(events, wakeUp, 'disconnected')
+                return
+            try:
+                if self._max_send_frag:
+                    for offset in range(0, len(data), self._max_send_frag):
+                        self.__smb_connection.writeFile(self.__tid, self.__handle, data[offset:offset+self._max_send_frag], offset = offset)
+                else:
+                    self.__smb_connection.writeFile(self.__tid, self.__handle, data)
+            except Exception, e:
+                reads.put(None)
+                self.__post(events, wakeUp, 'error', e)
+                return
+
+    def __read(self, reads, events, wakeUp):
+        while reads.get() is True:
+            try:
+                data = self.__smb_connection.readFile(self.__tid, self.__handle)
+                if data == '':
+                    raise Exception('Connection closed by peer')
+            except Exception, e:
+                self.__post(events, wakeUp, 'error', e)
+                return
+            self.__post(events, wakeUp, 'data', data)
+
+    def __connectPipe(self):
+        if self.__existing_smb is False:
+            remoteName = self.__remote_name
+            if remoteName == '':
+                if self.get_dport() == nmb.NETBIOS_SESSION_PORT:
+                    remoteName = '*SMBSERVER'
+                else:
+                    remoteName = self.get_dip()
+            self.__smb_connection = SMBConnection(remoteName, self.get_dip(), sess_port = self.get_dport())
+        if self.__smb_connection.getDialect() == smb.SMB_DIALECT:
+            raise Exception('ncacn_np is only non blocking over SMB2 and later')
+        if self.__existing_smb is False:
+            if self._doKerberos is False:
+                self.__smb_connection.login(self._username, self._password, self._domain, self._lmhash, self._nthash)
+            else:
+                self.__smb_connection.kerberosLogin(self._username, self._password, self._domain, self._lmhash, self._nthash, self._aesKey)
+        self.__smb_connection.getSMBServer().startDispatcher()
+        self.__tid = self.__smb_connection.connectTree('IPC$')
+        self.__handle = self.__smb_connection.openFile(self.__tid, self.__filename)
+
+    def __disconnectPipe(self):
+        # Closing the pipe ends the read pending on it, if any
+        steps = [(self.__smb_connection.closeFile, (self.__tid, self.__handle)), (self.__smb_connection.disconnectTree, (self.__tid,))]
+        # If we created the SMB connection, we close it, otherwise
+        # that's up for the caller
+        if self.__existing_smb is False:
+            steps.append((self.__smb_connection.logoff, ()))
+        for step, args in steps:
+            try:
+                step(*args)
+            except Exception:
+                # The rest goes on anyway
+                pass
+
+    def __close(self, error):
+        self._loop._remove(self)
+        if self.__disconnecting is None:
+            # The threads stop once they're done with the SMB side
+            self.__jobs.put(('disconnect', None))
+        for sock in self.__wakeUp:
+            sock.close()
+        self.__wakeUp = None
+        self.__reading = False
+        if self.__connecting is not None:
+            future = self.__connecting
+            self.__connecting = None
+            future.setError(error)
+        if self._handler is not None:
+            self._handler._connectionLost(error)
+        if self.__disconnecting is not None:
+            future = self.__disconnecting
+            self.__disconnecting = None
+            future.setResult(1)
+
+class DCERPC_v5(rpcrt.DCERPC_v5):
+    """
+    DCERPC_v5 whose bind(), alter_ctx() and request() return Futures. Requests
+    are pipelined as DCERPC_v5.submit() does
+    """
+    def __init__(self, transport):
+        rpcrt.DCERPC_v5.__init__(self, transport)
+        transport._setHandler(self)
+        self.__binding = None
+        self.__calls = {}
+        # ('request', future, (request, uuid, checkError, interface)) or
+        # ('alter', future, (uuid, bogus_binds)), in the order they were asked for
+        self.__queued = deque()
+        # Interface of the requests that don't come through a DCERPCContext
+        self.__default = None
+
+    def bind(self, uuid, alter = 0, bogus_binds = 0, transfer_syntax = ('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0'), extra_uuids = ()):
+        future = Future()
+        self.__bind(future, uuid, alter, bogus_binds, transfer_syntax, extra_uuids, False)
+        return future
+
+    def __bind(self, future, uuid, alter, bogus_binds, transfer_syntax, extra_uuids, context):
+        try:
+            bind, auth = self._sendBind(uuid, alter, bogus_binds, transfer_syntax, extra_uuids)
+        except Exception, e:
+            future.setError(e)
+            return
+        # [future, answer, alterCtx pending, what _bindAck() needs, whether
+        # it's for alter_ctx() and the interface used before]
+        self.__binding = [future, None, False, bind, auth, bogus_binds, context, self.__default]
+        self._transport._answerDue()
+
+    def set_interface(self, uuid):
+        rpcrt.DCERPC_v5.set_interface(self, uuid)
+        self.__default = uuid
+
+    def request(self, request, uuid=None, checkError=True):
+        return self._queueRequest(request, uuid, checkError, None)
+
+    def _queueRequest(self, request, uuid, checkError, interface):
+        future = Future()
+        self.__queued.append(('request', future, (request, uuid, checkError, interface)))
+        self.__sendQueued()
+        return future
+
+    def alter_ctx(self, newUID, bogus_binds = 0):
+        """
+        binds another interface in this same association, without a new
+        DCERPC_v5 as the blocking alter_ctx() does
+
+        :param uuid newUID: the interface to bind
+        :param integer bogus_binds: bogus contexts to offer before it
+
+        :return: a Future, whose result is a DCERPCContext sending requests to newUID
+        """
+        future = Future()
+        self.__queued.append(('alter', future, (newUID, bogus_binds)))
+        self.__sendQueued()
+        return future
+
+    def __sendQueued(self):
+        while len(self.__queued) > 0 and self.__binding is None:
+            kind, future, args = self.__queued[0]
+            if kind == 'alter':
+                # Its answer might set up a new security context, so nothing
+                # else can be on the way
+                if len(self.__calls) > 0:
+                    break
+                self.__queued.popleft()
+                newUID, bogus_binds = args
+                self.set_ctx_id(self._nextContext())
+                self.__bind(future, newUID, 1, bogus_binds, rpcrt.bin_to_uuidtup(self.transfer_syntax), (), True)
+                continue
+            if len(self.__calls) > 0 and (self._canPipeline() is False or len(self.__calls) >= self.get_max_pending()):
+                break
+            self.__queued.popleft()
+            request, uuid, checkError, interface = args
+            try:
+                if interface is None:
+                    interface = self.__default
+                if interface is not None:
+                    rpcrt.DCERPC_v5.set_interface(self, interface)
+                call = self.submit(request, uuid, checkError)
+            except Exception, e:
+                future.setError(e)
+                continue
+            self.__calls[call.callId] = (call, future)
+            self._transport._answerDue()
+
+    def _waiting(self):
+        return self.__binding is not None or len(self.__calls) > 0
+
+    def _dataReceived(self):
+        try:
+            while self._transport.hasPDU():
+                if self.__binding is not None:
+                    self.__bindAnswer()
+                else:
+                    self.__answer()
+        except Exception, e:
+            self._connectionLost(e)
+            self._transport.disconnect()
+            return
+        self.__sendQueued()
+
+    def __bindAnswer(self):
+        future, resp, alterCtx, bind, auth, bogus_binds, context, default = self.__binding
+        if alterCtx is True:
+            self._recvAlterCtx()
+        else:
+            resp = rpcrt.MSRPCHeader(self._transport.recv())
+            try:
+                alterCtx = self._bindAck(resp, bind, auth, bogus_binds)
+            except Exception, e:
+                self.__binding = None
+                future.setError(e)
+                return
+            if alterCtx is True:
+                self.__binding = [future, resp, True, bind, auth, bogus_binds, context, default]
+                return
+        self.__binding = None
+        if context is False:
+            future.setResult(resp)
+            return
+        # _bindAck() switched to the new interface, but that's only for the
+        # requests through the DCERPCContext
+        newUID = self.__default
+        self.__default = default
+        future.setResult(DCERPCContext(self, newUID))
+
+    def __answer(self):
+        self._recvPending()
+        callId = self.response_header['call_id']
+        call, future = self.__calls[callId]
+        if call.done() is False:
+            return
+        del(self.__calls[callId])
+        try:
+            response = call.result()
+        except Exception, e:
+            future.setError(e)
+        else:
+            future.setResult(response)
+
+    def _connectionLost(self, error):
+        waiting = []
+        if self.__binding is not None:
+            waiting.append(self.__binding[0])
+            self.__binding = None
+        waiting.extend([future for call, future in self.__calls.values()])
+        self.__calls = {}
+        waiting.extend([queued[1] for queued in self.__queued])
+        self.__queued.clear()
+        for future in waiting:
+            future.setError(error)
+
+class DCERPCContext:
+    """
+    What DCERPC_v5.alter_ctx() gives: requests go to the interface it bound,
+    over the association of the DCERPC_v5 it came from
+    """
+    def __init__(self, dce, interface):
+        self.__dce = dce
+        self.__interface = interface
+
+    def get_dce_rpc(self):
+        return self.__dce
+
+    def request(self, request, uuid=None, checkError=True):
+        return self.__dce._queueRequest(request, uuid, checkError, self.__interface)
+
+def DCERPCTransportFactory(loop, stringbinding):
+    sb = transport.DCERPCStringBinding(stringbinding)
+
+    na = sb.get_network_address()
+    ps = sb.get_protocol_sequence()
+    if 'ncacn_ip_tcp' == ps:
+        port = sb.get_endpoint()
+        if port:
+            return TCPTransport(loop, na, int(port))
+        else:
+            return TCPTransport(loop, na)
+    elif 'ncacn_np' == ps:
+        named_pipe = sb.get_endpoint()
+        if named_pipe:
+            named_pipe = named_pipe[len(r'\pipe'):]
+            return SMBTransport(loop, na, filename = named_pipe)
+        else:
+            return SMBTransport(loop, na)
+    else:
+        raise Exception, "Unsupported protocol sequence for non blocking transports."
@@ -1201,7 +1201,16 @@ class INTERFACE():
                     # We don't need to alter_ctx
                     pass
                 else:
-                    newDce = dce.alter_ctx(iid)
+                    # Nor if the interface was bound before in this connection
+                    contexts = INTERFACE.CONNECTIONS[self.__target][self.__oxid]['contexts']
+                    if contexts.has_key(iid):
+                        newDce = contexts[iid]
+                    else:
+                        # The newest context holds the highest context id
+                        newDce = INTERFACE.CONNECTIONS[self.__target][self.__oxid]['newest'].alter_ctx(iid)
+                        contexts[iid] = newDce
+                        INTERFACE.CONNECTIONS[self.__target][self.__oxid]['newest'] = newDce
+                    newDce.set_interface(iid)
                     INTERFACE.CONNECTIONS[self.__target][self.__oxid]['dce'] = newDce
                     INTERFACE.CONNECTIONS[self.__target][self.__oxid]['currentBinding'] = iid
             else:
@@ -1238,7 +1247,9 @@ class INTERFACE():
                 if iid is None:
                     raise
                 else:
-                    dce.bind(iid)
+                    # IRemUnknown(2) is served for every OXID, bind it right away
+                    extraIids = [remUnknown for remUnknown in (IID_IRemUnknown, IID_IRemUnknown2) if remUnknown != iid]
+                    dce.bind(iid, extra_uuids = extraIids)
 
                 if self.__oxid is None:
                     import traceback
@@ -1249,6 +1260,11 @@ class INTERFACE():
                 INTERFACE.CONNECTIONS[self.__target][self.__oxid] = {}
                 INTERFACE.CONNECTIONS[self.__target][self.__oxid]['dce'] = dce
                 INTERFACE.CONNECTIONS[self.__target][self.__oxid]['currentBinding'] = iid
+                INTERFACE.CONNECTIONS[self.__target][self.__oxid]['newest'] = dce
+                INTERFACE.CONNECTIONS[self.__target][self.__oxid]['contexts'] = {}
+                for boundIid in [iid] + extraIids:
+                    if dce.has_interface(boundIid):
+                        INTERFACE.CONNECTIONS[self.__target][self.__oxid]['contexts'][boundIid] = dce
         else:
             # No connection created
             raise
@@ -12,6 +12,7 @@
 #   [MS-DTYP] Interface mini implementation
 #
 import random
+import re
 from struct import pack, unpack
 from impacket.dcerpc.v5.ndr import NDRULONG, NDRUHYPER, NDRUSMALL, NDRSHORT, NDRLONG, NDRPOINTER, NDRUniConformantArray, NDRUniFixedArray, NDR, NDRHYPER, NDRSMALL, NDRPOINTERNULL, NDRSTRUCT, NULL, NDRUSMALL, NDRBOOLEAN, NDRUSHORT, NDRFLOAT, NDRDOUBLEFLOAT
 
@@ -50,8 +51,13 @@ class PCHAR(NDRPOINTER):
     )
 
 class WIDESTR(NDRUniFixedArray):
+    terminator = re.compile('\x00\x00\x00')
     def getDataLen(self, data):
-        return data.find('\x00\x00\x00')+3
+        # data might be a buffer, which has no find()
+        end = self.terminator.search(data)
+        if end is None:
+            return 2
+        return end.end()
 
     def __setitem__(self, key, value):
         if key == 'Data':
@@ -914,8 +914,8 @@ def hept_lookup(destHost, inquiry_type = RPC_C_EP_ALL_ELTS, objectUUID = NULL, i
         tmpEntry = {}
         entry = resp['entries'][i]
         tmpEntry['object'] = entry['object'] 
-        tmpEntry['annotation'] = ''.join(entry['annotation'])
-        tmpEntry['tower'] = EPMTower(''.join(entry['tower']['tower_octet_string']))
+        tmpEntry['annotation'] = entry['annotation']
+        tmpEntry['tower'] = EPMTower(entry['tower']['tower_octet_string'])
         entries.append(tmpEntry)        
     dce.disconnect()
     return entries
@@ -970,7 +970,7 @@ def hept_map(destHost, remoteIf, dataRepresentation = uuidtup_to_bin(('8a885d04-
     request['map_tower']['tower_octet_string'] = str(tower)
     resp = dce.request(request)
 
-    tower = EPMTower(''.join(resp['ITowers'][0]['Data']['tower_octet_string']))
+    tower = EPMTower(resp['ITowers'][0]['Data']['tower_octet_string'])
     # Now let's parse the result and return an stringBinding
     if protocol == 'ncacn_np':
         # Pipe Name should be the 4th floor
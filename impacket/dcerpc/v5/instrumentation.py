@@ -0,0 +1,297 @@
+# Copyright (c) 2003-2014 CORE Security Technologies
+#
+# This software is provided under under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# $Id$
+#
+# Description:
+#   Where DCE/RPC calls go. DCERPC_v5 reports every call, bind and
+#   transport send/recv to the instrumentation set with set_instrumentation().
+#   By default there's none, and nothing is measured at all.
+#
+#   stats = RPCStats()
+#   dce.set_instrumentation(stats)
+#   ... use dce ...
+#   print stats.toPrometheus()
+#
+#   Besides the whole call latency, every call records how long it spent in
+#   the transport's send() and recv() and signing/sealing. Comparing the
+#   same calls over different transports (e.g. ncacn_np and ncacn_ip_tcp)
+#   tells the SMB pipe overhead apart from the time the server takes.
+#
+
+import json
+import threading
+import time
+
+from impacket.uuid import bin_to_uuidtup
+
+# Upper bounds of the latency histograms, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def interfaceName(uuid):
+    """
+    :param string uuid: the interface, as MSRPC_UUID_* in the interface modules
+
+    :return: the interface as a label, e.g. 12345778-1234-ABCD-EF00-0123456789AC v1.0
+    """
+    if uuid is None:
+        return ''
+    return '%s v%s' % bin_to_uuidtup(uuid)
+
+class CallRecord:
+    """
+    What a call took. Times are in seconds, sizes in octets, including
+    the DCE/RPC headers and auth trailers
+    """
+    def __init__(self, interface, opnum, transport):
+        self.interface = interface
+        self.opnum = opnum
+        self.transport = transport
+        self.start = time.time()
+        self.elapsed = 0
+        self.requestBytes = 0
+        self.responseBytes = 0
+        self.requestFragments = 0
+        self.responseFragments = 0
+        # Signing, sealing, verifying and unsealing
+        self.securityTime = 0
+        # In the transport's send() and recv()
+        self.sendTime = 0
+        self.recvTime = 0
+        self.error = False
+
+    def finish(self, error = False):
+        self.elapsed = time.time() - self.start
+        self.error = error
+
+class Instrumentation:
+    """
+    Does nothing with what it's told. Subclass it and override what you're
+    interested in
+    """
+    def call(self, record):
+        """
+        a call got its answer, or failed
+
+        :param CallRecord record: what the call took
+        """
+        pass
+
+    def bind(self, interface, transport, alter, elapsed, error):
+        """
+        a bind (or alter_ctx) finished, authentication legs included
+
+        :param string interface: the interface bound, as interfaceName() labels it
+        :param string transport: the transport's class name
+        :param boolean alter: whether it was an alter_ctx
+        :param float elapsed: seconds it took
+        :param boolean error: whether it failed
+        """
+        pass
+
+    def transport(self, transport, operation, elapsed, size):
+        """
+        a transport's send() or recv() returned
+
+        :param string transport: the transport's class name
+        :param string operation: 'send' or 'recv'
+        :param float elapsed: seconds it took
+        :param integer size: octets sent or received
+        """
+        pass
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+
+    def add(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+
+    def getData(self):
+        # Cumulative, as Prometheus wants them
+        buckets = []
+        total = 0
+        for i in range(len(BUCKETS)):
+            total += self.counts[i]
+            buckets.append((BUCKETS[i], total))
+        total += self.counts[-1]
+        buckets.append(('+Inf', total))
+        return {'buckets': buckets, 'sum': self.sum, 'count': total}
+
+class RPCStats(Instrumentation):
+    """
+    Adds up what it's told per interface, opnum and transport. Thread safe,
+    so one can be shared by many associations
+    """
+    CALL_COUNTERS = ('calls', 'errors', 'requestBytes', 'responseBytes', 'requestFragments',
+                     'responseFragments', 'securityTime', 'sendTime', 'recvTime')
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.__lock.acquire()
+        try:
+            # (interface, opnum, transport) -> [counters, latency histogram]
+            self.__calls = {}
+            # (interface, transport, alter) -> [binds, errors, latency histogram]
+            self.__binds = {}
+            # (transport, operation) -> [octets, latency histogram]
+            self.__transports = {}
+        finally:
+            self.__lock.release()
+
+    def call(self, record):
+        key = (record.interface, record.opnum, record.transport)
+        self.__lock.acquire()
+        try:
+            if self.__calls.has_key(key) is False:
+                self.__calls[key] = [dict([(name, 0) for name in self.CALL_COUNTERS]), _Histogram()]
+            counters, histogram = self.__calls[key]
+            counters['calls'] += 1
+            if record.error is True:
+                counters['errors'] += 1
+            counters['requestBytes'] += record.requestBytes
+            counters['responseBytes'] += record.responseBytes
+            counters['requestFragments'] += record.requestFragments
+            counters['responseFragments'] += record.responseFragments
+            counters['securityTime'] += record.securityTime
+            counters['sendTime'] += record.sendTime
+            counters['recvTime'] += record.recvTime
+            histogram.add(record.elapsed)
+        finally:
+            self.__lock.release()
+
+    def bind(self, interface, transport, alter, elapsed, error):
+        key = (interface, transport, alter)
+        self.__lock.acquire()
+        try:
+            if self.__binds.has_key(key) is False:
+                self.__binds[key] = [0, 0, _Histogram()]
+            entry = self.__binds[key]
+            entry[0] += 1
+            if error is True:
+                entry[1] += 1
+            entry[2].add(elapsed)
+        finally:
+            self.__lock.release()
+
+    def transport(self, transport, operation, elapsed, size):
+        key = (transport, operation)
+        self.__lock.acquire()
+        try:
+            if self.__transports.has_key(key) is False:
+                self.__transports[key] = [0, _Histogram()]
+            entry = self.__transports[key]
+            entry[0] += size
+            entry[1].add(elapsed)
+        finally:
+            self.__lock.release()
+
+    def getData(self):
+        """
+        :return: everything added up so far, as a dict with 'calls', 'binds' and 'transports' lists
+        """
+        self.__lock.acquire()
+        try:
+            calls = []
+            for (interface, opnum, transport), (counters, histogram) in sorted(self.__calls.items()):
+                entry = {'interface': interface, 'opnum': opnum, 'transport': transport, 'latency': histogram.getData()}
+                entry.update(counters)
+                calls.append(entry)
+            binds = []
+            for (interface, transport, alter), (count, errors, histogram) in sorted(self.__binds.items()):
+                binds.append({'interface': interface, 'transport': transport, 'alter': alter, 'binds': count,
+                              'errors': errors, 'latency': histogram.getData()})
+            transports = []
+            for (transport, operation), (size, histogram) in sorted(self.__transports.items()):
+                transports.append({'transport': transport, 'operation': operation, 'bytes': size,
+                                   'latency': histogram.getData()})
+        finally:
+            self.__lock.release()
+        return {'calls': calls, 'binds': binds, 'transports': transports}
+
+    def toJSON(self, indent = None):
+        """
+        :param integer indent: how much to indent the JSON, None for a single line
+
+        :return: getData(), as a JSON string
+        """
+        return json.dumps(self.getData(), indent = indent)
+
+    def toPrometheus(self, prefix = 'impacket_dcerpc'):
+        """
+        :param string prefix: what the metric names start with
+
+        :return: getData(), in the Prometheus text exposition format
+        """
+        data = self.getData()
+        lines = []
+
+        def header(name, kind, description):
+            lines.append('# HELP %s_%s %s' % (prefix, name, description))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        def sample(name, labels, value):
+            lines.append('%s_%s{%s} %s' % (prefix, name, ','.join(['%s="%s"' % (label, _escape(labelValue)) for label, labelValue in labels]), _number(value)))
+
+        def histogram(name, description, entries, labels):
+            header(name, 'histogram', description)
+            for entry in entries:
+                entryLabels = [(label, entry[label]) for label in labels]
+                for le, count in entry['latency']['buckets']:
+                    sample(name + '_bucket', entryLabels + [('le', le)], count)
+                sample(name + '_sum', entryLabels, entry['latency']['sum'])
+                sample(name + '_count', entryLabels, entry['latency']['count'])
+
+        callLabels = ('interface', 'opnum', 'transport')
+        for counter, name, description in (
+            ('calls', 'calls_total', 'Calls made'),
+            ('errors', 'call_errors_total', 'Calls that failed or got a fault'),
+            ('requestBytes', 'request_bytes_total', 'Octets sent in requests'),
+            ('responseBytes', 'response_bytes_total', 'Octets received in responses'),
+            ('requestFragments', 'request_fragments_total', 'Request fragments sent'),
+            ('responseFragments', 'response_fragments_total', 'Response fragments received'),
+            ('securityTime', 'security_seconds_total', 'Time spent signing, sealing, verifying and unsealing'),
+            ('sendTime', 'send_seconds_total', 'Time spent in the transport sending requests'),
+            ('recvTime', 'recv_seconds_total', 'Time spent in the transport receiving responses')):
+            header(name, 'counter', description)
+            for entry in data['calls']:
+                sample(name, [(label, entry[label]) for label in callLabels], entry[counter])
+        histogram('call_duration_seconds', 'Time from sending a request to its whole answer', data['calls'], callLabels)
+
+        bindLabels = ('interface', 'transport', 'alter')
+        header('binds_total', 'counter', 'Binds and alter contexts made')
+        for entry in data['binds']:
+            sample('binds_total', [(label, entry[label]) for label in bindLabels], entry['binds'])
+        header('bind_errors_total', 'counter', 'Binds and alter contexts that failed')
+        for entry in data['binds']:
+            sample('bind_errors_total', [(label, entry[label]) for label in bindLabels], entry['errors'])
+        histogram('bind_duration_seconds', 'Time binding took, authentication included', data['binds'], bindLabels)
+
+        transportLabels = ('transport', 'operation')
+        header('transport_bytes_total', 'counter', 'Octets the transport sent or received')
+        for entry in data['transports']:
+            sample('transport_bytes_total', [(label, entry[label]) for label in transportLabels], entry['bytes'])
+        histogram('transport_duration_seconds', 'Time each transport send or recv took', data['transports'], transportLabels)
+
+        return '\n'.join(lines) + '\n'
+
+def _escape(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
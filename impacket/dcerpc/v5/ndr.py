@@ -19,8 +19,11 @@
 
 import random
 import inspect
+import weakref
+from types import CodeType
 from struct import *
 from impacket import uuid
+from impacket.structure import _IMMUTABLE, _trackValue, _listsUnchanged, _invalidateOwners
 from impacket.winregistry import hexdump
 from impacket.dcerpc.v5.enum import Enum
 from impacket.uuid import uuidtup_to_bin
@@ -31,6 +34,354 @@ from impacket.uuid import uuidtup_to_bin
 # Where necessary, an alignment gap, consisting of octets of unspecified value, *precedes* the 
 # representation of a primitive. The gap is of the smallest size sufficient to align the primitive
 
+class _NDRFields(dict):
+    # The fields of an NDR instance. Changing one of them drops the cached
+    # __len__ of the instance (and of whoever cached theirs counting on it)
+    __slots__ = ('owner',)
+    def __init__(self, owner):
+        dict.__init__(self)
+        self.owner = weakref.ref(owner)
+
+    def __setitem__(self, key, value):
+        owner = self.owner()
+        if owner is not None and (owner._size is not None or owner._owners) and self.has_key(key):
+            old = dict.__getitem__(self, key)
+            if old is not value and not (type(old) is type(value) and isinstance(value, _IMMUTABLE) and old == value):
+                owner._invalidate()
+        dict.__setitem__(self, key, value)
+
+_trackable = {}
+
+def _sizeTrackable(cls):
+    # The cached size can only be trusted if the class serializes itself
+    # the way this module does, i.e. only out of its fields
+    try:
+        return _trackable[cls]
+    except KeyError:
+        answer = True
+        for name in ('getData', 'getDataReferents', 'getDataReferent', 'getDataArray', 'pack', 'calculatePad'):
+            for klass in cls.__mro__:
+                if klass.__dict__.has_key(name):
+                    if klass.__module__ != __name__:
+                        answer = False
+                    break
+        _trackable[cls] = answer
+        return answer
+
+# Marshalling plans. What a field specifier or a class layout means doesn't
+# change from one instance to the next, so it is worked out once and kept
+# here, instead of splitting specifiers and inspecting classes per field
+# every time something is packed or unpacked.
+
+def _compile(code):
+    try:
+        return compile(code, '<string>', 'eval')
+    except SyntaxError:
+        # Evaluating the source raises it again, where the caller expects it
+        return code
+
+_NOCONSTANT = object()
+
+class _FieldSpec:
+    """
+    A string field specifier, split up:
+        left    the specifier before '=', if there's any '='
+        code    the expression after the first '='
+        default the expression to initialize the field with, when there's
+                exactly one '='
+        count   the field holding the number of items, for '*' arrays
+        target  the specifier the sizes come from, after following the lefts
+        constant the value of default, when it's an immutable literal
+    """
+    def __init__(self, fieldType):
+        self.fieldType = fieldType
+        self.void = fieldType[:1] == '_'
+        self.literal = fieldType[:1] == ':'
+        two = fieldType.split('=')
+        if len(two) >= 2:
+            self.left = two[0]
+            self.code = _compile(two[1])
+        else:
+            self.left = None
+            self.code = None
+        if len(two) == 2:
+            self.default = self.code
+        else:
+            self.default = None
+        self.constant = _NOCONSTANT
+        if isinstance(self.default, CodeType) and self.default.co_names == ():
+            try:
+                value = eval(self.default)
+            except:
+                pass
+            else:
+                if isinstance(value, _IMMUTABLE):
+                    self.constant = value
+        two = fieldType.split('*')
+        if len(two) == 2:
+            self.count = two[1]
+        else:
+            self.count = None
+        try:
+            self.struct = Struct(fieldType)
+            self.size = self.struct.size
+        except error:
+            self.struct = None
+            self.size = None
+        if self.left is not None:
+            self.target = _fieldSpec(self.left).target
+        else:
+            self.target = self
+
+    def calcsize(self):
+        if self.size is None:
+            # Let struct complain about it
+            return calcsize(self.fieldType)
+        return self.size
+
+    def emptySize(self):
+        # calcPackSize() of this specifier for an empty value
+        target = self.target
+        if target.count is not None or target.literal:
+            return 0
+        return target.calcsize()
+
+_specs = {}
+
+def _fieldSpec(fieldType):
+    try:
+        return _specs[fieldType]
+    except KeyError:
+        spec = _specs[fieldType] = _FieldSpec(fieldType)
+        return spec
+
+# Kinds of fields, as far as building and (un)packing them goes
+_PLAIN   = 0
+_NDRTYPE = 1
+_POINTER = 2
+_UNION   = 3
+
+class _NDRLayout:
+    """
+    The fields of a commonHdr/structure/referent combination, each one as
+    (fieldName, fieldTypeOrClass, spec, kind, emptySize). spec is the
+    _FieldSpec of string specifiers, emptySize what the field adds to the
+    alignment of a structure when it's not an NDR instance (None if it has
+    to be computed).
+    """
+    def __init__(self, commonHdr, structure, referent):
+        self.commonHdr = tuple(self.entry(field) for field in commonHdr)
+        self.structure = tuple(self.entry(field) for field in structure)
+        self.referent = tuple(self.entry(field) for field in referent)
+        self.body = self.commonHdr + self.structure
+        self.all = self.body + self.referent
+
+    def entry(self, field):
+        fieldName, fieldTypeOrClass = field
+        spec = None
+        emptySize = None
+        if inspect.isclass(fieldTypeOrClass) and issubclass(fieldTypeOrClass, NDR):
+            if issubclass(fieldTypeOrClass, NDRPOINTER):
+                kind = _POINTER
+            elif issubclass(fieldTypeOrClass, NDRUNION):
+                kind = _UNION
+            else:
+                kind = _NDRTYPE
+            emptySize = 0
+        elif isinstance(fieldTypeOrClass, basestring):
+            kind = _PLAIN
+            spec = _fieldSpec(fieldTypeOrClass)
+            if isinstance(fieldTypeOrClass, str):
+                try:
+                    emptySize = spec.emptySize()
+                except error:
+                    pass
+            else:
+                emptySize = 0
+        else:
+            kind = _PLAIN
+        return fieldName, fieldTypeOrClass, spec, kind, emptySize
+
+_layouts = {}
+
+# NDR64 alignment of the arms of unions, as freshly built instances
+_armAlignments = {}
+
+def _rest(data, offset):
+    # What's left of data past offset, as a view instead of a copy
+    if offset == 0:
+        return data
+    return buffer(data, offset)
+
+def _head(data, size):
+    if size >= len(data):
+        return data
+    return data[:size]
+
+def _consumedBy(ndr, soFar):
+    # Octets ndr took out of the stream in its last fromString(). If it
+    # didn't say, what it packs to
+    if ndr._consumed is None:
+        return len(ndr.getData(soFar))
+    return ndr._consumed
+
+# Arrays of scalars are (un)packed all at once, not one item at a time
+
+_bulkFormats = {}
+
+def _bulkFormat(item):
+    # (byte order, format character, size) of a struct specifier for one
+    # scalar, None if it's anything else
+    try:
+        return _bulkFormats[item]
+    except KeyError:
+        answer = None
+        if isinstance(item, str) and len(item) in (1, 2):
+            order, code = item[:-1], item[-1:]
+            if order in ('', '<', '>', '!', '=', '@') and code in 'cbBhHiIlLqQfd?':
+                answer = (order, code, calcsize(item))
+        _bulkFormats[item] = answer
+        return answer
+
+def _bulkUnpack(bulk, data, offset, count):
+    # count scalars out of data. Octets come back as a string
+    order, code, size = bulk
+    if code == 'c':
+        return data[offset:offset+count]
+    return list(unpack_from('%s%d%s' % (order, count, code), data, offset))
+
+_primitives = {}
+
+def _primitive(cls, isNDR64):
+    # The bulk format of NDR classes holding nothing but a scalar 'Data',
+    # and unpacking it the way NDR does. None for everything else
+    key = (cls, isNDR64)
+    try:
+        return _primitives[key]
+    except KeyError:
+        pass
+    answer = None
+    for name in ('fromString', 'unpack', 'calculatePad', 'fromStringReferents', 'fromStringReferent'):
+        if getattr(cls, name).im_func is not getattr(NDR, name).im_func:
+            break
+    else:
+        instance = _new(cls, isNDR64)
+        if instance.commonHdr == () and instance.referent == () and len(instance.structure) == 1 \
+           and instance.structure[0][0] == 'Data' and isinstance(instance.structure[0][1], str) \
+           and instance.fields.keys() == ['Data']:
+            answer = _bulkFormat(_fieldSpec(instance.structure[0][1]).target.fieldType)
+    _primitives[key] = answer
+    return answer
+
+def _layout(ndr):
+    key = (ndr.commonHdr, ndr.structure, ndr.referent)
+    try:
+        return _layouts[key]
+    except KeyError:
+        layout = _layouts[key] = _NDRLayout(*key)
+        return layout
+
+# Instances of NDR classes are mostly built as fields of other instances,
+# and each time the same way. The first one built is kept as a prototype
+# and the rest are copied from it, instead of going through __init__.
+
+class _Prototype:
+    """
+    A pristine instance of a class, flattened: its attributes, the values
+    of its plain fields, the empty lists among them and the NDR fields
+    (as (fieldName, class, topLevel), copied from their own prototypes)
+    """
+    def __init__(self, instance, children):
+        self.cls = instance.__class__
+        self.isNDR64 = instance._isNDR64
+        self.attrs = instance.__dict__.copy()
+        del self.attrs['fields']
+        self.values = {}
+        self.lists = []
+        for fieldName, value in dict.iteritems(instance.fields):
+            if isinstance(value, list):
+                self.lists.append(fieldName)
+            elif not isinstance(value, NDR):
+                self.values[fieldName] = value
+        self.children = children
+        self.pointer = isinstance(instance, NDRPOINTER)
+
+    def clone(self):
+        instance = object.__new__(self.cls)
+        instance.__dict__.update(self.attrs)
+        fields = instance.fields = _NDRFields(instance)
+        dict.update(fields, self.values)
+        for fieldName in self.lists:
+            dict.__setitem__(fields, fieldName, [])
+        for fieldName, fieldClass, topLevel in self.children:
+            dict.__setitem__(fields, fieldName, _new(fieldClass, self.isNDR64, topLevel))
+        if self.pointer:
+            dict.__setitem__(fields, 'ReferentID', random.randint(1,65535))
+        return instance
+
+_prototypes = {}
+
+def _prototype(cls, isNDR64, topLevel):
+    # A _Prototype for the class, or None if instances can't be copied:
+    # they're built by an __init__ from outside this module, or end up
+    # holding something else than NDR instances, lists and immutables
+    for klass in cls.__mro__:
+        if klass.__dict__.has_key('__init__'):
+            if klass.__module__ != __name__:
+                return None
+            break
+
+    # Building it mustn't show in the ReferentIDs drawn by the caller
+    state = random.getstate()
+    try:
+        if topLevel is True:
+            instance = cls(isNDR64 = isNDR64, topLevel = True)
+        else:
+            instance = cls(isNDR64 = isNDR64)
+    finally:
+        random.setstate(state)
+
+    if type(instance.fields) is not _NDRFields:
+        return None
+    for value in instance.__dict__.itervalues():
+        if not isinstance(value, _IMMUTABLE + (tuple, _NDRFields)):
+            return None
+
+    children = []
+    callLike = isinstance(instance, (NDRCALL, NDRUNION))
+    for fieldName, fieldTypeOrClass, spec, kind, emptySize in _layout(instance).all:
+        if kind is not _PLAIN:
+            if dict.get(instance.fields, fieldName).__class__ is not fieldTypeOrClass:
+                return None
+            children.append((fieldName, fieldTypeOrClass, callLike and (kind is _POINTER or kind is _UNION)))
+    names = set(fieldName for fieldName, fieldClass, topLevel in children)
+    for fieldName, value in dict.iteritems(instance.fields):
+        if isinstance(value, NDR):
+            if fieldName not in names:
+                return None
+        elif isinstance(value, list):
+            if value != []:
+                return None
+        elif not isinstance(value, _IMMUTABLE):
+            return None
+
+    return _Prototype(instance, children)
+
+def _new(cls, isNDR64, topLevel = False):
+    # A fresh cls(isNDR64 = isNDR64[, topLevel = True]) instance
+    key = (cls, isNDR64, topLevel)
+    try:
+        prototype = _prototypes[key]
+    except KeyError:
+        # Nothing to copy from while the prototype itself gets built
+        _prototypes[key] = None
+        prototype = _prototypes[key] = _prototype(cls, isNDR64, topLevel)
+    if prototype is None:
+        if topLevel is True:
+            return cls(isNDR64 = isNDR64, topLevel = True)
+        return cls(isNDR64 = isNDR64)
+    return prototype.clone()
+
 class NDR(object):
     """
     This will be the base class for all DCERPC NDR Types.
@@ -47,11 +398,17 @@ class NDR(object):
     align          = 4
     debug          = False
     _isNDR64       = False
+    # Cached __len__ and the instances whose cached __len__ depends on us
+    _size          = None
+    _owners        = None
+    # Octets taken by the last fromString() and by the last field unpack()ed
+    _consumed      = None
+    _unpacked      = None
 
     def __init__(self, data = None, isNDR64 = False):
         object.__init__(self)
         self._isNDR64 = isNDR64
-        self.fields = {}
+        self.fields = _NDRFields(self)
         self.data = None
         self.rawData = None
 
@@ -63,14 +420,16 @@ class NDR(object):
             if hasattr(self, 'align64'):
                 self.align = self.align64
 
-        for fieldName, fieldTypeOrClass in self.commonHdr+self.structure+self.referent:
-            if self.isNDR(fieldTypeOrClass):
-               self.fields[fieldName] = fieldTypeOrClass(isNDR64 = self._isNDR64)
+        for fieldName, fieldTypeOrClass, spec, kind, emptySize in _layout(self).all:
+            if kind is not _PLAIN:
+               self.fields[fieldName] = _new(fieldTypeOrClass, self._isNDR64)
             elif fieldTypeOrClass == ':':
                self.fields[fieldName] = ''
-            elif len(fieldTypeOrClass.split('=')) == 2: 
+            elif spec.constant is not _NOCONSTANT:
+               self.fields[fieldName] = spec.constant
+            elif spec.default is not None:
                try:
-                   self.fields[fieldName] = eval(fieldTypeOrClass.split('=')[1])
+                   self.fields[fieldName] = eval(spec.default)
                except:
                    self.fields[fieldName] = None
             else:
@@ -89,6 +448,7 @@ class NDR(object):
             if self._isNDR64 is False:
                 # Ok, let's change everything
                 self._isNDR64 = True
+                self._invalidate()
                 for fieldName in self.fields.keys():
                     if isinstance(self.fields[fieldName], NDR):
                         self.fields[fieldName].changeTransferSyntax(newSyntax)
@@ -153,8 +513,56 @@ class NDR(object):
         return self.getData()
 
     def __len__(self):
-        # XXX: improve
-        return len(self.getData())
+        cached = self._size
+        if cached is not None:
+            size, lists, fields, commonHdr, structure, referent = cached
+            if fields is self.fields and commonHdr is self.commonHdr and structure is self.structure \
+               and referent is self.referent and _listsUnchanged(lists):
+                return size
+            self._size = None
+
+        size = len(self.getData())
+        lists = []
+        if self._trackSize(self, lists):
+            self._size = (size, lists, self.fields, self.commonHdr, self.structure, self.referent)
+        return size
+
+    def _trackSize(self, owner, lists):
+        fields = self.fields
+        if not _sizeTrackable(self.__class__) or not isinstance(fields, _NDRFields) or fields.owner() is not self:
+            return False
+        if owner is not self:
+            if self._owners is None:
+                self._owners = {}
+            self._owners[id(owner)] = weakref.ref(owner)
+        for value in fields.itervalues():
+            if not _trackValue(owner, value, lists):
+                return False
+        return True
+
+    def _invalidate(self):
+        self._size = None
+        owners = self._owners
+        if owners:
+            self._owners = None
+            _invalidateOwners(owners)
+
+    def __getstate__(self):
+        # Copies start without a cached size, and with fields of their own
+        state = self.__dict__.copy()
+        state.pop('_size', None)
+        state.pop('_owners', None)
+        state['fields'] = dict(self.fields)
+        if isinstance(self.rawData, buffer):
+            # buffer objects can't be copied. What the instance was unpacked from
+            # is kept as a string in the copy
+            state['rawData'] = str(self.rawData)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.fields = _NDRFields(self)
+        self.fields.update(state['fields'])
 
     def getDataLen(self, data):
         return len(data)
@@ -243,13 +651,14 @@ class NDR(object):
             print "Calculate PAD: name: %s, type:%s, soFar:%d" % (fieldName, fieldType, soFar)
         alignment = 0
         size = 0
-        if isinstance(self.fields[fieldName], NDR):
-            alignment = self.fields[fieldName].getAlignment()
+        field = self.fields[fieldName]
+        if isinstance(field, NDR):
+            alignment = field.getAlignment()
         else:
             if fieldType == ':':
                 return 0
             # Special case for arrays, fieldType is the array item type
-            if len(fieldType.split('*')) == 2:
+            if _fieldSpec(fieldType).count is not None:
                 if self.isNDR(self.item):
                     fieldType = ':'
                     # ToDo: Careful here.. I don't know this is right.. 
@@ -259,7 +668,7 @@ class NDR(object):
                 else:
                     fieldType = self.item
             if packing:
-                alignment = self.calcPackSize(fieldType, self.fields[fieldName])
+                alignment = self.calcPackSize(fieldType, field)
             else:
                 alignment = self.calcUnPackSize(fieldType, data)
         if alignment > 0 and alignment <= 8:
@@ -346,33 +755,56 @@ class NDR(object):
             self.rawData = data
 
         soFar0 = soFar
+        offset = 0
+        consumed = 0
         for fieldName, fieldTypeOrClass in self.commonHdr+self.structure:
-            size = self.calcUnPackSize(fieldTypeOrClass, data)
-            pad = self.calculatePad(fieldName, fieldTypeOrClass, data, soFar = soFar, packing = False)
+            rest = _rest(data, offset)
+            size = self.calcUnPackSize(fieldTypeOrClass, rest)
+            pad = self.calculatePad(fieldName, fieldTypeOrClass, rest, soFar = soFar, packing = False)
             if pad > 0:
                 soFar += pad
-                data = data[pad:]
+                offset += pad
+                consumed += pad
+                rest = _rest(data, offset)
             try:
-                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, data[:size], soFar)
-                if isinstance(self.fields[fieldName], NDR):
-                    size = len(self.fields[fieldName].getData(soFar))
-                data = data[size:]
+                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, _head(rest, size), soFar)
+                size, used = self.unpackedSize(fieldName, size, soFar)
+                offset += size
                 soFar += size
+                consumed += used
             except Exception,e:
-                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, data, size),)
+                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, str(rest), size),)
                 raise
 
+        self._unpackedFrom(data, consumed)
         return self
 
+    def _unpackedFrom(self, data, consumed):
+        # fromString() took consumed octets from data. Those are what rawData
+        # keeps if data is a view, the view would keep the whole PDU alive
+        self._consumed = consumed
+        if self.rawData is data and isinstance(data, buffer):
+            self.rawData = data[:consumed]
+
+    def unpackedSize(self, fieldName, size, soFar = 0):
+        # After unpack(), how far to move on in the stream, and how many
+        # octets the field stands for
+        field = self.fields[fieldName]
+        if isinstance(field, NDR):
+            size = _consumedBy(field, soFar)
+            return size, size
+        return size, self._unpacked
+
     def fromStringReferents(self, data, soFar = 0):
         soFar0 = soFar
+        offset = 0
         for fieldName, fieldTypeOrClass in self.commonHdr+self.structure:
             if isinstance(self.fields[fieldName], NDR):
-                nSoFar = self.fields[fieldName].fromStringReferents(data, soFar)
+                nSoFar = self.fields[fieldName].fromStringReferents(_rest(data, offset), soFar)
                 soFar += nSoFar
-                nSoFar2 = self.fields[fieldName].fromStringReferent(data[nSoFar:], soFar)
+                nSoFar2 = self.fields[fieldName].fromStringReferent(_rest(data, offset + nSoFar), soFar)
                 soFar += nSoFar2
-                data = data[nSoFar+nSoFar2:]
+                offset += nSoFar+nSoFar2
         return soFar - soFar0
 
     def fromStringReferent(self, data, soFar = 0):
@@ -386,24 +818,27 @@ class NDR(object):
                 # NULL Pointer, there's no referent for it
                 return 0
 
+        offset = 0
         for fieldName, fieldTypeOrClass in self.referent:
-            size = self.calcUnPackSize(fieldTypeOrClass, data)
-            pad = self.calculatePad(fieldName, fieldTypeOrClass, data, soFar = soFar, packing = False)
+            rest = _rest(data, offset)
+            size = self.calcUnPackSize(fieldTypeOrClass, rest)
+            pad = self.calculatePad(fieldName, fieldTypeOrClass, rest, soFar = soFar, packing = False)
             if pad > 0:
                 soFar += pad
-                data = data[pad:]
+                offset += pad
+                rest = _rest(data, offset)
             try:
-                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, data[:size], soFar)
+                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, _head(rest, size), soFar)
             except Exception,e:
-                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, data, size),)
+                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, str(rest), size),)
                 raise
 
             if isinstance(self.fields[fieldName], NDR):
-                size = len(self.fields[fieldName].getData(soFar))
-                nSoFar = self.fields[fieldName].fromStringReferents(data[size:], soFar + size)
-                nSoFar2 = self.fields[fieldName].fromStringReferent(data[size + nSoFar:], soFar + size + nSoFar)
+                size = _consumedBy(self.fields[fieldName], soFar)
+                nSoFar = self.fields[fieldName].fromStringReferents(_rest(data, offset + size), soFar + size)
+                nSoFar2 = self.fields[fieldName].fromStringReferent(_rest(data, offset + size + nSoFar), soFar + size + nSoFar)
                 size += nSoFar + nSoFar2 
-            data = data[size:]
+            offset += size
             soFar += size
 
         return soFar-soFar0
@@ -412,37 +847,51 @@ class NDR(object):
         if self.debug:
             print "  pack( %s | %s | %d )" %  (fieldName, fieldTypeOrClass, soFar)
 
-        if isinstance(self.fields[fieldName], NDR):
-            return self.fields[fieldName].getData(soFar)
-
         data = self.fields[fieldName]
+        if isinstance(data, NDR):
+            return data.getData(soFar)
+
+        spec = _fieldSpec(fieldTypeOrClass)
         # void specifier
-        if fieldTypeOrClass[:1] == '_':
+        if spec.void:
             return ''
 
         # code specifier
-        two = fieldTypeOrClass.split('=')
-        if len(two) >= 2:
+        if spec.left is not None:
             try:
-                return self.pack(fieldName, two[0], soFar)
+                return self.pack(fieldName, spec.left, soFar)
             except:
-                self.fields[fieldName] = eval(two[1], {}, self.fields)
-                return self.pack(fieldName, two[0], soFar)
+                self.fields[fieldName] = eval(spec.code, {}, self.fields)
+                return self.pack(fieldName, spec.left, soFar)
 
         # array specifier
-        two = fieldTypeOrClass.split('*')
-        if len(two) == 2:
+        if spec.count is not None:
             answer = ''
             if self.isNDR(self.item):
                 item = ':'
                 dataClass = self.item
-                self.fields['_tmpItem'] = dataClass(isNDR64=self._isNDR64)
+                self.fields['_tmpItem'] = _new(dataClass, self._isNDR64)
             else:
                 item = self.item
                 dataClass = None
                 self.fields['_tmpItem'] = item
 
-            for each in data:
+            bulk = None
+            if dataClass is None and len(data) > 0:
+                bulk = _bulkFormat(item)
+            if bulk is not None:
+                # Once the first one is aligned, so are the rest
+                pad = self.calculatePad('_tmpItem', self.item, answer, soFar, packing = True)
+                order, code, size = bulk
+                if code == 'c' and isinstance(data, str):
+                    answer = '\xdd' * pad + data
+                else:
+                    answer = '\xdd' * pad + pack('%s%d%s' % (order, len(data), code), *data)
+                items = ()
+            else:
+                items = data
+
+            for each in items:
                 pad = self.calculatePad('_tmpItem', self.item, answer, len(answer)+soFar, packing = True)
                 if pad > 0:
                     answer += '\xdd' * pad
@@ -462,92 +911,126 @@ class NDR(object):
                     answer += each.getDataReferent(len(answer)+soFar)
 
             del(self.fields['_tmpItem'])
-            self.fields[two[1]] = len(data)
+            self.fields[spec.count] = len(data)
             return answer
 
         if data is None:
             raise Exception, "Trying to pack None"
         
         # literal specifier
-        if fieldTypeOrClass[:1] == ':':
+        if spec.literal:
             return str(data)
 
         # struct like specifier
-        return pack(fieldTypeOrClass, data)
+        if spec.struct is None:
+            return pack(fieldTypeOrClass, data)
+        return spec.struct.pack(data)
 
     def unpack(self, fieldName, fieldTypeOrClass, data, soFar = 0):
         if self.debug:
             print "  unpack( %s | %s | %r | %d)" %  (fieldName, fieldTypeOrClass, data, soFar)
 
-        if isinstance(self.fields[fieldName], NDR):
-            return self.fields[fieldName].fromString(data, soFar)
+        field = self.fields[fieldName]
+        if isinstance(field, NDR):
+            field._consumed = None
+            return field.fromString(data, soFar)
 
+        spec = _fieldSpec(fieldTypeOrClass)
         # code specifier
-        two = fieldTypeOrClass.split('=')
-        if len(two) >= 2:
-            return self.unpack(fieldName,two[0], data, soFar)
+        if spec.left is not None:
+            return self.unpack(fieldName, spec.left, data, soFar)
 
         # array specifier
-        two = fieldTypeOrClass.split('*')
         answer = []
         soFarItems = 0
-        if len(two) == 2:
+        if spec.count is not None:
             # First field points to a field with the amount of items
-            numItems = self[two[1]]
+            numItems = self[spec.count]
             # The item type is determined by self.item
             if self.isNDR(self.item):
                 item = ':'
                 dataClassOrCode = self.item
-                self.fields['_tmpItem'] = dataClassOrCode(isNDR64=self._isNDR64)
+                self.fields['_tmpItem'] = _new(dataClassOrCode, self._isNDR64)
             else:
                 item = self.item
                 dataClassOrCode = None
                 self.fields['_tmpItem'] = item
 
-            nsofar = 0
-            while numItems and soFarItems < len(data):
-                pad = self.calculatePad('_tmpItem', self.item, data[soFar:], soFarItems+soFar, packing = False)
+            # Items are read in place, walking data by offset
+            length = len(data)
+            if dataClassOrCode is None:
+                bulk = _bulkFormat(item)
+            else:
+                bulk = _primitive(dataClassOrCode, self._isNDR64)
+            if bulk is not None and numItems and soFarItems < length:
+                size = bulk[2]
+                if size <= 8:
+                    pad = (size - ((soFar + soFarItems) % size)) % size
+                else:
+                    pad = 0
+                start = soFarItems + pad
+                # As many as the item by item loop would go for
+                count = min(numItems, (length - start + size - 1) // size)
+                if count > 0 and start + count * size <= length:
+                    values = _bulkUnpack(bulk, data, start, count)
+                    if dataClassOrCode is None:
+                        answer = values
+                    else:
+                        for value in values:
+                            itemn = _new(dataClassOrCode, self._isNDR64)
+                            dict.__setitem__(itemn.fields, 'Data', value)
+                            itemn._consumed = pad + size
+                            pad = 0
+                            answer.append(itemn)
+                    soFarItems = start + count * size
+                    # Nothing left for them to do
+                    dataClassOrCode = None
+                    numItems = 0
+
+            while numItems and soFarItems < length:
+                pad = self.calculatePad('_tmpItem', self.item, _rest(data, soFar), soFarItems+soFar, packing = False)
                 if pad > 0:
                     soFarItems +=pad
                 if dataClassOrCode is None:
                     nsofar = soFarItems + calcsize(item)
                     answer.append(unpack(item, data[soFarItems:nsofar])[0])
                 else:
-                    itemn = dataClassOrCode(isNDR64=self._isNDR64)
-                    itemn.fromString(data[soFarItems:], soFar+soFarItems)
-                    itemn.rawData = data[soFarItems+len(itemn.getData(soFar+soFarItems)):] 
+                    itemn = _new(dataClassOrCode, self._isNDR64)
+                    itemn.fromString(_rest(data, soFarItems), soFar+soFarItems)
+                    nsofar = soFarItems + _consumedBy(itemn, soFar+soFarItems)
                     answer.append(itemn)
-                    nsofar += len(itemn.getData(soFarItems)) + pad
                 numItems -= 1
                 soFarItems = nsofar
 
-            pad = self.calculatePad('_tmpItem', self.item, data[soFarItems:], soFarItems+soFar, packing = False)
+            # Pads only make it to the octet stream if something comes after
+            # them, the ones left at the end don't count as part of the array
+            pending = 0
+            pad = self.calculatePad('_tmpItem', self.item, _rest(data, soFarItems), soFarItems+soFar, packing = False)
             if pad > 0:
                 soFarItems +=pad
+                pending += pad
 
             if dataClassOrCode is not None:
                 # We gotta go over again, asking for the referents
-                data = data[soFarItems:]
-                answer2 = []
-                #soFarItems = 0
                 for itemn in answer:
                     # ToDo: I'm not sure about this is right
                     if self._isNDR64 is False:
-                        pad = self.calculatePad('_tmpItem', self.item, data, soFarItems+soFar, packing = False)
+                        pad = self.calculatePad('_tmpItem', self.item, _rest(data, soFarItems), soFarItems+soFar, packing = False)
                         if pad > 0:
                             soFarItems += pad
-                            data = data[pad:]
-                    nSoFar = itemn.fromStringReferents(data, soFarItems+soFar)
+                            pending += pad
+                    nSoFar = itemn.fromStringReferents(_rest(data, soFarItems), soFarItems+soFar)
                     soFarItems += nSoFar
-                    data = data[nSoFar:]
-                    nSoFar2 = itemn.fromStringReferent(data, soFarItems+soFar)
+                    nSoFar2 = itemn.fromStringReferent(_rest(data, soFarItems), soFarItems+soFar)
                     soFarItems += nSoFar2
-                    data = data[nSoFar2:]
-                    answer2.append(itemn)
-                answer = answer2
-                del(answer2)
+                    if nSoFar + nSoFar2 > 0:
+                        pending = 0
 
             del(self.fields['_tmpItem'])
+            self._unpacked = soFarItems - pending
+            if answer == [] and self.item == 'c':
+                # Arrays of octets come back as strings
+                answer = ''
             return answer
 
         # literal specifier
@@ -555,10 +1038,25 @@ class NDR(object):
             if isinstance(fieldTypeOrClass, NDR):
                 return self.fields[field].fromString(data, soFar)
             else:
-                return data[:self.getDataLen(data)]
+                try:
+                    answer = data[:self.getDataLen(data)]
+                except (AttributeError, TypeError):
+                    if isinstance(data, str):
+                        raise
+                    # A getDataLen() written for strings only, data is a view. The
+                    # ones in this package take views, this copies what's left
+                    data = str(data)
+                    answer = data[:self.getDataLen(data)]
+                self._unpacked = len(answer)
+                return answer
 
         # struct like specifier
-        return unpack(fieldTypeOrClass, data)[0]
+        if spec.struct is None:
+            answer = unpack(fieldTypeOrClass, data)[0]
+        else:
+            answer = spec.struct.unpack(data)[0]
+        self._unpacked = len(data)
+        return answer
 
     def calcPackSize(self, fieldTypeOrClass, data):
         if self.debug:
@@ -567,29 +1065,27 @@ class NDR(object):
         if isinstance(fieldTypeOrClass, str) is False:
             return len(data)
 
-        # code specifier
-        two = fieldTypeOrClass.split('=')
-        if len(two) >= 2:
-            return self.calcPackSize(two[0], data)
+        # code specifier, sized as what's left of the '='
+        spec = _fieldSpec(fieldTypeOrClass).target
 
         # array specifier
-        two = fieldTypeOrClass.split('*')
-        if len(two) == 2:
+        if spec.count is not None:
             answer = 0
-            for each in data:
+            if len(data) > 0:
                 if self.isNDR(self.item):
                     item = ':'
                 else:
                     item = self.item
-                answer += self.calcPackSize(item, each)
+                for each in data:
+                    answer += self.calcPackSize(item, each)
             return answer
 
         # literal specifier
-        if fieldTypeOrClass[:1] == ':':
+        if spec.literal:
             return len(data)
 
         # struct like specifier
-        return calcsize(fieldTypeOrClass)
+        return spec.calcsize()
 
     def calcUnPackSize(self, fieldTypeOrClass, data):
         if self.debug:
@@ -598,22 +1094,15 @@ class NDR(object):
         if isinstance(fieldTypeOrClass, str) is False:
             return len(data)
 
-        # code specifier
-        two = fieldTypeOrClass.split('=')
-        if len(two) >= 2:
-            return self.calcUnPackSize(two[0], data)
+        # code specifier, sized as what's left of the '='
+        spec = _fieldSpec(fieldTypeOrClass).target
 
-        # array specifier
-        two = fieldTypeOrClass.split('*')
-        if len(two) == 2:
-            return len(data)
-
-        # literal specifier
-        if fieldTypeOrClass[:1] == ':':
+        # array specifier and literal specifier
+        if spec.count is not None or spec.literal:
             return len(data)
 
         # struct like specifier
-        return calcsize(fieldTypeOrClass)
+        return spec.calcsize()
 
 class NDRCALL(NDR):
     # This represents a group of NDR instances that conforms an NDR Call. 
@@ -629,7 +1118,7 @@ class NDRCALL(NDR):
     consistencyCheck = False
     def __init__(self, data = None, isNDR64 = False):
         self._isNDR64 = isNDR64
-        self.fields = {}
+        self.fields = _NDRFields(self)
         self.data = None
         self.rawData = None
 
@@ -641,19 +1130,19 @@ class NDRCALL(NDR):
             if hasattr(self, 'align64'):
                 self.align = self.align64
 
-        for fieldName, fieldTypeOrClass in self.commonHdr+self.structure+self.referent:
-            if self.isNDR(fieldTypeOrClass):
-               if self.isPointer(fieldTypeOrClass):
-                   self.fields[fieldName] = fieldTypeOrClass(isNDR64 = self._isNDR64, topLevel = True)
-               elif self.isUnion(fieldTypeOrClass):
-                   self.fields[fieldName] = fieldTypeOrClass(isNDR64 = self._isNDR64, topLevel = True)
+        for fieldName, fieldTypeOrClass, spec, kind, emptySize in _layout(self).all:
+            if kind is not _PLAIN:
+               if kind is _POINTER or kind is _UNION:
+                   self.fields[fieldName] = _new(fieldTypeOrClass, self._isNDR64, topLevel = True)
                else:
-                   self.fields[fieldName] = fieldTypeOrClass(isNDR64 = self._isNDR64)
+                   self.fields[fieldName] = _new(fieldTypeOrClass, self._isNDR64)
             elif fieldTypeOrClass == ':':
                self.fields[fieldName] = None
-            elif len(fieldTypeOrClass.split('=')) == 2: 
+            elif spec.constant is not _NOCONSTANT:
+               self.fields[fieldName] = spec.constant
+            elif spec.default is not None:
                try:
-                   self.fields[fieldName] = eval(fieldTypeOrClass.split('=')[1])
+                   self.fields[fieldName] = eval(spec.default)
                except:
                    self.fields[fieldName] = None
             else:
@@ -707,26 +1196,29 @@ class NDRCALL(NDR):
         if self.rawData is None:
             self.rawData = data
 
+        offset = 0
         for fieldName, fieldTypeOrClass in self.commonHdr+self.structure:
-            size = self.calcUnPackSize(fieldTypeOrClass, data)
-            pad = self.calculatePad(fieldName, fieldTypeOrClass, data, soFar = soFar, packing = False)
+            rest = _rest(data, offset)
+            size = self.calcUnPackSize(fieldTypeOrClass, rest)
+            pad = self.calculatePad(fieldName, fieldTypeOrClass, rest, soFar = soFar, packing = False)
             if pad > 0:
                 soFar += pad
-                data = data[pad:]
+                offset += pad
+                rest = _rest(data, offset)
             try:
-                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, data[:size], soFar)
+                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, _head(rest, size), soFar)
                 if isinstance(self.fields[fieldName], NDR):
-                    size = len(self.fields[fieldName].getData(soFar))
+                    size = _consumedBy(self.fields[fieldName], soFar)
                     # Any referent information to unpack?
                     if isinstance(self.fields[fieldName], NDR):
-                        nSoFar = self.fields[fieldName].fromStringReferents(data[size:], soFar + size)
-                        nSoFar2 = self.fields[fieldName].fromStringReferent(data[size + nSoFar:], soFar + size + nSoFar)
+                        nSoFar = self.fields[fieldName].fromStringReferents(_rest(data, offset + size), soFar + size)
+                        nSoFar2 = self.fields[fieldName].fromStringReferent(_rest(data, offset + size + nSoFar), soFar + size + nSoFar)
                         size += nSoFar + nSoFar2 
 
-                data = data[size:]
+                offset += size
                 soFar += size
             except Exception,e:
-                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, data, size),)
+                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, str(rest), size),)
                 raise
 
         if self.consistencyCheck is True:
@@ -970,32 +1462,45 @@ class NDRUniConformantArray(NDRArray):
 
         return data
 
-    def fromStringArray(self, data, soFar = 0):
+    def fromStringArray(self, data, soFar = 0, conformance = None):
         # Since we're unpacking an array, the MaximumCount was already processed
         # hence, we don't have to calculate the pad again.
+        # If the enclosing structure moved the MaximumCount octets to its
+        # beginning, they come in conformance, and data starts right after them
         if self.rawData is None:
             self.rawData = data
 
         soFar0 = soFar
         fieldNum = 0
+        offset = 0
+        consumed = 0
+        if conformance is not None:
+            offset = -len(conformance)
         for fieldName, fieldTypeOrClass in self.structure:
-            size = self.calcUnPackSize(fieldTypeOrClass, data)
+            if offset < 0:
+                rest = conformance[offset:]
+            else:
+                rest = _rest(data, offset)
+            size = self.calcUnPackSize(fieldTypeOrClass, rest)
             if fieldNum > 0:
-                pad = self.calculatePad(fieldName, fieldTypeOrClass, data, soFar = soFar, packing = False)
+                pad = self.calculatePad(fieldName, fieldTypeOrClass, rest, soFar = soFar, packing = False)
                 if pad > 0:
                     soFar += pad
-                    data = data[pad:]
+                    offset += pad
+                    consumed += pad
+                    rest = _rest(data, offset)
             try:
-                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, data[:size], soFar)
-                if isinstance(self.fields[fieldName], NDR):
-                    size = len(self.fields[fieldName].getData(soFar))
-                data = data[size:]
+                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, _head(rest, size), soFar)
+                size, used = self.unpackedSize(fieldName, size, soFar)
+                offset += size
                 soFar += size
+                consumed += used
                 fieldNum += 1
             except Exception,e:
-                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, data, size),)
+                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, str(rest), size),)
                 raise
 
+        self._unpackedFrom(data, consumed)
         return self
 
 # Uni-dimensional Varying Arrays
@@ -1071,33 +1576,46 @@ class NDRUniConformantVaryingArray(NDRArray):
 
         return data
 
-    def fromStringArray(self, data, soFar = 0):
+    def fromStringArray(self, data, soFar = 0, conformance = None):
         # Since we're unpacking an array, the MaximumCount/Offset/ActualCount
         # was already processed
         # hence, we don't have to calculate the pad again.
+        # If the enclosing structure moved the MaximumCount octets to its
+        # beginning, they come in conformance, and data starts right after them
         if self.rawData is None:
             self.rawData = data
 
         soFar0 = soFar
         fieldNum = 0
+        offset = 0
+        consumed = 0
+        if conformance is not None:
+            offset = -len(conformance)
         for fieldName, fieldTypeOrClass in self.commonHdr+self.structure:
-            size = self.calcUnPackSize(fieldTypeOrClass, data)
+            if offset < 0:
+                rest = conformance[offset:]
+            else:
+                rest = _rest(data, offset)
+            size = self.calcUnPackSize(fieldTypeOrClass, rest)
             if fieldNum > 1:
-                pad = self.calculatePad(fieldName, fieldTypeOrClass, data, soFar = soFar, packing = False)
+                pad = self.calculatePad(fieldName, fieldTypeOrClass, rest, soFar = soFar, packing = False)
                 if pad > 0:
                     soFar += pad
-                    data = data[pad:]
+                    offset += pad
+                    consumed += pad
+                    rest = _rest(data, offset)
             try:
-                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, data[:size], soFar)
-                if isinstance(self.fields[fieldName], NDR):
-                    size = len(self.fields[fieldName].getData(soFar))
-                data = data[size:]
+                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, _head(rest, size), soFar)
+                size, used = self.unpackedSize(fieldName, size, soFar)
+                offset += size
                 soFar += size
+                consumed += used
                 fieldNum += 1
             except Exception,e:
-                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, data, size),)
+                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, str(rest), size),)
                 raise
 
+        self._unpackedFrom(data, consumed)
         return self
 
 
@@ -1244,6 +1762,7 @@ class NDRSTRUCT(NDR):
 
         soFar0 = soFar
         pad0 = 0
+        offset = 0
         arrayPresent = False
         # 14.3.7.1 Structures Containing a Conformant Array
         # A structure can contain a conformant array only as its last member.
@@ -1276,16 +1795,16 @@ class NDRSTRUCT(NDR):
             pad0 = (arrayItemSize - (soFar % arrayItemSize)) % arrayItemSize 
             if pad0 > 0:
                 soFar += pad0
-                data = data[pad0:]
+                offset += pad0
             # And now, let's pretend we put the item in
             soFar += arrayItemSize
             # And let's extract the array size for later use, if it is a pointer, it is after the referent ID
             if isinstance(self, NDRPOINTER):
-                arraySize = data[arrayItemSize:][:arrayItemSize]
+                arraySize = data[offset+arrayItemSize:offset+2*arrayItemSize]
             else:
-                arraySize = data[:arrayItemSize]
+                arraySize = data[offset:offset+arrayItemSize]
             # And move on data
-            data = data[arrayItemSize:]
+            offset += arrayItemSize
 
         # Now we need to align the structure 
         # The alignment of a structure in the octet stream is the largest of the alignments of the fields it
@@ -1296,43 +1815,53 @@ class NDRSTRUCT(NDR):
             pad = (alignment - (soFar % alignment)) % alignment
             if pad > 0:
                 soFar += pad
-                data = data[pad:]
+                offset += pad
 
+        consumed = offset
         for fieldName, fieldTypeOrClass in self.commonHdr+self.structure:
             try:
-                size = self.calcUnPackSize(fieldTypeOrClass, data)
-                pad = self.calculatePad(fieldName, fieldTypeOrClass, data, soFar = soFar, packing = False)
+                rest = _rest(data, offset)
+                size = self.calcUnPackSize(fieldTypeOrClass, rest)
+                pad = self.calculatePad(fieldName, fieldTypeOrClass, rest, soFar = soFar, packing = False)
                 if pad > 0:
                     soFar += pad
-                    data = data[pad:]
+                    offset += pad
+                    consumed += pad
+                    rest = _rest(data, offset)
 
                 if isinstance(self.fields[fieldName], NDRUniConformantArray) or isinstance(self.fields[fieldName], NDRUniConformantVaryingArray):
-                    # Okey.. here it is.. so we should add the first arrayItemSize bytes to data
+                    # Okey.. here it is.. so we should hand the array the first arrayItemSize bytes
                     # and move from there
-                    data = arraySize + data
                     # and substract soFar times arrayItemSize (that we already counted at the beggining)
                     soFar -= arrayItemSize
+                    self.fields[fieldName]._consumed = None
+                    self.fields[fieldName].fromStringArray(_head(rest, size), soFar, arraySize)
                     # and add sizeItemSize to the size variable
                     size += arrayItemSize
-                    self.fields[fieldName].fromStringArray(data[:size], soFar)
+                    moved = arrayItemSize
                 else:
-                    self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, data[:size], soFar)
-                if isinstance(self.fields[fieldName], NDR):
-                    size = len(self.fields[fieldName].getData(soFar))
-                data = data[size:]
+                    self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, _head(rest, size), soFar)
+                    moved = 0
+                size, used = self.unpackedSize(fieldName, size, soFar)
+                offset += size - moved
                 soFar += size
+                consumed += used - moved
             except Exception,e:
-                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, data, size),)
+                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, str(_rest(data, offset)), size),)
                 raise
 
+        self._unpackedFrom(data, consumed)
         return self
 
     def getAlignment(self):
         tmpAlign = 0
         align = 0
-        for fieldName, fieldTypeOrClass in self.commonHdr+self.structure+self.referent:
-            if isinstance(self.fields[fieldName], NDR):
-                tmpAlign = self.fields[fieldName].getAlignment()
+        for fieldName, fieldTypeOrClass, spec, kind, emptySize in _layout(self).all:
+            field = self.fields[fieldName]
+            if isinstance(field, NDR):
+                tmpAlign = field.getAlignment()
+            elif emptySize is not None:
+                tmpAlign = emptySize
             else:
                 tmpAlign = self.calcPackSize(fieldTypeOrClass, '')
             if tmpAlign > align:
@@ -1357,7 +1886,7 @@ class NDRUNION(NDR):
         #ret = NDR.__init__(self,None, isNDR64=isNDR64)
         self.topLevel = topLevel
         self._isNDR64 = isNDR64
-        self.fields = {}
+        self.fields = _NDRFields(self)
         self.data = None
         self.rawData = None
 
@@ -1369,19 +1898,19 @@ class NDRUNION(NDR):
             if hasattr(self, 'align64'):
                 self.align = self.align64
 
-        for fieldName, fieldTypeOrClass in self.commonHdr+self.structure+self.referent:
-            if self.isNDR(fieldTypeOrClass):
-               if self.isPointer(fieldTypeOrClass):
-                   self.fields[fieldName] = fieldTypeOrClass(isNDR64 = self._isNDR64, topLevel = True)
-               elif self.isUnion(fieldTypeOrClass):
-                   self.fields[fieldName] = fieldTypeOrClass(isNDR64 = self._isNDR64, topLevel = True)
+        for fieldName, fieldTypeOrClass, spec, kind, emptySize in _layout(self).all:
+            if kind is not _PLAIN:
+               if kind is _POINTER or kind is _UNION:
+                   self.fields[fieldName] = _new(fieldTypeOrClass, self._isNDR64, topLevel = True)
                else:
-                   self.fields[fieldName] = fieldTypeOrClass(isNDR64 = self._isNDR64)
+                   self.fields[fieldName] = _new(fieldTypeOrClass, self._isNDR64)
             elif fieldTypeOrClass == ':':
                self.fields[fieldName] = None
-            elif len(fieldTypeOrClass.split('=')) == 2: 
+            elif spec.constant is not _NOCONSTANT:
+               self.fields[fieldName] = spec.constant
+            elif spec.default is not None:
                try:
-                   self.fields[fieldName] = eval(fieldTypeOrClass.split('=')[1])
+                   self.fields[fieldName] = eval(spec.default)
                except:
                    self.fields[fieldName] = None
             else:
@@ -1397,6 +1926,7 @@ class NDRUNION(NDR):
     def __setitem__(self, key, value):
         if key == 'tag':
             # We're writing the tag, we now should set the right item for the structure
+            self._invalidate()
             self.structure = ()
             if self.union.has_key(value):
                 self.structure = (self.union[value]),
@@ -1488,8 +2018,8 @@ class NDRUNION(NDR):
         if len(data) > 4:
             # First off, let's see what the tag is:
             # We need to know the tag type and unpack it
-            tagtype = self.commonHdr[0][1].structure[0][1].split('=')[0]
-            tag = unpack(tagtype, data[:calcsize(tagtype)])[0]
+            tagtype = _fieldSpec(self.commonHdr[0][1].structure[0][1]).target
+            tag = unpack(tagtype.fieldType, data[:tagtype.calcsize()])[0]
             if self.union.has_key(tag):
                 self.structure = (self.union[tag]),
                 self.__init__(None, isNDR64=self._isNDR64, topLevel = self.topLevel)
@@ -1510,20 +2040,25 @@ class NDRUNION(NDR):
             self.rawData = data
 
         soFar0 = soFar
+        offset = 0
+        consumed = 0
         for fieldName, fieldTypeOrClass in self.commonHdr:
-            size = self.calcUnPackSize(fieldTypeOrClass, data)
-            pad = self.calculatePad(fieldName, fieldTypeOrClass, data, soFar = soFar, packing = False)
+            rest = _rest(data, offset)
+            size = self.calcUnPackSize(fieldTypeOrClass, rest)
+            pad = self.calculatePad(fieldName, fieldTypeOrClass, rest, soFar = soFar, packing = False)
             if pad > 0:
                 soFar += pad
-                data = data[pad:]
+                offset += pad
+                consumed += pad
+                rest = _rest(data, offset)
             try:
-                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, data[:size], soFar)
-                if isinstance(self.fields[fieldName], NDR):
-                    size = len(self.fields[fieldName].getData(soFar))
-                data = data[size:]
+                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, _head(rest, size), soFar)
+                size, used = self.unpackedSize(fieldName, size, soFar)
+                offset += size
                 soFar += size
+                consumed += used
             except Exception,e:
-                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, data, size),)
+                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, str(rest), size),)
                 raise
 
         # WARNING
@@ -1541,28 +2076,34 @@ class NDRUNION(NDR):
 
         pad = (align - (soFar % align)) % align
         if pad > 0:
-            data = data[pad:]
+            offset += pad
+            consumed += pad
             soFar += pad
 
         if self.structure is ():
+            self._unpackedFrom(data, consumed)
             return self
 
         for fieldName, fieldTypeOrClass in self.structure:
-            size = self.calcUnPackSize(fieldTypeOrClass, data)
-            pad = self.calculatePad(fieldName, fieldTypeOrClass, data, soFar = soFar, packing = False)
+            rest = _rest(data, offset)
+            size = self.calcUnPackSize(fieldTypeOrClass, rest)
+            pad = self.calculatePad(fieldName, fieldTypeOrClass, rest, soFar = soFar, packing = False)
             if pad > 0:
                 soFar += pad
-                data = data[pad:]
+                offset += pad
+                consumed += pad
+                rest = _rest(data, offset)
             try:
-                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, data[:size], soFar)
-                if isinstance(self.fields[fieldName], NDR):
-                    size = len(self.fields[fieldName].getData(soFar))
-                data = data[size:]
+                self.fields[fieldName] = self.unpack(fieldName, fieldTypeOrClass, _head(rest, size), soFar)
+                size, used = self.unpackedSize(fieldName, size, soFar)
+                offset += size
                 soFar += size
+                consumed += used
             except Exception,e:
-                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, data, size),)
+                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, fieldTypeOrClass, str(rest), size),)
                 raise
 
+        self._unpackedFrom(data, consumed)
         return self
 
     def getAlignment(self):
@@ -1587,7 +2128,10 @@ class NDRUNION(NDR):
 
         if self._isNDR64:
             for fieldName, fieldTypeOrClass in self.union.itervalues():
-                tmpAlign = fieldTypeOrClass(isNDR64 = self._isNDR64).getAlignment()
+                try:
+                    tmpAlign = _armAlignments[fieldTypeOrClass]
+                except KeyError:
+                    tmpAlign = _armAlignments[fieldTypeOrClass] = fieldTypeOrClass(isNDR64 = self._isNDR64).getAlignment()
                 if tmpAlign > align:
                     align = tmpAlign
         return align
@@ -1680,6 +2224,7 @@ class NDRPOINTER(NDR):
         if unpack('<L', data[:4])[0] == 0:
             self['ReferentID'] = 0
             self.fields['Data'] = ''
+            self._consumed = len(self.getData(soFar))
             return self
         else:
             return NDR.fromString(self,data, soFar)
@@ -1826,6 +2371,110 @@ class TestPointerNULL(NDRTest):
     def populate(self, a):
         pass
 
+class TestScalarArrays:
+    # Arrays of scalars are (un)packed in one go. Octets come back as a string,
+    # the rest as a list of numbers
+    def arrayClass(self, base, item):
+        class Array(base):
+            pass
+        Array.item = item
+        class theClass(NDRCALL):
+            structure = (
+                ('Count', NDRULONG),
+                ('Array', Array),
+                ('Trailer', NDRULONG),
+            )
+        return theClass
+
+    def check(self, what, value, expected):
+        if value != expected or type(value) != type(expected):
+            print "ERROR: %s is %r, should be %r" % (what, value, expected)
+            raise Exception('TestScalarArrays')
+
+    def test(self, isNDR64 = False):
+        print
+        print "-"*70
+        print "starting test: %s (NDR64 = %s)....." % (self.__class__.__name__, isNDR64)
+        for base in (NDRUniConformantArray, NDRUniConformantVaryingArray):
+            for item, values in (('c', ['a', 'b', 'c']), ('<H', [1, 0xffff, 3]), ('<L', [1, 0xffffffff, 3])):
+                theClass = self.arrayClass(base, item)
+                # Empty, odd length
+                for count in (0, 1, 3):
+                    a = theClass(isNDR64 = isNDR64)
+                    a['Count'] = count
+                    a['Array'] = values[:count]
+                    a['Trailer'] = 0x11223344
+                    a_str = str(a)
+                    b = theClass(a_str, isNDR64 = isNDR64)
+                    if item == 'c':
+                        self.check('%s %s[:%d]' % (base.__name__, item, count), b['Array'], ''.join(values[:count]))
+                    else:
+                        self.check('%s %s[:%d]' % (base.__name__, item, count), b['Array'], values[:count])
+                    self.check('%s %s[:%d] Trailer' % (base.__name__, item, count), b['Trailer'], 0x11223344)
+                    self.check('%s %s[:%d] repacked' % (base.__name__, item, count), str(b), a_str)
+
+        # Counts that don't match the data. Three items in the stream, the array
+        # says two: the third one goes to Trailer
+        if isNDR64 is False:
+            for item, body, expected in (('c', 'abc\x00', 'ab'), ('<H', pack('<HHHH', 1, 2, 3, 0), [1, 2]), ('<L', pack('<LLL', 1, 2, 3), [1, 2])):
+                theClass = self.arrayClass(NDRUniConformantArray, item)
+                b = theClass(pack('<LL', 9, 2) + body + pack('<L', 0x11223344), isNDR64 = isNDR64)
+                self.check('%s of 2 out of 3' % item, b['Array'], expected)
+                if item == 'c':
+                    self.check('%s of 2 out of 3 Trailer' % item, b['Trailer'], 0x11223344)
+                else:
+                    self.check('%s of 2 out of 3 Trailer' % item, b['Trailer'], 3)
+            # The array says five, the stream ends after three
+            for item, body in (('c', 'abc'), ('<H', pack('<HHH', 1, 2, 3)), ('<L', pack('<LLL', 1, 2, 3))):
+                theClass = self.arrayClass(NDRUniConformantArray, item)
+                try:
+                    theClass(pack('<LL', 9, 5) + body, isNDR64 = isNDR64)
+                except Exception:
+                    pass
+                else:
+                    print "ERROR: %s array of 5 out of 3 unpacked" % item
+                    raise Exception('TestScalarArrays')
+
+    def run(self):
+        self.test(False)
+        self.test(True)
+
+class PTestString(NDRPOINTER):
+    referent = (
+        ('Data', NDRConformantVaryingString),
+    )
+
+class TestEntry(NDRSTRUCT):
+    structure = (
+        ('Id', NDRULONG),
+        ('Name', PTestString),
+    )
+
+class TestEntryArray(NDRUniConformantArray):
+    item = TestEntry
+
+class PTestEntryArray(NDRPOINTER):
+    referent = (
+        ('Data', TestEntryArray),
+    )
+
+class TestStructArray(NDRTest):
+    # Array items with referents of odd sizes, and something after them
+    class theClass(NDRCALL):
+        structure = (
+            ('Count', NDRULONG),
+            ('Entries', PTestEntryArray),
+            ('Trailer', NDRULONG),
+        )
+    def populate(self, a):
+        for i in range(5):
+            entry = TestEntry(isNDR64 = a._isNDR64)
+            entry['Id'] = i
+            entry['Name'] = 'name' + 'x'*i
+            a['Entries'].append(entry)
+        a['Count'] = 5
+        a['Trailer'] = 0x12345678
+
 if __name__ == '__main__':
     TestUniFixedArray().run()
     #TestUniConformantArray().run()
@@ -1834,3 +2483,5 @@ if __name__ == '__main__':
     TestVaryingString().run()
     TestConformantVaryingString().run()
     TestPointerNULL().run()
+    TestScalarArrays().run()
+    TestStructArray().run()
@@ -0,0 +1,345 @@
+# Copyright (c) 2003-2014 CORE Security Technologies
+#
+# This software is provided under under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# $Id$
+#
+# Description:
+#   Pool of bound DCE/RPC associations. Instead of connecting,
+#   authenticating and binding every time, ask the pool:
+#
+#   pool = DCERPCPool()
+#   dce = pool.get(r'ncacn_np:%s[\pipe\samr]' % host, samr.MSRPC_UUID_SAMR, username, password, domain)
+#   ... use dce ...
+#   pool.release(dce)
+#
+#   Associations released are handed out again to whoever asks for the
+#   same binding, credentials and auth level. If the interface asked for is
+#   a different one, it is bound through alter_ctx on an idle association
+#   first. Named pipe associations to the same server with the same
+#   credentials share their SMB session if it's SMB2 or up. Its dispatcher
+#   (see SMB3.startDispatcher()) is started then, for them to be used from
+#   different threads at once. SMB1 sessions have none, every named pipe
+#   association gets its own.
+#
+
+import select
+import threading
+import time
+
+from impacket import smb
+from impacket.dcerpc.v5 import transport
+from impacket.dcerpc.v5.rpcrt import RPC_C_AUTHN_WINNT
+
+def _isAlive(sock):
+    # Nothing should be waiting to be read on an idle association's socket,
+    # unless the other end closed it
+    try:
+        return len(select.select([sock], [], [], 0)[0]) == 0
+    except Exception:
+        return False
+
+def _isSessionAlive(smbConnection):
+    # Other associations might be using the session's socket, what's waiting
+    # there could be their answers. The session is asked instead
+    try:
+        return smbConnection.getSMBServer().echo() is True
+    except Exception:
+        return False
+
+class _SMBSession:
+    # An SMB session shared by named pipe associations
+    def __init__(self, smbKey, smbConnection):
+        self.smbKey = smbKey
+        self.smbConnection = smbConnection
+        self.users = 1
+        self.lastUsed = time.time()
+
+class _Association:
+    def __init__(self, key, rpctransport, smbSession):
+        self.key = key
+        self.transport = rpctransport
+        # The _SMBSession used, None if it's not shared
+        self.smbSession = smbSession
+        # Bound contexts, by interface
+        self.contexts = {}
+        self.lastUsed = time.time()
+
+    def isAlive(self):
+        if self.smbSession is not None:
+            return _isSessionAlive(self.smbSession.smbConnection)
+        return _isAlive(self.transport.get_socket())
+
+class DCERPCPool:
+    """
+    Keeps bound DCERPC_v5 instances for reuse. Thread safe, although each
+    instance is handed out to one user at a time. Those sharing an SMB
+    session can be used from different threads at once, its dispatcher
+    serializes their SMB traffic
+    """
+    def __init__(self, maxIdleTime = 300):
+        """
+        :param integer maxIdleTime: seconds an association can stay unused before it's disconnected
+        """
+        self.__maxIdleTime = maxIdleTime
+        self.__lock = threading.Lock()
+        # key -> idle _Associations, least recently used first
+        self.__idle = {}
+        # id(dce) -> _Association, for those handed out
+        self.__busy = {}
+        # SMB sessions the named pipe associations share. smbKey -> _SMBSession
+        self.__smbSessions = {}
+
+    def get(self, stringBinding, uuid, username = '', password = '', domain = '', lmhash = '', nthash = '', aesKey = '', doKerberos = False, authLevel = None, authType = RPC_C_AUTHN_WINNT, transfer_syntax = ('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0')):
+        """
+        hands out a DCERPC_v5 bound to an interface
+
+        :param string stringBinding: where to connect to, e.g. ncacn_np:host[\\pipe\\samr]
+        :param string uuid: the interface to bind to, as MSRPC_UUID_* in the interface modules
+        :param string username, password, domain, lmhash, nthash, aesKey: the credentials
+        :param boolean doKerberos: whether to use Kerberos to authenticate the transport
+        :param integer authLevel: RPC_C_AUTHN_LEVEL_* to bind with, None not to authenticate the bind itself
+        :param integer authType: RPC_C_AUTHN_* to bind with, if authLevel is set
+        :param tuple transfer_syntax: the transfer syntax to bind with
+
+        :return: the DCERPC_v5 instance. Give it back with release() when done, or with discard() if it's broken
+        """
+        key = (stringBinding, username, password, domain, lmhash, nthash, aesKey, doKerberos, authLevel, authType, transfer_syntax)
+        self.evict()
+
+        while True:
+            association = self.__takeIdle(key, uuid)
+            if association is None:
+                break
+            if association.isAlive() is False:
+                self.__disconnect(association)
+                continue
+            if association.contexts.has_key(uuid):
+                dce = association.contexts[uuid]
+            else:
+                try:
+                    dce = self.__alterCtx(association, uuid, transfer_syntax)
+                except Exception:
+                    # Not an interface we can reach from there
+                    self.__putIdle(association)
+                    break
+            return self.__lend(dce, association)
+
+        association = self.__connect(key, stringBinding, username, password, domain, lmhash, nthash, aesKey, doKerberos)
+        try:
+            dce = association.transport.get_dce_rpc()
+            if authLevel is not None:
+                dce.set_credentials(*(association.transport.get_credentials()))
+                dce.set_auth_type(authType)
+                dce.set_auth_level(authLevel)
+            dce.bind(uuid, transfer_syntax = transfer_syntax)
+        except:
+            self.__disconnect(association)
+            raise
+        association.contexts[uuid] = dce
+        return self.__lend(dce, association)
+
+    def release(self, dce):
+        """
+        gives back a DCERPC_v5 instance handed out by get(), for others to use
+        """
+        self.__lock.acquire()
+        try:
+            association = self.__busy.pop(id(dce))
+        finally:
+            self.__lock.release()
+        association.lastUsed = time.time()
+        self.__putIdle(association)
+
+    def discard(self, dce):
+        """
+        disconnects a DCERPC_v5 instance handed out by get(), instead of
+        giving it back. For those that failed in the middle of a call
+        """
+        self.__lock.acquire()
+        try:
+            association = self.__busy.pop(id(dce))
+        finally:
+            self.__lock.release()
+        self.__disconnect(association)
+
+    def evict(self, maxIdleTime = None):
+        """
+        disconnects associations (and SMB sessions) unused for longer than maxIdleTime
+
+        :param integer maxIdleTime: seconds. If None, the pool's own maxIdleTime
+        """
+        if maxIdleTime is None:
+            maxIdleTime = self.__maxIdleTime
+        oldest = time.time() - maxIdleTime
+        evicted = []
+        self.__lock.acquire()
+        try:
+            for key in self.__idle.keys():
+                idle = self.__idle[key]
+                evicted.extend([association for association in idle if association.lastUsed <= oldest])
+                idle = [association for association in idle if association.lastUsed > oldest]
+                if len(idle) > 0:
+                    self.__idle[key] = idle
+                else:
+                    del(self.__idle[key])
+        finally:
+            self.__lock.release()
+        for association in evicted:
+            # Its session was idle since then too
+            self.__disconnect(association, association.lastUsed)
+
+        smbSessions = []
+        self.__lock.acquire()
+        try:
+            for smbKey, smbSession in self.__smbSessions.items():
+                if smbSession.users == 0 and smbSession.lastUsed <= oldest:
+                    smbSessions.append(smbSession)
+                    del(self.__smbSessions[smbKey])
+        finally:
+            self.__lock.release()
+        for smbSession in smbSessions:
+            self.__logoff(smbSession.smbConnection)
+
+    def close(self):
+        """
+        disconnects everything not handed out right now
+        """
+        self.evict(-1)
+
+    def __takeIdle(self, key, uuid):
+        # The most recently used idle association for key, preferably one
+        # already bound to uuid
+        self.__lock.acquire()
+        try:
+            idle = self.__idle.get(key, [])
+            if len(idle) == 0:
+                return None
+            chosen = idle[-1]
+            for association in reversed(idle):
+                if association.contexts.has_key(uuid):
+                    chosen = association
+                    break
+            idle.remove(chosen)
+            return chosen
+        finally:
+            self.__lock.release()
+
+    def __putIdle(self, association):
+        self.__lock.acquire()
+        try:
+            self.__idle.setdefault(association.key, []).append(association)
+        finally:
+            self.__lock.release()
+
+    def __lend(self, dce, association):
+        self.__lock.acquire()
+        try:
+            self.__busy[id(dce)] = association
+        finally:
+            self.__lock.release()
+        return dce
+
+    def __alterCtx(self, association, uuid, transfer_syntax):
+        # alter_ctx() numbers the new context after the one it's called on
+        last = None
+        for dce in association.contexts.values():
+            if last is None or dce._ctx > last._ctx:
+                last = dce
+        dce = last.alter_ctx(uuid)
+        association.contexts[uuid] = dce
+        return dce
+
+    def __connect(self, key, stringBinding, username, password, domain, lmhash, nthash, aesKey, doKerberos):
+        rpctransport = transport.DCERPCTransportFactory(stringBinding)
+        if hasattr(rpctransport, 'set_credentials'):
+            # This method exists only for selected protocol sequences.
+            rpctransport.set_credentials(username, password, domain, lmhash, nthash, aesKey)
+        rpctransport.set_kerberos(doKerberos)
+
+        smbKey = None
+        smbSession = None
+        if isinstance(rpctransport, transport.SMBTransport):
+            smbKey = (rpctransport.get_dip(), rpctransport.get_dport(), username, password, domain, lmhash, nthash, aesKey, doKerberos)
+            self.__lock.acquire()
+            try:
+                smbSession = self.__smbSessions.get(smbKey)
+                if smbSession is not None:
+                    # Taken already, for eviction not to log it off while checking it
+                    smbSession.users += 1
+            finally:
+                self.__lock.release()
+            if smbSession is not None:
+                if _isSessionAlive(smbSession.smbConnection) is True:
+                    rpctransport.set_smb_connection(smbSession.smbConnection)
+                else:
+                    self.__lock.acquire()
+                    try:
+                        if self.__smbSessions.get(smbKey) is smbSession:
+                            del(self.__smbSessions[smbKey])
+                    finally:
+                        self.__lock.release()
+                    self.__release(smbSession)
+                    smbSession = None
+
+        try:
+            rpctransport.connect()
+        except:
+            self.__disconnect(_Association(key, rpctransport, smbSession))
+            raise
+
+        if isinstance(rpctransport, transport.SMBTransport) and smbSession is None:
+            smbConnection = rpctransport.get_smb_connection()
+            if smbConnection.getDialect() == smb.SMB_DIALECT:
+                # Can't be shared, it's this association's alone
+                return _Association(key, rpctransport, None)
+            # Keep the SMB session for other pipes. The transport won't log it
+            # off when disconnecting, that's up to us now. Its dispatcher is started
+            # before anyone else can use it
+            rpctransport.set_smb_connection(smbConnection)
+            smbConnection.getSMBServer().startDispatcher()
+            smbSession = _SMBSession(smbKey, smbConnection)
+            self.__lock.acquire()
+            try:
+                if self.__smbSessions.has_key(smbKey) is False:
+                    self.__smbSessions[smbKey] = smbSession
+                # Otherwise someone else got here first, this session is shared by
+                # nobody else and logged off when its last user is gone
+            finally:
+                self.__lock.release()
+
+        return _Association(key, rpctransport, smbSession)
+
+    def __disconnect(self, association, lastUsed = None):
+        try:
+            association.transport.disconnect()
+        except Exception:
+            pass
+        if association.smbSession is None:
+            if isinstance(association.transport, transport.SMBTransport):
+                self.__logoff(association.transport.get_smb_connection())
+            return
+        self.__release(association.smbSession, lastUsed)
+
+    def __release(self, smbSession, lastUsed = None):
+        # One less association using smbSession. Sessions no longer in the pool
+        # (dropped as dead, or never shared) are logged off with the last one
+        self.__lock.acquire()
+        try:
+            smbSession.users -= 1
+            if lastUsed is None:
+                lastUsed = time.time()
+            smbSession.lastUsed = max(smbSession.lastUsed, lastUsed)
+            logoff = smbSession.users == 0 and self.__smbSessions.get(smbSession.smbKey) is not smbSession
+        finally:
+            self.__lock.release()
+        if logoff is True:
+            self.__logoff(smbSession.smbConnection)
+
+    def __logoff(self, smbConnection):
+        try:
+            smbConnection.logoff()
+        except Exception:
+            pass
@@ -19,8 +19,14 @@
 #     more SSP (e.g. NETLOGON)
 # 
 
+import errno
 import logging
+import Queue
+import select
 import socket
+import sys
+import time
+import traceback
 from binascii import a2b_hex
 from Crypto.Cipher import ARC4
 
@@ -32,6 +38,7 @@ from impacket import uuid
 from impacket.uuid import uuidtup_to_bin, generate, stringver_to_bin, bin_to_uuidtup
 from impacket.dcerpc.v5.dtypes import UCHAR, ULONG, USHORT
 from impacket.dcerpc.v5.ndr import NDRSTRUCT
+from impacket.dcerpc.v5.instrumentation import CallRecord, interfaceName
 from impacket import hresult_errors
 from threading import Thread
 
@@ -644,6 +651,20 @@ class MSRPCHeader(Structure):
 
         return self.getData()
 
+    def get_packet_parts(self):
+        # The packet as [header, pduData, trailer], pduData not copied, so
+        # the transport can send the parts one after the other
+        pduData = self['pduData']
+        self['pduData'] = ''
+        try:
+            packet = self.get_packet()
+        finally:
+            self['pduData'] = pduData
+        if self.fields.has_key('frag_len') is False:
+            packet = packet[:8] + pack('<H', len(packet) + len(pduData)) + packet[10:]
+        headerSize = self.get_header_size()
+        return [packet[:headerSize], pduData, packet[headerSize:]]
+
 class MSRPCRequestHeader(MSRPCHeader):
     _SIZE = 24
     commonHdr = MSRPCHeader.commonHdr + ( 
@@ -763,6 +784,19 @@ class MSRPCBindNak(Structure):
         if data is None:
             self['SupportedVersions'] = ''
 
+def _recvFragment(data, fragLen, recv):
+    # Completes a fragment, data being what we got of it so far. recv(count)
+    # returns up to count more octets
+    if len(data) >= fragLen:
+        return data
+    chunks = [data]
+    received = len(data)
+    while received < fragLen:
+        chunk = recv(fragLen - received)
+        chunks.append(chunk)
+        received += len(chunk)
+    return ''.join(chunks)
+
 class DCERPC:
     # Standard NDR Representation
     NDRSyntax   = uuidtup_to_bin(('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0'))
@@ -812,14 +846,19 @@ class DCERPC:
     def call(self, function, body, uuid=None):
         return self.send(DCERPC_RawCall(function, str(body), uuid))
     def request(self, request, uuid=None, checkError=True):
+        isNDR64 = self._setTransferSyntax(request)
+        self.call(request.opnum, request, uuid)
+        answer = self.recv()
+        return self._response(request, answer, isNDR64, checkError)
+
+    def _setTransferSyntax(self, request):
         if self.transfer_syntax == self.NDR64Syntax:
             request.changeTransferSyntax(self.NDR64Syntax)
-            isNDR64 = True
+            return True
         else:
-            isNDR64 = False
+            return False
 
-        self.call(request.opnum, request, uuid)
-        answer = self.recv()
+    def _response(self, request, answer, isNDR64, checkError):
         try:
             module = __import__(request.__module__.split('.')[-1], globals(), locals(), -1)
         except:
@@ -875,6 +914,20 @@ class DCERPC_v5(DCERPC):
         self.transfer_syntax = uuidtup_to_bin(('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0'))
         self.__callid = 1
         self._ctx = 0
+        self.__max_recv_size = None
+        # Presentation contexts bound. Interface -> (context id, transfer syntax)
+        self.__contexts = {}
+        self.__offered = []
+        self.__auth_ctx_id = 79231
+        # Calls sent with submit() still waiting for (part of) their answer
+        self.__pending = {}
+        self.__max_pending = 16
+        # Interface of the context requests go to
+        self.__interface = None
+        # Where to report to, see instrumentation. None measures nothing
+        self.__instrumentation = None
+        # CallRecords of the calls not answered yet, by call_id
+        self.__records = {}
 
     def set_session_key(self, session_key):
         self.__sessionKey = session_key
@@ -891,6 +944,47 @@ class DCERPC_v5(DCERPC):
 
     def set_max_tfrag(self, size):
         self.__max_xmit_size = size
+
+    def set_max_rfrag(self, size):
+        # Largest fragment we tell the server we can take, when binding. The
+        # bigger, the fewer fragments large responses come split into
+        self.__max_recv_size = size
+
+    def get_max_rfrag(self):
+        return self.__max_recv_size
+
+    def has_interface(self, uuid):
+        return self.__contexts.has_key(uuid)
+
+    def set_interface(self, uuid):
+        # Sends the following requests to the context uuid was bound in,
+        # without the round trip alter_ctx() costs
+        if self.__contexts.has_key(uuid) is False:
+            raise Exception('Interface %s v%s not bound' % bin_to_uuidtup(uuid))
+        self._ctx, self.transfer_syntax = self.__contexts[uuid]
+        self.__interface = uuid
+
+    def set_max_pending(self, count):
+        # How many submit()ted calls can be waiting for their answer before
+        # we stop sending and start reading. Keep it low enough for the
+        # answers to fit in what the transport buffers, or the server might
+        # block writing them while we block writing more requests
+        self.__max_pending = count
+
+    def get_max_pending(self):
+        return self.__max_pending
+
+    def set_instrumentation(self, instrumentation):
+        """
+        reports calls, binds and transport sends/recvs from now on
+
+        :param Instrumentation instrumentation: where to, e.g. an instrumentation.RPCStats. None to stop measuring
+        """
+        self.__instrumentation = instrumentation
+        self.__records = {}
+
+    def get_instrumentation(self):
+        return self.__instrumentation
     
     def get_credentials(self):
         return self.__username, self.__password, self.__domain, self.__lmhash, self.__nthash, self.__aesKey
@@ -912,8 +1006,45 @@ class DCERPC_v5(DCERPC):
                 self.__nthash = nthash
                 pass
 
-    def bind(self, uuid, alter = 0, bogus_binds = 0, transfer_syntax = ('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0')):
+    def bind(self, uuid, alter = 0, bogus_binds = 0, transfer_syntax = ('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0'), extra_uuids = ()):
+        # extra_uuids are other interfaces to bind in the same PDU, each one in
+        # a presentation context of its own. transfer_syntax can also be a list
+        # of syntaxes to offer for every interface, in order of preference.
+        # set_interface() chooses which interface the requests go to
+        if self.__instrumentation is None:
+            return self.__bind(uuid, alter, bogus_binds, transfer_syntax, extra_uuids)
+        start = time.time()
+        error = True
+        try:
+            resp = self.__bind(uuid, alter, bogus_binds, transfer_syntax, extra_uuids)
+            error = False
+            return resp
+        finally:
+            self.__instrumentation.bind(interfaceName(uuid), self._transport.__class__.__name__, alter != 0, time.time() - start, error)
+
+    def __bind(self, uuid, alter, bogus_binds, transfer_syntax, extra_uuids):
+        bind, auth = self._sendBind(uuid, alter, bogus_binds, transfer_syntax, extra_uuids)
+
+        s = self._transport.recv()
+
+        if s != 0:
+            resp = MSRPCHeader(s)
+        else:
+            return 0 #mmm why not None?
+
+        if self._bindAck(resp, bind, auth, bogus_binds):
+            self._recvAlterCtx()
+
+        return resp     # means packet is signed, if verifier is wrong it fails
+
+    def _sendBind(self, uuid, alter = 0, bogus_binds = 0, transfer_syntax = ('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0'), extra_uuids = ()):
+        # Sends the bind (or alter_ctx) request. Returns what _bindAck() needs
+        # to go on with its answer
         bind = MSRPCBind()
+        if self.__max_recv_size is not None:
+            bind['max_rfrag'] = self.__max_recv_size
+        if isinstance(transfer_syntax, list) is False:
+            transfer_syntax = [transfer_syntax]
         #item['TransferSyntax']['Version'] = 1
         ctx = self._ctx
         for i in range(bogus_binds):
@@ -923,18 +1054,25 @@ class DCERPC_v5(DCERPC):
             item['ContextID'] = ctx
             # We generate random UUIDs for bogus binds
             item['AbstractSyntax'] = generate() + stringver_to_bin('2.0')
-            item['TransferSyntax'] = uuidtup_to_bin(transfer_syntax)
+            item['TransferSyntax'] = uuidtup_to_bin(transfer_syntax[0])
             bind.addCtxItem(item)
             self._ctx += 1
             ctx += 1
 
-        # The true one :)
-        item = CtxItem()
-        item['AbstractSyntax'] = uuid
-        item['TransferSyntax'] = uuidtup_to_bin(transfer_syntax)
-        item['ContextID'] = ctx
-        item['TransItems'] = 1
-        bind.addCtxItem(item)
+        # The true ones :)
+        # Which interface went in each of the contexts, for _bindAck()
+        self.__offered = []
+        for abstractSyntax in [uuid] + list(extra_uuids):
+            for syntax in transfer_syntax:
+                item = CtxItem()
+                item['AbstractSyntax'] = abstractSyntax
+                item['TransferSyntax'] = uuidtup_to_bin(syntax)
+                item['ContextID'] = ctx
+                item['TransItems'] = 1
+                bind.addCtxItem(item)
+                self.__offered.append((ctx, abstractSyntax))
+                ctx += 1
+        self.__auth_ctx_id = self._ctx + 79231
 
         packet = MSRPCHeader()
         packet['type'] = MSRPC_BIND
@@ -944,6 +1082,7 @@ class DCERPC_v5(DCERPC):
         if alter:
             packet['type'] = MSRPC_ALTERCTX
 
+        auth = None
         if (self.__auth_level != RPC_C_AUTHN_LEVEL_NONE):
             if (self.__username is None) or (self.__password is None):
                 self.__username, self.__password, self.__domain, self.__lmhash, self.__nthash, self.__aesKey = self._transport.get_credentials()
@@ -961,7 +1100,7 @@ class DCERPC_v5(DCERPC):
             sec_trailer = SEC_TRAILER()
             sec_trailer['auth_type']   = self.__auth_type
             sec_trailer['auth_level']  = self.__auth_level
-            sec_trailer['auth_ctx_id'] = self._ctx + 79231 
+            sec_trailer['auth_ctx_id'] = self.__auth_ctx_id
 
             pad = (4 - (len(packet.get_packet()) % 4)) % 4
             if pad != 0:
@@ -972,14 +1111,13 @@ class DCERPC_v5(DCERPC):
             packet['auth_data'] = str(auth)
 
         self._transport.send(packet.get_packet())
+        return bind, auth
 
-        s = self._transport.recv()
-
-        if s != 0:
-            resp = MSRPCHeader(s)
-        else:
-            return 0 #mmm why not None?
-
+    def _bindAck(self, resp, bind, auth, bogus_binds = 0):
+        # Processes the answer to _sendBind(), sending what the authentication
+        # needs next. Returns True if an alter_ctx_resp is still due, to be
+        # read with _recvAlterCtx()
+        alterCtx = False
         if resp['type'] == MSRPC_BINDACK or resp['type'] == MSRPC_ALTERCTX_R:
             bindResp = MSRPCBindAck(str(resp))
         elif resp['type'] == MSRPC_BINDNAK:
@@ -994,21 +1132,36 @@ class DCERPC_v5(DCERPC):
         else:
             raise Exception('Unknown DCE RPC packet type received: %d' % resp['type'])
 
-        # check ack results for each context, except for the bogus ones
+        # check ack results for each context, except for the bogus ones. Every
+        # interface needs one of its contexts accepted, but only the first
+        # interface makes the bind fail if it got none
+        rejected = None
+        accepted = {}
         for ctx in range(bogus_binds+1,bindResp['ctx_num']+1):
             ctxItems = bindResp.getCtxItem(ctx)
+            ctxId, abstractSyntax = self.__offered[ctx-bogus_binds-1]
             if ctxItems['Result'] != 0:
-                msg = "Bind context %d rejected: " % ctx
-                msg += rpc_cont_def_result.get(ctxItems['Result'], 'Unknown DCE RPC context result code: %.4x' % ctxItems['Result'])
-                msg += "; "
-                reason = bindResp.getCtxItem(ctx)['Reason']
-                msg += rpc_provider_reason.get(reason, 'Unknown reason code: %.4x' % reason)
-                if (ctxItems['Result'], reason) == (2, 1): # provider_rejection, abstract syntax not supported
-                    msg += " (this usually means the interface isn't listening on the given endpoint)"
-                raise Exception(msg, ctxItems)
-
-            # Save the transfer syntax for later use
-            self.transfer_syntax = ctxItems['TransferSyntax'] 
+                if rejected is None:
+                    msg = "Bind context %d rejected: " % ctx
+                    msg += rpc_cont_def_result.get(ctxItems['Result'], 'Unknown DCE RPC context result code: %.4x' % ctxItems['Result'])
+                    msg += "; "
+                    reason = bindResp.getCtxItem(ctx)['Reason']
+                    msg += rpc_provider_reason.get(reason, 'Unknown reason code: %.4x' % reason)
+                    if (ctxItems['Result'], reason) == (2, 1): # provider_rejection, abstract syntax not supported
+                        msg += " (this usually means the interface isn't listening on the given endpoint)"
+                    rejected = Exception(msg, ctxItems)
+                continue
+
+            # Save the context and transfer syntax for later use
+            if accepted.has_key(abstractSyntax) is False:
+                accepted[abstractSyntax] = (ctxId, ctxItems['TransferSyntax'])
+
+        if accepted.has_key(self.__offered[0][1]) is False:
+            if rejected is None:
+                rejected = Exception('Bind context not acknowledged')
+            raise rejected
+        self.__contexts.update(accepted)
+        self.set_interface(self.__offered[0][1])
 
         self.__max_xmit_size = bindResp['max_tfrag']
 
@@ -1053,7 +1206,7 @@ class DCERPC_v5(DCERPC):
             sec_trailer = SEC_TRAILER()
             sec_trailer['auth_type'] = self.__auth_type
             sec_trailer['auth_level'] = self.__auth_level
-            sec_trailer['auth_ctx_id'] = self._ctx + 79231 
+            sec_trailer['auth_ctx_id'] = self.__auth_ctx_id
 
             if response is not None:
                 if self.__auth_type == RPC_C_AUTHN_GSS_NEGOTIATE:
@@ -1065,8 +1218,7 @@ class DCERPC_v5(DCERPC):
                     self._transport.send(alter_ctx.get_packet(), forceWriteAndx = 1)
                     self.__gss = gssapi.GSSAPI(self.__cipher)
                     self.__sequence = 0
-                    s = self.recv()
-                    self.__sequence = 0
+                    alterCtx = True
                 else:
                     auth3 = MSRPCHeader()
                     auth3['type'] = MSRPC_AUTH3
@@ -1085,17 +1237,26 @@ class DCERPC_v5(DCERPC):
 
             self.__callid += 1
 
-        return resp     # means packet is signed, if verifier is wrong it fails
+        return alterCtx
+
+    def _recvAlterCtx(self):
+        self.recv()
+        self.__sequence = 0
 
     def _transport_send(self, rpc_packet, forceWriteAndx = 0, forceRecv = 0):
         rpc_packet['ctx_id'] = self._ctx
+        record = self.__records.get(rpc_packet['call_id'])
         if self.__auth_level in [RPC_C_AUTHN_LEVEL_PKT_INTEGRITY, RPC_C_AUTHN_LEVEL_PKT_PRIVACY]:
+            if record is not None:
+                start = time.time()
+            # Signing and sealing want the data as a string
+            rpc_packet['pduData'] = str(rpc_packet['pduData'])
             # Dummy verifier, just for the calculations
             sec_trailer = SEC_TRAILER()
             sec_trailer['auth_type'] = self.__auth_type
             sec_trailer['auth_level'] = self.__auth_level
             sec_trailer['auth_pad_len'] = 0
-            sec_trailer['auth_ctx_id'] = self._ctx + 79231 
+            sec_trailer['auth_ctx_id'] = self.__auth_ctx_id
 
             pad = (4 - (len(rpc_packet.get_packet()) % 4)) % 4
             if pad != 0:
@@ -1163,10 +1324,30 @@ class DCERPC_v5(DCERPC):
             rpc_packet['auth_data'] = str(signature)
 
             self.__sequence += 1
-
-        self._transport.send(rpc_packet.get_packet(), forceWriteAndx = forceWriteAndx, forceRecv = forceRecv)
+            if record is not None:
+                record.securityTime += time.time() - start
+
+        parts = rpc_packet.get_packet_parts()
+        if record is None:
+            self._transport.send_buffers(parts, forceWriteAndx = forceWriteAndx, forceRecv = forceRecv)
+            return
+
+        size = sum([len(part) for part in parts])
+        sending = time.time()
+        self._transport.send_buffers(parts, forceWriteAndx = forceWriteAndx, forceRecv = forceRecv)
+        elapsed = time.time() - sending
+        record.sendTime += elapsed
+        record.requestBytes += size
+        record.requestFragments += 1
+        self.__instrumentation.transport(self._transport.__class__.__name__, 'send', elapsed, size)
 
     def send(self, data):
+        # Answers still due to submit()ted calls come before this one's
+        while self.__pending:
+            self._recvPending()
+        self.__send(data)
+
+    def __send(self, data):
         if isinstance(data, MSRPCHeader) is not True:
             # Must be an Impacket, transform to structure
             data = DCERPC_RawCall(data.OP_NUM, data.get_packet())
@@ -1174,6 +1355,9 @@ class DCERPC_v5(DCERPC):
         data['ctx_id'] = self._ctx
         data['call_id'] = self.__callid
 
+        if self.__instrumentation is not None:
+            self.__records[self.__callid] = CallRecord(interfaceName(self.__interface), data['op_num'], self._transport.__class__.__name__)
+
         max_frag = self._max_frag
         if len(data['pduData']) > self.__max_xmit_size - 32:
             max_frag = self.__max_xmit_size - 32    # XXX: 32 is a safe margin for auth data
@@ -1186,7 +1370,8 @@ class DCERPC_v5(DCERPC):
             rawcall = DCERPC_RawCall(data['op_num'])
 
             while 1:
-                toSend = packet[offset:offset+max_frag]
+                # A view on the fragment's data, not a copy of it
+                toSend = buffer(packet, offset, max_frag)
                 if not toSend:
                     break
                 flags = 0
@@ -1197,41 +1382,170 @@ class DCERPC_v5(DCERPC):
                     flags |= MSRPC_LASTFRAG
                 data['flags'] = flags
                 data['pduData'] = toSend
-                self._transport_send(data, forceWriteAndx = 1, forceRecv = flags & MSRPC_LASTFRAG)
+                self.__transportSend(data, forceWriteAndx = 1, forceRecv = flags & MSRPC_LASTFRAG)
         else:
-            self._transport_send(data)
+            self.__transportSend(data)
         self.__callid += 1
 
-    def recv(self):
-        finished = False
-        forceRecv = 0
-        retAnswer = ''
-        while not finished:
-            # At least give me the MSRPCRespHeader, especially important for 
-            # TCP/UDP Transports
+    def __transportSend(self, data, forceWriteAndx = 0, forceRecv = 0):
+        try:
+            self._transport_send(data, forceWriteAndx = forceWriteAndx, forceRecv = forceRecv)
+        except:
+            if self.__records.has_key(data['call_id']):
+                self.__finishRecord(data['call_id'], True)
+            raise
+
+    def __recvPDU(self, forceRecv):
+        if self.__instrumentation is not None:
+            start = time.time()
+        # At least give me the MSRPCRespHeader, especially important for 
+        # TCP/UDP Transports
+        try:
             self.response_data = self._transport.recv(forceRecv, count=MSRPCRespHeader._SIZE)
             self.response_header = MSRPCRespHeader(self.response_data)
             # Ok, there might be situation, especially with large packets, that 
             # the transport layer didn't send us the full packet's contents
             # So we gotta check we received it all
-            while ( len(self.response_data) < self.response_header['frag_len'] ):
-               self.response_data += self._transport.recv(forceRecv, count=(self.response_header['frag_len']-len(self.response_data)))
-
-            off = self.response_header.get_header_size()
+            self.response_data = _recvFragment(self.response_data, self.response_header['frag_len'],
+                                               lambda count: self._transport.recv(forceRecv, count=count))
+        except:
+            # Whatever was waiting for an answer won't get it
+            for callId in self.__records.keys():
+                self.__finishRecord(callId, True)
+            raise
+
+        if self.__instrumentation is not None:
+            elapsed = time.time() - start
+            self.__instrumentation.transport(self._transport.__class__.__name__, 'recv', elapsed, len(self.response_data))
+            record = self.__records.get(self.response_header['call_id'])
+            if record is not None:
+                record.recvTime += elapsed
+                record.responseBytes += len(self.response_data)
+                record.responseFragments += 1
+
+    def __finishRecord(self, callId, error):
+        record = self.__records.pop(callId)
+        record.finish(error)
+        self.__instrumentation.call(record)
+
+    def __fault(self):
+        # The exception a fault PDU stands for, None if it isn't one
+        off = self.response_header.get_header_size()
+        if self.response_header['type'] != MSRPC_FAULT or self.response_header['frag_len'] < off+4:
+            return None
+        status_code = unpack("<L",self.response_data[off:off+4])[0]
+        if rpc_status_codes.has_key(status_code):
+            return Exception(rpc_status_codes[status_code])
+        elif rpc_status_codes.has_key(status_code & 0xffff):
+            return Exception(rpc_status_codes[status_code & 0xffff])
+        else:
+            if hresult_errors.ERROR_MESSAGES.has_key(status_code):
+                error_msg_short = hresult_errors.ERROR_MESSAGES[status_code][0]
+                error_msg_verbose = hresult_errors.ERROR_MESSAGES[status_code][1] 
+                return Exception('%s - %s' % (error_msg_short, error_msg_verbose))
+            else:
+                return Exception('Unknown DCE RPC fault status code: %.8x' % status_code)
+
+    def __stubData(self):
+        # The PDU's stub data, verified and unsealed
+        answer = self.response_data[self.response_header.get_header_size():]
+        auth_len = self.response_header['auth_len']
+        if auth_len and self.__records.has_key(self.response_header['call_id']):
+            start = time.time()
+            answer = self.__verify(answer, auth_len)
+            self.__records[self.response_header['call_id']].securityTime += time.time() - start
+            return answer
+        return self.__verify(answer, auth_len)
+
+    def __verify(self, answer, auth_len):
+        if auth_len:
+            auth_len += 8
+            auth_data = answer[-auth_len:]
+            sec_trailer = SEC_TRAILER(data = auth_data)
+            answer = answer[:-auth_len]
+
+            if sec_trailer['auth_level'] == RPC_C_AUTHN_LEVEL_PKT_PRIVACY:
+                if self.__auth_type == RPC_C_AUTHN_WINNT:
+                    if self.__flags & ntlm.NTLMSSP_NTLM2_KEY:
+                        # TODO: FIX THIS, it's not calculating the signature well
+                        # Since I'm not testing it we don't care... yet
+                        answer, signature =  ntlm.SEAL(self.__flags, 
+                                self.__serverSigningKey, 
+                                self.__serverSealingKey,  
+                                answer, 
+                                answer, 
+                                self.__sequence, 
+                                self.__serverSealingHandle)
+                    else:
+                        answer, signature = ntlm.SEAL(self.__flags, 
+                                self.__serverSigningKey, 
+                                self.__serverSealingKey, 
+                                answer, 
+                                answer, 
+                                self.__sequence, 
+                                self.__serverSealingHandle)
+                        self.__sequence += 1
+                elif self.__auth_type == RPC_C_AUTHN_NETLOGON:
+                    from impacket.dcerpc.v5 import nrpc
+                    answer, cfounder = nrpc.UNSEAL(answer, 
+                           auth_data[len(sec_trailer):],
+                           self.__sessionKey, 
+                           False)
+                    self.__sequence += 1
+                elif self.__auth_type == RPC_C_AUTHN_GSS_NEGOTIATE:
+                    if self.__sequence > 0:
+                        answer, cfounder = self.__gss.GSS_Unwrap(self.__sessionKey, answer, self.__sequence, direction='init', authData=auth_data)
 
-            if self.response_header['type'] == MSRPC_FAULT and self.response_header['frag_len'] >= off+4:
-                status_code = unpack("<L",self.response_data[off:off+4])[0]
-                if rpc_status_codes.has_key(status_code):
-                    raise Exception(rpc_status_codes[status_code])
-                elif rpc_status_codes.has_key(status_code & 0xffff):
-                    raise Exception(rpc_status_codes[status_code & 0xffff])
-                else:
-                    if hresult_errors.ERROR_MESSAGES.has_key(status_code):
-                        error_msg_short = hresult_errors.ERROR_MESSAGES[status_code][0]
-                        error_msg_verbose = hresult_errors.ERROR_MESSAGES[status_code][1] 
-                        raise Exception('%s - %s' % (error_msg_short, error_msg_verbose))
+            elif sec_trailer['auth_level'] == RPC_C_AUTHN_LEVEL_PKT_INTEGRITY:
+                if self.__auth_type == RPC_C_AUTHN_WINNT:
+                    ntlmssp = auth_data[12:]
+                    if self.__flags & ntlm.NTLMSSP_NTLM2_KEY:
+                        signature =  ntlm.SIGN(self.__flags, 
+                                self.__serverSigningKey, 
+                                answer, 
+                                self.__sequence, 
+                                self.__serverSealingHandle)
                     else:
-                        raise Exception('Unknown DCE RPC fault status code: %.8x' % status_code)
+                        signature = ntlm.SIGN(self.__flags, 
+                                self.__serverSigningKey, 
+                                ntlmssp, 
+                                self.__sequence, 
+                                self.__serverSealingHandle)
+                        # Yes.. NTLM2 doesn't increment sequence when receiving
+                        # the packet :P
+                        self.__sequence += 1
+                elif self.__auth_type == RPC_C_AUTHN_NETLOGON:
+                    from impacket.dcerpc.v5 import nrpc
+                    ntlmssp = auth_data[12:]
+                    signature = nrpc.SIGN(ntlmssp, 
+                           self.__confounder, 
+                           self.__sequence, 
+                           self.__sessionKey, 
+                           False)
+                    self.__sequence += 1
+                elif self.__auth_type == RPC_C_AUTHN_GSS_NEGOTIATE:
+                    # Do NOT increment the sequence number when Signing Kerberos
+                    #self.__sequence += 1
+                    pass
+
+            
+            if sec_trailer['auth_pad_len']:
+                answer = answer[:-sec_trailer['auth_pad_len']]
+
+        return answer
+
+    def recv(self):
+        finished = False
+        forceRecv = 0
+        # Fragments are put together once all of them are in
+        fragments = []
+        while not finished:
+            self.__recvPDU(forceRecv)
+            fault = self.__fault()
+            if fault is not None:
+                if self.__records.has_key(self.response_header['call_id']):
+                    self.__finishRecord(self.response_header['call_id'], True)
+                raise fault
 
             if self.response_header['flags'] & MSRPC_LASTFRAG:
                 # No need to reassembly DCERPC
@@ -1240,84 +1554,105 @@ class DCERPC_v5(DCERPC):
                 # Forcing Read Recv, we need more packets!
                 forceRecv = 1
 
-            answer = self.response_data[off:]
-            auth_len = self.response_header['auth_len']
-            if auth_len:
-                auth_len += 8
-                auth_data = answer[-auth_len:]
-                sec_trailer = SEC_TRAILER(data = auth_data)
-                answer = answer[:-auth_len]
-
-                if sec_trailer['auth_level'] == RPC_C_AUTHN_LEVEL_PKT_PRIVACY:
-                    if self.__auth_type == RPC_C_AUTHN_WINNT:
-                        if self.__flags & ntlm.NTLMSSP_NTLM2_KEY:
-                            # TODO: FIX THIS, it's not calculating the signature well
-                            # Since I'm not testing it we don't care... yet
-                            answer, signature =  ntlm.SEAL(self.__flags, 
-                                    self.__serverSigningKey, 
-                                    self.__serverSealingKey,  
-                                    answer, 
-                                    answer, 
-                                    self.__sequence, 
-                                    self.__serverSealingHandle)
-                        else:
-                            answer, signature = ntlm.SEAL(self.__flags, 
-                                    self.__serverSigningKey, 
-                                    self.__serverSealingKey, 
-                                    answer, 
-                                    answer, 
-                                    self.__sequence, 
-                                    self.__serverSealingHandle)
-                            self.__sequence += 1
-                    elif self.__auth_type == RPC_C_AUTHN_NETLOGON:
-                        from impacket.dcerpc.v5 import nrpc
-                        answer, cfounder = nrpc.UNSEAL(answer, 
-                               auth_data[len(sec_trailer):],
-                               self.__sessionKey, 
-                               False)
-                        self.__sequence += 1
-                    elif self.__auth_type == RPC_C_AUTHN_GSS_NEGOTIATE:
-                        if self.__sequence > 0:
-                            answer, cfounder = self.__gss.GSS_Unwrap(self.__sessionKey, answer, self.__sequence, direction='init', authData=auth_data)
-
-                elif sec_trailer['auth_level'] == RPC_C_AUTHN_LEVEL_PKT_INTEGRITY:
-                    if self.__auth_type == RPC_C_AUTHN_WINNT:
-                        ntlmssp = auth_data[12:]
-                        if self.__flags & ntlm.NTLMSSP_NTLM2_KEY:
-                            signature =  ntlm.SIGN(self.__flags, 
-                                    self.__serverSigningKey, 
-                                    answer, 
-                                    self.__sequence, 
-                                    self.__serverSealingHandle)
-                        else:
-                            signature = ntlm.SIGN(self.__flags, 
-                                    self.__serverSigningKey, 
-                                    ntlmssp, 
-                                    self.__sequence, 
-                                    self.__serverSealingHandle)
-                            # Yes.. NTLM2 doesn't increment sequence when receiving
-                            # the packet :P
-                            self.__sequence += 1
-                    elif self.__auth_type == RPC_C_AUTHN_NETLOGON:
-                        from impacket.dcerpc.v5 import nrpc
-                        ntlmssp = auth_data[12:]
-                        signature = nrpc.SIGN(ntlmssp, 
-                               self.__confounder, 
-                               self.__sequence, 
-                               self.__sessionKey, 
-                               False)
-                        self.__sequence += 1
-                    elif self.__auth_type == RPC_C_AUTHN_GSS_NEGOTIATE:
-                        # Do NOT increment the sequence number when Signing Kerberos
-                        #self.__sequence += 1
-                        pass
-
-                
-                if sec_trailer['auth_pad_len']:
-                    answer = answer[:-sec_trailer['auth_pad_len']]
-              
-            retAnswer += answer
-        return retAnswer
+            fragments.append(self.__stubData())
+        if self.__records.has_key(self.response_header['call_id']):
+            self.__finishRecord(self.response_header['call_id'], False)
+        return ''.join(fragments)
+
+    def _canPipeline(self):
+        # NTLM without NTLM2 session security and Netlogon use the same
+        # sequence number for requests and answers, so their calls can't
+        # overlap
+        if self.__auth_level not in [RPC_C_AUTHN_LEVEL_PKT_INTEGRITY, RPC_C_AUTHN_LEVEL_PKT_PRIVACY]:
+            return True
+        if self.__auth_type == RPC_C_AUTHN_GSS_NEGOTIATE:
+            return True
+        if self.__auth_type == RPC_C_AUTHN_WINNT:
+            return self.__flags & ntlm.NTLMSSP_NTLM2_KEY != 0
+        return False
+
+    def submit(self, request, uuid=None, checkError=True):
+        """
+        sends a request without waiting for its answer
+
+        :param NDRCALL request: the request to send
+        :param string uuid: the object UUID, if any
+        :param boolean checkError: whether result() raises on an error status, as request() does
+
+        :return: a DCERPCCall, whose result() is the answer to the request
+        """
+        if self._canPipeline():
+            maxPending = self.__max_pending
+        else:
+            maxPending = 1
+        while len(self.__pending) >= maxPending:
+            self._recvPending()
+        isNDR64 = self._setTransferSyntax(request)
+        call = DCERPCCall(self, request, self.__callid, isNDR64, checkError)
+        self.__send(DCERPC_RawCall(request.opnum, str(request), uuid))
+        self.__pending[call.callId] = call
+        return call
+
+    def collect(self, calls = None):
+        """
+        yields calls as their answers arrive
+
+        :param list calls: DCERPCCalls returned by submit(). All the pending ones if None
+        """
+        if calls is None:
+            calls = self.__pending.values()
+        waiting = list(calls)
+        while waiting:
+            remaining = []
+            for call in waiting:
+                if call.done():
+                    yield call
+                else:
+                    remaining.append(call)
+            waiting = remaining
+            if waiting:
+                self._recvPending()
+
+    def batch(self, requests, uuid=None, checkError=True):
+        """
+        sends many requests, keeping up to get_max_pending() of them waiting
+        for their answer at any time
+
+        :param list requests: the requests to send
+        :param string uuid: the object UUID, if any
+        :param boolean checkError: whether result() raises on an error status, as request() does
+
+        :return: the DCERPCCalls for the requests, in the same order, all of them answered
+        """
+        calls = [self.submit(request, uuid, checkError) for request in requests]
+        for call in self.collect(calls):
+            pass
+        return calls
+
+    def _recvPending(self):
+        # Reads a PDU and hands it to the submit()ted call it answers
+        self.__recvPDU(0)
+        callId = self.response_header['call_id']
+        if self.__pending.has_key(callId) is False:
+            raise Exception('Unexpected answer for call_id %d' % callId)
+        call = self.__pending[callId]
+        fault = self.__fault()
+        if fault is not None:
+            del(self.__pending[callId])
+            if self.__records.has_key(callId):
+                self.__finishRecord(callId, True)
+            call._setError(fault)
+            return
+        lastFragment = self.response_header['flags'] & MSRPC_LASTFRAG
+        call._addFragment(self.__stubData(), lastFragment)
+        if lastFragment:
+            del(self.__pending[callId])
+            if self.__records.has_key(callId):
+                self.__finishRecord(callId, False)
+
+    def _nextContext(self):
+        # Next to the last context offered or bound here, for an alter_ctx to offer
+        return max([self._ctx] + [ctxId for ctxId, abstractSyntax in self.__offered] + [ctxId for ctxId, syntax in self.__contexts.values()])+1
 
     def alter_ctx(self, newUID, bogus_binds = 0):
         answer = self.__class__(self._transport)
@@ -1326,11 +1661,60 @@ class DCERPC_v5(DCERPC):
         answer.set_auth_type(self.__auth_type)
         answer.set_auth_level(self.__auth_level)
 
-        answer.set_ctx_id(self._ctx+1)
+        answer.set_ctx_id(self._nextContext())
         answer.__callid = self.__callid
+        answer.set_max_rfrag(self.__max_recv_size)
+        answer.set_instrumentation(self.__instrumentation)
         answer.bind(newUID, alter = 1, bogus_binds = bogus_binds, transfer_syntax = bin_to_uuidtup(self.transfer_syntax))
         return answer
 
+class DCERPCCall:
+    """
+    A request sent with DCERPC_v5.submit(). Answers are read off the association
+    when someone waits for them, so waiting for a call might get others answered
+    as well
+    """
+    def __init__(self, dce, request, callId, isNDR64, checkError):
+        self.request = request
+        self.callId = callId
+        self.__dce = dce
+        self.__isNDR64 = isNDR64
+        self.__checkError = checkError
+        self.__fragments = []
+        self.__answer = None
+        self.__response = None
+        self.__error = None
+
+    def done(self):
+        return self.__answer is not None or self.__error is not None
+
+    def _addFragment(self, data, lastFragment):
+        self.__fragments.append(data)
+        if lastFragment:
+            self.__answer = ''.join(self.__fragments)
+            self.__fragments = []
+
+    def _setError(self, error):
+        self.__error = error
+
+    def result(self):
+        """
+        waits for the answer to the request
+
+        :return: the response, as request() would return it. Raises what request() would have raised
+        """
+        while not self.done():
+            self.__dce._recvPending()
+        if self.__error is not None:
+            raise self.__error
+        if self.__response is None:
+            try:
+                self.__response = self.__dce._response(self.request, self.__answer, self.__isNDR64, self.__checkError)
+            except Exception, e:
+                self.__error = e
+                raise
+        return self.__response
+
 class DCERPC_RawCall(MSRPCRequestHeader):
     def __init__(self, op_num, data = '', uuid=None):
         MSRPCRequestHeader.__init__(self)
@@ -1378,26 +1762,136 @@ class TypeSerialization1(NDRSTRUCT):
         self['PrivateHeader']['ObjectBufferLength'] = len(NDRSTRUCT.getData(self, soFar))+len(NDRSTRUCT.getDataReferents(self, soFar))-len(self['CommonHeader'])-len(self['PrivateHeader'])
         return NDRSTRUCT.getData(self, soFar)
 
+def _socketPair():
+    # socket.socketpair() is not there on Windows
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    writer = socket.socket()
+    writer.connect(listener.getsockname())
+    reader, address = listener.accept()
+    listener.close()
+    return reader, writer
+
+class DCERPCServerAssociation:
+    """
+    A client of DCERPCServer: its presentation contexts and the requests
+    it's still sending fragments of
+    """
+    def __init__(self, sock, maxXmitSize):
+        # None for in-process pipes
+        self.sock = sock
+        self.inBuffer = bytearray()
+        self.outBuffer = bytearray()
+        self.boundUUID = ''
+        # Interface bound in each presentation context
+        self.boundContexts = {}
+        # Stub data received so far of each fragmented request, by call_id
+        self.fragments = {}
+        self.maxXmitSize = maxXmitSize
+        self.closed = False
+
+    def getPDU(self):
+        # The next full PDU received, if any
+        if len(self.inBuffer) < MSRPCHeader._SIZE:
+            return None
+        fragLen = unpack('<H', str(self.inBuffer[8:10]))[0]
+        if fragLen < MSRPCHeader._SIZE:
+            raise Exception('Bogus frag_len %d' % fragLen)
+        if len(self.inBuffer) < fragLen:
+            return None
+        data = str(self.inBuffer[:fragLen])
+        del(self.inBuffer[:fragLen])
+        return data
+
+class DCERPCServerPipe:
+    """
+    A named pipe into a DCERPCServer, as DCERPCServer.openPipe() returns it.
+    What's written to it gets answered during send(), in the caller's thread.
+    It has the socket methods smbserver uses on pipes: send, recv and close
+    """
+    def __init__(self, server):
+        self.__server = server
+        self.__association = DCERPCServerAssociation(None, server._max_xmit_size)
+        # Octets of the answer PDU being read still in outBuffer
+        self.__pduLeft = 0
+
+    def send(self, data):
+        association = self.__association
+        association.inBuffer += data
+        while association.closed is False:
+            pdu = association.getPDU()
+            if pdu is None:
+                break
+            self.__server._dispatchInline(association, pdu)
+        return len(data)
+
+    def recv(self, count):
+        """
+        :return: up to count octets of the next answer PDU, '' if there's none. As with
+         message mode pipes, a read doesn't go past the end of the PDU it started in
+        """
+        outBuffer = self.__association.outBuffer
+        if self.__pduLeft == 0 and len(outBuffer) >= MSRPCHeader._SIZE:
+            self.__pduLeft = unpack('<H', str(outBuffer[8:10]))[0]
+        data = str(outBuffer[:min(count, self.__pduLeft)])
+        del(outBuffer[:len(data)])
+        self.__pduLeft -= len(data)
+        return data
+
+    def close(self):
+        self.__association.closed = True
+        self.__association.fragments = {}
+        self.__association.outBuffer = bytearray()
+        self.__pduLeft = 0
+
 class DCERPCServer(Thread):
     """
     A minimalistic DCERPC Server, mainly used by the smbserver, for now. Might be useful
     for other purposes in the future, but we should do it way stronger.
     If you want to implement a DCE Interface Server, use this class as the base class
+
+    It serves any number of clients at once out of a single thread, while the
+    callbacks run in a pool of worker threads (see setWorkers()).
+
+    Subclasses written for the one client at a time server: bind() and
+    processRequest() take the client's DCERPCServerAssociation, and return
+    their answer instead of sending it. Called without one, they use a
+    default association, which _boundUUID reads from. processRequest() still
+    takes the raw PDU as a string. send(), recv() and _clientSock are gone,
+    the run() loop does the socket I/O.
     """
     def __init__(self):
         Thread.__init__(self)
         self._listenPort    = 0
         self._listenAddress = '127.0.0.1'
         self._listenUUIDS   = {}
-        self._boundUUID     = ''
         self._sock          = None
-        self._clientSock    = None
-        self._callid        = 1
         self._max_frag       = None
         self._max_xmit_size = 4280
+        self._workers       = 4
         self.__log = logging.getLogger()
-        self._sock = socket.socket()
-        self._sock.bind((self._listenAddress,self._listenPort))
+        # fileno -> DCERPCServerAssociation
+        self.__associations = {}
+        # (association, request) for the workers
+        self.__requests = Queue.Queue()
+        # (association, response) from the workers
+        self.__responses = Queue.Queue()
+        # Workers write to the second one to wake the server thread up
+        self.__wakeUp = None
+        # Only where select.poll() is there, select() is used otherwise
+        self.__poller = None
+        # filenos with something left in their outBuffer
+        self.__writers = set()
+        # For bind() and processRequest() called without an association
+        self.__defaultAssociation = DCERPCServerAssociation(None, self._max_xmit_size)
+
+    @property
+    def _boundUUID(self):
+        # The last interface bound through the default association
+        return self.__defaultAssociation.boundUUID
 
     def log(self, msg, level=logging.INFO):
         self.__log.log(level,msg)
@@ -1417,100 +1911,287 @@ class DCERPCServer(Thread):
 
     def setListenPort(self, portNum):
         self._listenPort = portNum
-        self._sock = socket.socket()
-        self._sock.bind((self._listenAddress,self._listenPort))
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self.__bind()
 
     def getListenPort(self):
+        self.__bind()
         return self._sock.getsockname()[1]
 
-    def recv(self):
-        finished = False
-        forceRecv = 0
-        retAnswer = ''
-        while not finished:
-            # At least give me the MSRPCRespHeader, especially important for TCP/UDP Transports
-            self.response_data = self._clientSock.recv(MSRPCRespHeader._SIZE)
-            # No data?, connection might have closed
-            if self.response_data == '':
-                return None
-            self.response_header = MSRPCRespHeader(self.response_data)
-            # Ok, there might be situation, especially with large packets, 
-            # that the transport layer didn't send us the full packet's contents
-            # So we gotta check we received it all
-            while ( len(self.response_data) < self.response_header['frag_len'] ):
-               self.response_data += self._clientSock.recv(self.response_header['frag_len']-len(self.response_data))
-            self.response_header = MSRPCRespHeader(self.response_data)
-            if self.response_header['flags'] & MSRPC_LASTFRAG:
-                # No need to reassembly DCERPC
-                finished = True
-            else:
-                # Forcing Read Recv, we need more packets!
-                forceRecv = 1
-            answer = self.response_header['pduData']
-            auth_len = self.response_header['auth_len']
-            if auth_len:
-                auth_len += 8
-                auth_data = answer[-auth_len:]
-                sec_trailer = SEC_TRAILER(data = auth_data)
-                answer = answer[:-auth_len]
-                if sec_trailer['auth_pad_len']:
-                    answer = answer[:-sec_trailer['auth_pad_len']]
-              
-            retAnswer += answer
-        return self.response_data
-    
+    def __bind(self):
+        # Only once it's going to listen, served through openPipe() it never does
+        if self._sock is None:
+            self._sock = socket.socket()
+            self._sock.bind((self._listenAddress,self._listenPort))
+
+    def openPipe(self):
+        """
+        opens a named pipe to this server from the same process, no socket
+        involved. It works without start()ing the server
+
+        :return: a DCERPCServerPipe, e.g. for SMBSERVER.registerNamedPipe()
+        """
+        return DCERPCServerPipe(self)
+
+    def setWorkers(self, workers):
+        """
+        sets how many threads run the callbacks. Call it before start()
+
+        :param integer workers: number of threads. 0 runs the callbacks in the server thread itself, one at a time
+        """
+        self._workers = workers
+
     def run(self):
-        self._sock.listen(10)
+        self.__bind()
+        self._sock.listen(128)
+        self._sock.setblocking(0)
+        self.__wakeUp = _socketPair()
+        self.__wakeUp[0].setblocking(0)
+        self.__wakeUp[1].setblocking(0)
+        for i in range(self._workers):
+            worker = Thread(target = self.__work)
+            worker.daemon = True
+            worker.start()
+        if hasattr(select, 'poll'):
+            self.__poller = select.poll()
+            self.__poller.register(self._sock.fileno(), select.POLLIN)
+            self.__poller.register(self.__wakeUp[0].fileno(), select.POLLIN)
         while True:
-            self._clientSock, address = self._sock.accept()
-            try:
-                while True:
-                    data = self.recv()
-                    if data is None:
-                        # No data.. connection closed
-                        break
-                    answer = self.processRequest(data)
-                    if answer != None:
-                        self.send(answer)
-            except Exception, e:
-                import traceback
-                print traceback.print_exc()
-                pass
-            self._clientSock.close()
+            self.__poll()
 
-    def send(self, data):
-        max_frag       = self._max_frag
-        if len(data['pduData']) > self._max_xmit_size - 32:
-            max_frag   = self._max_xmit_size - 32    # XXX: 32 is a safe margin for auth data
+    def __poll(self):
+        if self.__poller is not None:
+            # select() can't take descriptors past FD_SETSIZE
+            try:
+                events = self.__poller.poll()
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    return
+                raise
+            readable = [fd for fd, event in events if event & (select.POLLIN | select.POLLERR | select.POLLHUP)]
+            writable = [fd for fd, event in events if event & (select.POLLOUT | select.POLLERR | select.POLLHUP)]
+        else:
+            readers = [self._sock.fileno(), self.__wakeUp[0].fileno()] + self.__associations.keys()
+            try:
+                readable, writable, dummy = select.select(readers, list(self.__writers), [])
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    return
+                raise
+
+        for fd in writable:
+            if self.__associations.has_key(fd):
+                self.__write(self.__associations[fd])
+        for fd in readable:
+            if fd == self._sock.fileno():
+                self.__accept()
+            elif fd == self.__wakeUp[0].fileno():
+                self.__collect()
+            elif self.__associations.has_key(fd):
+                self.__read(self.__associations[fd])
+
+    def __watch(self, fd, writing):
+        # Waits for fd to be writable as well as readable, or not anymore
+        if writing is (fd in self.__writers):
+            return
+        if writing is True:
+            self.__writers.add(fd)
+        else:
+            self.__writers.discard(fd)
+        if self.__poller is not None:
+            if writing is True:
+                self.__poller.modify(fd, select.POLLIN | select.POLLOUT)
+            else:
+                self.__poller.modify(fd, select.POLLIN)
 
-        if self._max_frag:
-            max_frag   = min(max_frag, self._max_frag)
-        if max_frag and len(data['pduData']) > 0:
-            packet     = data['pduData']
-            offset     = 0
-            while 1:
-                toSend = packet[offset:offset+max_frag]
-                if not toSend:
+    def __accept(self):
+        while True:
+            try:
+                clientSock, address = self._sock.accept()
+            except socket.error, e:
+                if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                self.log('accept: %s' % e, logging.ERROR)
+                return
+            clientSock.setblocking(0)
+            self.__associations[clientSock.fileno()] = DCERPCServerAssociation(clientSock, self._max_xmit_size)
+            if self.__poller is not None:
+                self.__poller.register(clientSock.fileno(), select.POLLIN)
+            self.log('Connection from %s:%d' % address, logging.DEBUG)
+
+    def __read(self, association):
+        try:
+            data = association.sock.recv(65536)
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if data == '':
+            self.__close(association)
+            return
+        association.inBuffer += data
+        try:
+            while association.closed is False:
+                pdu = association.getPDU()
+                if pdu is None:
                     break
-                flags  = 0
-                if offset == 0:
-                    flags |= MSRPC_FIRSTFRAG
-                offset += len(toSend)
-                if offset == len(packet):
-                    flags |= MSRPC_LASTFRAG
-                data['flags']   = flags
-                data['pduData'] = toSend
-                self._clientSock.send(data.get_packet())
+                self.__dispatch(association, pdu)
+        except:
+            # Not just rpcrt's Exception, anything a bogus PDU could raise
+            self.log('Dropping connection: %s' % sys.exc_info()[1], logging.ERROR)
+            self.__close(association)
+
+    def __write(self, association):
+        while len(association.outBuffer) > 0:
+            try:
+                sent = association.sock.send(association.outBuffer)
+            except socket.error, e:
+                if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # The rest goes once the client reads some
+                    self.__watch(association.sock.fileno(), True)
+                    return
+                self.__close(association)
+                return
+            del(association.outBuffer[:sent])
+        self.__watch(association.sock.fileno(), False)
+
+    def __close(self, association):
+        association.closed = True
+        association.fragments = {}
+        association.outBuffer = bytearray()
+        fd = association.sock.fileno()
+        del(self.__associations[fd])
+        self.__writers.discard(fd)
+        if self.__poller is not None:
+            self.__poller.unregister(fd)
+        association.sock.close()
+
+    def __dispatch(self, association, data):
+        packet = self._reassemble(association, data)
+        if packet is None:
+            return
+        if packet['type'] != MSRPC_REQUEST:
+            self.__answer(association, self.processRequest(packet, association))
+        elif self._workers == 0:
+            self.__answer(association, self.__process(packet, association))
+        else:
+            self.__requests.put((association, packet))
+
+    def _dispatchInline(self, association, data):
+        # As __dispatch(), but answering requests right away in the caller's thread
+        packet = self._reassemble(association, data)
+        if packet is None:
+            return
+        if packet['type'] != MSRPC_REQUEST:
+            self.__answer(association, self.processRequest(packet, association))
         else:
-            self._clientSock.send(data.get_packet())
-        self._callid += 1
+            self.__answer(association, self.__process(packet, association))
+
+    def _reassemble(self, association, data):
+        # The PDU to answer data with. For requests, None until their last fragment is in
+        packet = MSRPCHeader(data)
+        if packet['type'] != MSRPC_REQUEST:
+            return packet
+
+        request = MSRPCRequestHeader(data)
+        stub = request['pduData']
+        if request['auth_len'] > 0:
+            # We don't do auth, just get rid of the trailer
+            sec_trailer = SEC_TRAILER(data = stub[-(request['auth_len']+8):])
+            stub = stub[:-(request['auth_len']+8+sec_trailer['auth_pad_len'])]
+        if request['flags'] & MSRPC_FIRSTFRAG:
+            association.fragments[request['call_id']] = []
+        association.fragments.setdefault(request['call_id'], []).append(stub)
+        if request['flags'] & MSRPC_LASTFRAG == 0:
+            return None
+        request['pduData'] = ''.join(association.fragments.pop(request['call_id']))
+        request['auth_len'] = 0
+        request['auth_data'] = ''
+        request['sec_trailer'] = ''
+        return request
+
+    def __process(self, request, association):
+        try:
+            return self.processRequest(request, association)
+        except:
+            # A callback failing is the client's problem only
+            self.log('processRequest: %s' % traceback.format_exc(), logging.ERROR)
+            return self._fault(request, 0x1C000012L, request['ctx_id'])
 
-    def bind(self,packet, bind):
+    def __work(self):
+        while True:
+            association, request = self.__requests.get()
+            self.__responses.put((association, self.__process(request, association)))
+            try:
+                self.__wakeUp[1].send('\x00')
+            except socket.error:
+                # Full of wake ups already
+                pass
+
+    def __collect(self):
+        try:
+            while self.__wakeUp[0].recv(4096) != '':
+                pass
+        except socket.error:
+            pass
+        while True:
+            try:
+                association, response = self.__responses.get_nowait()
+            except Queue.Empty:
+                return
+            self.__answer(association, response)
+
+    def __answer(self, association, response):
+        if response is None or association.closed is True:
+            return
+        for packet in self._fragment(association, response):
+            association.outBuffer += packet
+        if association.sock is not None:
+            self.__write(association)
+
+    def _fragment(self, association, response):
+        # The packets to send response in, as long as the client can take them
+        if response['type'] != MSRPC_RESPONSE:
+            return [response.get_packet()]
+        data = response['pduData']
+        maxFrag = (association.maxXmitSize - MSRPCRespHeader._SIZE) & ~7
+        if self._max_frag:
+            maxFrag = min(maxFrag, self._max_frag)
+        if len(data) <= maxFrag:
+            return [response.get_packet()]
+        packets = []
+        for offset in range(0, len(data), maxFrag):
+            flags = 0
+            if offset == 0:
+                flags |= MSRPC_FIRSTFRAG
+            if offset + maxFrag >= len(data):
+                flags |= MSRPC_LASTFRAG
+            response['flags'] = flags
+            response['alloc_hint'] = len(data) - offset
+            response['pduData'] = data[offset:offset+maxFrag]
+            packets.append(response.get_packet())
+        return packets
+
+    def _fault(self, packet, status, ctxId = 0):
+        fault = MSRPCRespHeader()
+        fault['type']    = MSRPC_FAULT
+        fault['call_id'] = packet['call_id']
+        fault['ctx_id']  = ctxId
+        fault['pduData'] = pack('<L', status)
+        return fault
+
+    def bind(self, packet, bind, association = None):
+        if association is None:
+            association = self.__defaultAssociation
         # Standard NDR Representation
         NDRSyntax   = ('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0')
         resp = MSRPCBindAck()
 
         resp['type']             = MSRPC_BINDACK
+        if packet['type'] == MSRPC_ALTERCTX:
+            resp['type']         = MSRPC_ALTERCTX_R
         resp['flags']            = packet['flags']
         resp['frag_len']         = 0
         resp['auth_len']         = 0
@@ -1520,6 +2201,12 @@ class DCERPCServer(Thread):
         resp['max_rfrag']        = bind['max_rfrag']
         resp['assoc_group']      = 0x1234
         resp['ctx_num']          = 0
+        # Unless some context gets accepted
+        resp['SecondaryAddr']    = ''
+        resp['SecondaryAddrLen'] = 1
+
+        # Don't send fragments larger than the client can take
+        association.maxXmitSize = bind['max_rfrag']
 
         data      = bind['ctx_items']
         ctx_items = ''
@@ -1538,7 +2225,8 @@ class DCERPCServer(Thread):
                         resp['SecondaryAddr']    = self._listenUUIDS[item['AbstractSyntax']]['SecondaryAddr']
                         resp['SecondaryAddrLen'] = len(resp['SecondaryAddr'])+1
                         reason           = 0
-                        self._boundUUID = i
+                        association.boundUUID = i
+                        association.boundContexts[item['ContextID']] = i
             else:
                 # Fail the bind request for this context
                 reason = 2 # Transfer Syntax not supported
@@ -1555,32 +2243,45 @@ class DCERPCServer(Thread):
         resp['ctx_items'] = ctx_items
         resp['frag_len']  = len(str(resp))
 
-        self._clientSock.send(str(resp)) 
-        return None
+        return resp
 
-    def processRequest(self,data):
-        packet = MSRPCHeader(data)
-        if packet['type'] == MSRPC_BIND:
+    def processRequest(self, packet, association = None):
+        """
+        answers a PDU. Runs in a worker thread for requests, in the server's for anything else
+
+        :param MSRPCHeader packet: the PDU. For requests, a MSRPCRequestHeader with the whole stub, even if it came in fragments. A string is taken as the PDU itself
+        :param DCERPCServerAssociation association: the client that sent it. None for the default association (see the class docstring)
+
+        :return: the answer, None if there's nothing to answer
+        """
+        if association is None:
+            association = self.__defaultAssociation
+        if isinstance(packet, str):
+            data = packet
+            packet = MSRPCHeader(data)
+            if packet['type'] == MSRPC_REQUEST:
+                packet = MSRPCRequestHeader(data)
+        if packet['type'] == MSRPC_BIND or packet['type'] == MSRPC_ALTERCTX:
             bind   = MSRPCBind(packet['pduData'])
-            packet = self.bind(packet, bind)
+            return self.bind(packet, bind, association)
         elif packet['type'] == MSRPC_REQUEST:
-            request          = MSRPCRequestHeader(data)
-            response         = MSRPCRespHeader(data)
-            response['type'] = MSRPC_RESPONSE
+            boundUUID = association.boundContexts.get(packet['ctx_id'], association.boundUUID)
             # Serve the opnum requested, if not, fails
-            if self._listenUUIDS[self._boundUUID]['CallBacks'].has_key(request['op_num']):
-                # Call the function 
-                returnData          = self._listenUUIDS[self._boundUUID]['CallBacks'][request['op_num']](request['pduData'])
-                response['pduData'] = returnData
-            else:
-                response['type']    = MSRPC_FAULT
-                response['pduData'] = struct.pack('<L',0x000006E4L)
-            response['frag_len'] = len(response)
+            if self._listenUUIDS.has_key(boundUUID) is False:
+                return self._fault(packet, 0x1C010003L, packet['ctx_id'])
+            if self._listenUUIDS[boundUUID]['CallBacks'].has_key(packet['op_num']) is False:
+                return self._fault(packet, 0x000006E4L, packet['ctx_id'])
+            # Call the function
+            returnData = self._listenUUIDS[boundUUID]['CallBacks'][packet['op_num']](packet['pduData'])
+            response = MSRPCRespHeader()
+            response['call_id']    = packet['call_id']
+            response['ctx_id']     = packet['ctx_id']
+            response['pduData']    = str(returnData)
+            response['alloc_hint'] = len(response['pduData'])
             return response
+        elif packet['type'] == MSRPC_AUTH3 or packet['type'] == MSRPC_ORPHANED or packet['type'] == MSRPC_CO_CANCEL:
+            # Nothing to answer to these
+            return None
         else:
             # Defaults to a fault
-            packet         = MSRPCRespHeader(data)
-            packet['type'] = MSRPC_FAULT
-
-        return packet
-
+            return self._fault(packet, 0x1C01000BL)
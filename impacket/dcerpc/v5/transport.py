@@ -135,6 +135,11 @@ class DCERPCTransport:
         raise RuntimeError, 'virtual function'
     def send(self,data=0, forceWriteAndx = 0, forceRecv = 0):
         raise RuntimeError, 'virtual function'
+    def send_buffers(self, buffers, forceWriteAndx = 0, forceRecv = 0):
+        # Sends the buffers as a single PDU. Transports that can send them
+        # without joining them first override this. Here they're joined,
+        # buffer() views are copied into strings first, join() takes nothing else
+        self.send(''.join([str(buf) for buf in buffers]), forceWriteAndx, forceRecv)
     def recv(self, forceRecv = 0, count = 0):
         raise RuntimeError, 'virtual function'
     def disconnect(self):
@@ -289,21 +294,34 @@ class TCPTransport(DCERPCTransport):
 
     def send(self,data, forceWriteAndx = 0, forceRecv = 0):
         if self._max_send_frag:
+            view = memoryview(data)
             offset = 0
-            while 1:
-                toSend = data[offset:offset+self._max_send_frag]
-                if not toSend:
-                    break
-                self.__socket.send(toSend)
-                offset += len(toSend)
+            while offset < len(data):
+                self.__socket.sendall(view[offset:offset+self._max_send_frag])
+                offset += self._max_send_frag
+        else:
+            self.__socket.sendall(data)
+
+    def send_buffers(self, buffers, forceWriteAndx = 0, forceRecv = 0):
+        if self._max_send_frag:
+            # Every buffer in pieces of _max_send_frag at most
+            for buf in buffers:
+                self.send(buf)
         else:
-            self.__socket.send(data)
+            nmb.send_buffers(self.__socket, buffers)
 
     def recv(self, forceRecv = 0, count = 0):
         if count:
-            buffer = ''
-            while len(buffer) < count:
-               buffer += self.__socket.recv(count-len(buffer))
+            # Mostly a single read. The chunks are joined once otherwise
+            chunks = []
+            received = 0
+            while received < count:
+                chunk = self.__socket.recv(count-received)
+                if chunk == '':
+                    raise Exception, "Connection closed by the remote end"
+                chunks.append(chunk)
+                received += len(chunk)
+            buffer = ''.join(chunks)
         else:
             buffer = self.__socket.recv(8192)
         return buffer
@@ -652,6 +652,25 @@ def _do_first_level_decoding(m):
     s = m.group(0)
     return chr(((ord(s[0]) - ord('A')) << 4) | (ord(s[1]) - ord('A')))
 
+# Buffers smaller than this are joined with their neighbours before sending
+SEND_COALESCE_SIZE = 16384
+
+def send_buffers(sock, buffers):
+    # Sends buffers (strings, buffers, memoryviews...) one after the other,
+    # without joining the large ones into a new string first. The small
+    # ones (headers, mostly) are joined, a send() costs more than copying them
+    pending = bytearray()
+    for data in buffers:
+        if len(data) < SEND_COALESCE_SIZE:
+            pending += data
+            continue
+        if len(pending) > 0:
+            sock.sendall(pending)
+            pending = bytearray()
+        sock.sendall(data)
+    if len(pending) > 0:
+        sock.sendall(pending)
+
 
 
 class NetBIOSSessionPacket:
@@ -821,6 +840,11 @@ class NetBIOSUDPSession(NetBIOSSession):
         p['SourceIP'] = self._sock.getsockname()[0]
         p['SourceName'] = encode_name(self.get_myname(), self.get_mytype(), '')[:-1]
         p['DestinationName'] = encode_name(self.get_remote_name(), self.get_remote_type(), '')[:-1]
+        if isinstance(data, (list, tuple)):
+            joined = bytearray()
+            for buf in data:
+                joined += buf
+            data = str(joined)
         p['Data'] = data
 
         self._sock.sendto(str(p), self.peer)
@@ -863,10 +887,12 @@ class NetBIOSTCPSession(NetBIOSSession):
         return sock
 
     def send_packet(self, data):
-        p = NetBIOSSessionPacket()
-        p.set_type(NETBIOS_SESSION_MESSAGE)
-        p.set_trailer(data)
-        self._sock.send(p.rawData())
+        # data can also be a list of buffers, sent as they are after the header
+        if isinstance(data, (list, tuple)) is False:
+            data = [data]
+        length = sum([len(buf) for buf in data])
+        header = pack('!BBH', NETBIOS_SESSION_MESSAGE, length >> 16, length & 0xFFFF)
+        send_buffers(self._sock, [header] + list(data))
 
     def recv_packet(self, timeout = None):
         data = self.__read(timeout)
@@ -29,6 +29,8 @@
 
 import socket, string, ntpath
 import random
+import sys
+import select, threading, time
 from impacket import nmb, smb3structs, nt_errors, spnego, ntlm, uuid, crypto
 from impacket.smb3structs import *
 from impacket.nt_errors import *
@@ -155,6 +157,8 @@ class SMB3:
             'ServerSecurityMode'       : 0,    #
             # Outside the protocol
             'ServerIP'                 : '',    #
+            # Granted by the server and not charged yet
+            'Credits'                  : 1,
         }
    
         self._Session = {
@@ -187,6 +191,21 @@ class SMB3:
         self.SMB_PACKET = SMB2Packet
         
         self._timeout = timeout
+        # How many READs retrieveFile() and WRITEs storeFile() keep in flight
+        self._pipelineDepth = 8
+        # Several threads might share this connection, see startDispatcher()
+        self.__sendLock = threading.Lock()
+        self.__treeLock = threading.RLock()
+        self.__receivedLock = threading.Lock()
+        self.__dispatcher = None
+        self.__dispatching = False
+        self.__dispatchError = None
+        # Indexed by the MessageID they wait for (None for any), the Conditions of the
+        # threads waiting for the dispatcher to hand them an answer. Several can wait for
+        # the same one, e.g. recvSMB(None)
+        self.__waiting = {}
+        # SMB 3.0 signers, see __cmac()
+        self.__signers = {}
         self._Connection['ServerIP'] = remote_host
         self._NetBIOSSession = None
         
@@ -257,79 +276,191 @@ class SMB3:
     def getDialect(self):
         return self._Connection['Dialect']
 
+    def setPipelineDepth(self, depth):
+        """
+        :param integer depth: how many READs retrieveFile() (or WRITEs storeFile()) sends before waiting for the first answer. 1 to wait for every answer
+        """
+        self._pipelineDepth = max(1, depth)
 
-    def signSMB(self, packet):
+    def getPipelineDepth(self):
+        return self._pipelineDepth
+
+
+    def signSMB(self, packet, payload = ''):
+        # payload is what goes on the wire right after the packet, see sendSMB()
         packet['Signature'] = '\x00'*16
         if self._Connection['Dialect'] == SMB2_DIALECT_21 or self._Connection['Dialect'] == SMB2_DIALECT_002:
             if len(self._Session['SessionKey']) > 0:
-                signature = hmac.new(self._Session['SessionKey'], str(packet), hashlib.sha256).digest()
-                packet['Signature'] = signature[:16]
+                signature = hmac.new(self._Session['SessionKey'], str(packet), hashlib.sha256)
+                signature.update(payload)
+                packet['Signature'] = signature.digest()[:16]
         else:
             if len(self._Session['SessionKey']) > 0:
-                p = str(packet)
-                signature = crypto.AES_CMAC(self._Session['SigningKey'], p, len(p))
-                packet['Signature'] = signature
+                packet['Signature'] = self.__cmac('sign', str(packet), payload)
+
+    def __cmac(self, direction, message, more = ''):
+        # A signer for sending and another one for verifying what's received, as each one
+        # can only be used by a thread at a time
+        signer = self.__signers.get(direction)
+        if signer is None or signer.getKey() != self._Session['SigningKey']:
+            signer = crypto.AES_CMAC_Signer(self._Session['SigningKey'])
+            self.__signers[direction] = signer
+        return signer.sign(message, more)
+
+    def __verifySMB(self, packet, message):
+        # message is the packet as it came, padding included
+        if self._Session['SigningActivated'] is False or (packet['Flags'] & SMB2_FLAGS_SIGNED) == 0:
+            return
+        if packet['SessionID'] != self._Session['SessionID'] or len(self._Session['SessionKey']) == 0:
+            return
+        message = message[:48] + '\x00'*16 + message[64:]
+        if self._Connection['Dialect'] == SMB2_DIALECT_21 or self._Connection['Dialect'] == SMB2_DIALECT_002:
+            signature = hmac.new(self._Session['SessionKey'], message, hashlib.sha256).digest()[:16]
+        else:
+            signature = self.__cmac('verify', message)
+        if signature != packet['Signature']:
+            raise SessionError(STATUS_INVALID_SIGNATURE, packet)
      
-    def sendSMB(self, packet):
-        # The idea here is to receive multiple/single commands and create a compound request, and send it
-        # Should return the MessageID for later retrieval. Implement compounded related requests.
+    def sendSMB(self, packet, payload = ''):
+        # payload is sent as it is right after the packet, so large data (e.g. a write's Buffer)
+        # doesn't need to be copied into it first. It's part of packet['Data'] as far as
+        # the server is concerned
+
+        # Should return the MessageID for later retrieval. See sendCompound() for
+        # several commands in a single message
 
         # If Connection.Dialect is equal to "3.000" and if Connection.SupportsMultiChannel or
         # Connection.SupportsPersistentHandles is TRUE, the client MUST set ChannelSequence in the
         # SMB2 header to Session.ChannelSequence
 
-        # Check this is not a CANCEL request. If so, don't consume sequece numbers
-        if packet['Command'] is not SMB2_CANCEL:
-            packet['MessageID'] = self._Connection['SequenceWindow']
-            self._Connection['SequenceWindow'] += 1
-        packet['SessionID'] = self._Session['SessionID']
+        # Other threads might be sending too. MessageIDs are taken and the packet written
+        # to the wire in one go
+        self.__sendLock.acquire()
+        try:
+            messageId = self.__stampSMB(packet)
+            self.__signSMB(packet, payload)
 
+            if self.__mustEncrypt(packet):
+                self._NetBIOSSession.send_packet(self.__encryptSMB(str(packet) + str(payload)))
+            elif len(payload) > 0:
+                self._NetBIOSSession.send_packet([str(packet), payload])
+            else:
+                self._NetBIOSSession.send_packet(str(packet))
+        finally:
+            self.__sendLock.release()
+        return messageId
+
+    def sendCompound(self, packets, related = True):
+        """
+        sends several requests in a single message. Each one gets its own answer, recvSMB() them
+        one by one
+
+        :param list packets: the SMB_PACKET()s to send, in the order the server should process them
+        :param boolean related: whether they're a chain of related operations, each one acting on
+            what the one before opened. Their FileID should be SMB2_RELATED_FILEID then
+
+        :return: the MessageIDs of the requests, in the same order
+        """
+        messageIds = []
+        message = []
+        encrypt = False
+        self.__sendLock.acquire()
+        try:
+            for i in range(len(packets)):
+                packet = packets[i]
+                if related is True and i > 0:
+                    packet['Flags'] = packet.fields.get('Flags', 0) | SMB2_FLAGS_RELATED_OPERATIONS
+                messageIds.append(self.__stampSMB(packet))
+                if i < len(packets) - 1:
+                    # Every element but the last one is padded for the next one to start 8-byte aligned,
+                    # and is signed padding included
+                    length = len(str(packet))
+                    packet['Data'] = str(packet['Data']) + '\x00' * ((8 - length % 8) % 8)
+                    packet['NextCommand'] = len(str(packet))
+                self.__signSMB(packet)
+                message.append(str(packet))
+                encrypt = encrypt or self.__mustEncrypt(packet)
+
+            message = ''.join(message)
+            if encrypt is True:
+                message = self.__encryptSMB(message)
+            self._NetBIOSSession.send_packet(message)
+        finally:
+            self.__sendLock.release()
+        return messageIds
+
+    def __stampSMB(self, packet):
         # Default the credit charge to 1 unless set by the caller
         if packet.fields.has_key('CreditCharge') is False:
             packet['CreditCharge'] = 1
 
+        # Check this is not a CANCEL request. If so, don't consume sequece numbers
+        if packet['Command'] is not SMB2_CANCEL:
+            # A multi-credit request takes as many MessageIDs as credits it's charged. They're
+            # taken right now, for other requests to be sent before this one's answer arrives
+            packet['MessageID'] = self._Connection['SequenceWindow']
+            self._Connection['SequenceWindow'] += max(1, packet['CreditCharge'])
+            # Answers, read maybe by another thread, add to it
+            self.__receivedLock.acquire()
+            self._Connection['Credits'] -= max(1, packet['CreditCharge'])
+            self.__receivedLock.release()
+        packet['SessionID'] = self._Session['SessionID']
+
         # Standard credit request after negotiating protocol
         if self._Connection['SequenceWindow'] > 3:
             packet['CreditRequestResponse'] = 127
 
-        messageId = packet['MessageID']
+        return packet['MessageID']
 
+    def __signSMB(self, packet, payload = ''):
         if self._Session['SigningActivated'] is True and self._Connection['SequenceWindow'] > 2:
             if packet['TreeID'] > 0 and self._Session['TreeConnectTable'].has_key(packet['TreeID']) is True:
                 if self._Session['TreeConnectTable'][packet['TreeID']]['EncryptData'] is False:
-                    packet['Flags'] = SMB2_FLAGS_SIGNED
-                    self.signSMB(packet)
+                    packet['Flags'] = packet.fields.get('Flags', 0) | SMB2_FLAGS_SIGNED
+                    self.signSMB(packet, payload)
             elif packet['TreeID'] == 0:
-                packet['Flags'] = SMB2_FLAGS_SIGNED
-                self.signSMB(packet)
-
-        if (self._Session['SessionFlags'] & SMB2_SESSION_FLAG_ENCRYPT_DATA) or ( packet['TreeID'] != 0 and self._Session['TreeConnectTable'][packet['TreeID']]['EncryptData'] is True):
-            plainText = str(packet)
-            transformHeader = SMB2_TRANSFORM_HEADER()
-            transformHeader['Nonce'] = ''.join([random.choice(string.letters) for i in range(11)])
-            transformHeader['OriginalMessageSize'] = len(plainText)
-            transformHeader['EncryptionAlgorithm'] = SMB2_ENCRYPTION_AES128_CCM
-            transformHeader['SessionID'] = self._Session['SessionID'] 
-            from Crypto.Cipher import AES
-            try: 
-                AES.MODE_CCM
-            except:
-                print "Your pycrypto doesn't support AES.MODE_CCM. Currently only pycrypto experimental supports this mode.\nDownload it from https://www.dlitz.net/software/pycrypto "
-                raise 
-            cipher = AES.new(self._Session['EncryptionKey'], AES.MODE_CCM,  transformHeader['Nonce'])
-            cipher.update(str(transformHeader)[20:])
-            cipherText = cipher.encrypt(plainText)
-            transformHeader['Signature'] = cipher.digest()
-            packet = str(transformHeader) + cipherText
-
-        self._NetBIOSSession.send_packet(str(packet))
-        return messageId
+                packet['Flags'] = packet.fields.get('Flags', 0) | SMB2_FLAGS_SIGNED
+                self.signSMB(packet, payload)
+
+    def __mustEncrypt(self, packet):
+        return (self._Session['SessionFlags'] & SMB2_SESSION_FLAG_ENCRYPT_DATA) or ( packet['TreeID'] != 0 and self._Session['TreeConnectTable'][packet['TreeID']]['EncryptData'] is True)
+
+    def __encryptSMB(self, plainText):
+        transformHeader = SMB2_TRANSFORM_HEADER()
+        transformHeader['Nonce'] = ''.join([random.choice(string.letters) for i in range(11)])
+        transformHeader['OriginalMessageSize'] = len(plainText)
+        transformHeader['EncryptionAlgorithm'] = SMB2_ENCRYPTION_AES128_CCM
+        transformHeader['SessionID'] = self._Session['SessionID'] 
+        from Crypto.Cipher import AES
+        try: 
+            AES.MODE_CCM
+        except:
+            print "Your pycrypto doesn't support AES.MODE_CCM. Currently only pycrypto experimental supports this mode.\nDownload it from https://www.dlitz.net/software/pycrypto "
+            raise 
+        cipher = AES.new(self._Session['EncryptionKey'], AES.MODE_CCM,  transformHeader['Nonce'])
+        cipher.update(str(transformHeader)[20:])
+        cipherText = cipher.encrypt(plainText)
+        transformHeader['Signature'] = cipher.digest()
+        return str(transformHeader) + cipherText
 
     def recvSMB(self, packetID = None):
-        # First, verify we don't have the packet already
-        if self._Connection['OutstandingResponses'].has_key(packetID):
-            return self._Connection['OutstandingResponses'].pop(packetID) 
-
+        if self.__dispatcher is not None:
+            answer = self.__waitSMB(packetID)
+            if answer is not None:
+                return answer
+
+        # Nobody else reads from the connection, this thread does it
+        while True:
+            # First, verify we don't have the packet already
+            if self._Connection['OutstandingResponses'].has_key(packetID):
+                return self._Connection['OutstandingResponses'].pop(packetID)
+
+            answer = self.__storeSMB(self.__readSMB(), packetID)
+            if answer is not None:
+                return answer
+
+    def __readSMB(self):
+        # Returns the packets in the next message that arrives
         data = self._NetBIOSSession.recv_packet(self._timeout) 
 
         if data.get_trailer().startswith('\xfdSMB'):
@@ -345,46 +476,158 @@ class SMB3:
             cipher.update(str(transformHeader)[20:])
             plainText = cipher.decrypt(data.get_trailer()[len(SMB2_TRANSFORM_HEADER()):])
             #cipher.verify(transformHeader['Signature'])
-            packet = SMB2Packet(plainText)
+            message = plainText
+            encrypted = True
         else:
             # In all SMB dialects for a response this field is interpreted as the Status field. 
             # This field can be set to any value. For a list of valid status codes, 
             # see [MS-ERREF] section 2.3.
-            packet = SMB2Packet(data.get_trailer())
-
-        # Loop while we receive pending requests
-        if packet['Status'] == STATUS_PENDING:
-            status = STATUS_PENDING
-            while status == STATUS_PENDING:
-                data = self._NetBIOSSession.recv_packet(self._timeout) 
-                if data.get_trailer().startswith('\xfeSMB'):
-                    packet = SMB2Packet(data.get_trailer())
+            message = data.get_trailer()
+            encrypted = False
+
+        # Answers to compound requests might come in a single message, one after the other
+        packets = []
+        offset = 0
+        while True:
+            nextCommand = unpack('<L', message[offset+20:offset+24])[0]
+            if nextCommand == 0:
+                raw = message[offset:]
+            else:
+                raw = message[offset:offset+nextCommand]
+            packet = SMB2Packet(raw)
+            if encrypted is False:
+                self.__verifySMB(packet, raw)
+            packets.append(packet)
+            if nextCommand == 0:
+                break
+            offset += nextCommand
+        return packets
+
+    def __storeSMB(self, packets, packetID = None, keepAll = False):
+        # Returns the answer to packetID (the first one if None) among packets, the rest are kept
+        # in OutstandingResponses, and whoever waits for them told
+        answer = None
+        self.__receivedLock.acquire()
+        try:
+            for packet in packets:
+                self._Connection['Credits'] += packet['CreditRequestResponse']
+
+                # An interim answer, the final one comes later with the same MessageID. Other
+                # requests' answers might come before it if there are more in flight
+                if packet['Status'] == STATUS_PENDING:
+                    continue
+
+                if keepAll is False and answer is None and (packet['MessageID'] == packetID or packetID is None):
+                #    if self._Session['SigningRequired'] is True:
+                #        self.signSMB(packet)
+                    answer = packet
                 else:
-                    packet = SMB2_TRANSFORM_HEADER(data.get_trailer())
-                    # Packet is encrypted
-                    transformHeader = SMB2_TRANSFORM_HEADER(data.get_trailer())
-                    from Crypto.Cipher import AES
-                    try: 
-                        AES.MODE_CCM
-                    except:
-                        print "Your pycrypto doesn't support AES.MODE_CCM. Currently only pycrypto experimental supports this mode.\nDownload it from https://www.dlitz.net/software/pycrypto "
-                        raise 
-                    cipher = AES.new(self._Session['DecryptionKey'], AES.MODE_CCM,  transformHeader['Nonce'][:11])
-                    cipher.update(str(transformHeader)[20:])
-                    plainText = cipher.decrypt(data.get_trailer()[len(SMB2_TRANSFORM_HEADER()):])
-                    #cipher.verify(transformHeader['Signature'])
-                    packet = SMB2Packet(plainText)
-                status = packet['Status']
-
-        if packet['MessageID'] == packetID or packetID is None:
-        #    if self._Session['SigningRequired'] is True:
-        #        self.signSMB(packet)
-            # Let's update the sequenceWindow based on the CreditsCharged
-            self._Connection['SequenceWindow'] += (packet['CreditCharge'] - 1)
-            return packet
-        else:
-            self._Connection['OutstandingResponses'][packet['MessageID']] = packet
-            return self.recvSMB(packetID) 
+                    self._Connection['OutstandingResponses'][packet['MessageID']] = packet
+                    for waiting in (packet['MessageID'], None):
+                        for waiter in self.__waiting.get(waiting, ()):
+                            waiter.notify()
+        finally:
+            self.__receivedLock.release()
+        return answer
+
+    def __waitSMB(self, packetID):
+        # Waits for the dispatcher to hand over the answer to packetID. None if it's
+        # stopped meanwhile, this thread has to read it then
+        if self._timeout is not None:
+            deadline = time.time() + self._timeout
+        waiter = threading.Condition(self.__receivedLock)
+        self.__receivedLock.acquire()
+        try:
+            responses = self._Connection['OutstandingResponses']
+            while True:
+                if packetID is None and len(responses) > 0:
+                    return responses.pop(min(responses))
+                if responses.has_key(packetID):
+                    return responses.pop(packetID)
+                if self.__dispatchError is not None:
+                    raise self.__dispatchError[0], self.__dispatchError[1], self.__dispatchError[2]
+                if self.__dispatcher is None:
+                    return None
+                if self._timeout is not None and time.time() > deadline:
+                    raise nmb.NetBIOSTimeout
+                # Timed waits poll, this one is woken up by the dispatcher at least once a second
+                waiters = self.__waiting.setdefault(packetID, [])
+                waiters.append(waiter)
+                try:
+                    waiter.wait()
+                finally:
+                    waiters.remove(waiter)
+                    if len(waiters) == 0 and self.__waiting.get(packetID) is waiters:
+                        del(self.__waiting[packetID])
+        finally:
+            self.__receivedLock.release()
+
+    def __dispatch(self):
+        sock = self._NetBIOSSession.get_socket()
+        lastTick = time.time()
+        try:
+            while self.__dispatching is True:
+                ready, _, _ = select.select([sock], [], [], 1)
+                if ready:
+                    self.__storeSMB(self.__readSMB(), keepAll = True)
+                if time.time() - lastTick >= 1:
+                    # Every second those waiting check their timeouts
+                    lastTick = time.time()
+                    self.__receivedLock.acquire()
+                    self.__notifyAll()
+                    self.__receivedLock.release()
+        except:
+            # Whoever waits gets the error. The connection is useless from now on
+            self.__receivedLock.acquire()
+            self.__dispatchError = sys.exc_info()
+            self.__notifyAll()
+            self.__receivedLock.release()
+
+    def __notifyAll(self):
+        # Wakes up every thread waiting for an answer. Called holding __receivedLock
+        for waiters in self.__waiting.values():
+            for waiter in waiters:
+                waiter.notify()
+
+    def startDispatcher(self):
+        """
+        starts a thread reading every answer from the server, and handing it over to the
+        recvSMB() waiting for it. Several threads (e.g. a few SMBTransport named pipes and a
+        download) can use this connection at the same time then. Otherwise the thread
+        calling recvSMB() reads, and only one can do it at a time
+
+        :return: None
+        """
+        if self.__dispatcher is not None:
+            return
+        self.__dispatchError = None
+        self.__dispatching = True
+        self.__dispatcher = threading.Thread(target = self.__dispatch, name = 'SMB3 dispatcher %s' % self._Connection['ServerName'])
+        self.__dispatcher.daemon = True
+        self.__dispatcher.start()
+
+    def stopDispatcher(self):
+        """
+        stops the thread started by startDispatcher(), once it's done with the message it might be
+        reading. Any thread still waiting for an answer reads it itself afterwards, so this should
+        be called when only one uses the connection
+
+        :return: None
+        """
+        dispatcher = self.__dispatcher
+        if dispatcher is None:
+            return
+        self.__dispatching = False
+        if dispatcher is not threading.currentThread():
+            dispatcher.join()
+        self.__receivedLock.acquire()
+        self.__dispatcher = None
+        self.__dispatchError = None
+        self.__notifyAll()
+        self.__receivedLock.release()
+
+    def isDispatching(self):
+        return self.__dispatcher is not None
 
     def negotiateSession(self, preferredDialect = None):
         packet = self.SMB_PACKET()
@@ -750,6 +993,14 @@ class SMB3:
                 raise
 
     def connectTree(self, share):
+        # Several threads might connect to (or disconnect from) the same share at once
+        self.__treeLock.acquire()
+        try:
+            return self.__connectTree(share)
+        finally:
+            self.__treeLock.release()
+
+    def __connectTree(self, share):
 
         # Just in case this came with the full path (maybe an SMB1 client), let's just leave 
         # the sharename, we'll take care of the rest
@@ -808,6 +1059,13 @@ class SMB3:
            return packet['TreeID'] 
 
     def disconnectTree(self, treeId):
+        self.__treeLock.acquire()
+        try:
+            return self.__disconnectTree(treeId)
+        finally:
+            self.__treeLock.release()
+
+    def __disconnectTree(self, treeId):
         if self._Session['TreeConnectTable'].has_key(treeId) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
@@ -836,6 +1094,13 @@ class SMB3:
         if self._Session['TreeConnectTable'].has_key(treeId) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
+        packet, pathName = self.__createPacket(treeId, fileName, desiredAccess, shareMode, creationOptions, creationDisposition, fileAttributes, impersonationLevel, securityFlags, oplockLevel, createContexts)
+        packetID = self.sendSMB(packet)
+        ans = self.recvSMB(packetID)
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            return self.__addOpen(SMB2Create_Response(ans['Data']), treeId, oplockLevel, pathName)
+
+    def __createPacket(self, treeId, fileName, desiredAccess, shareMode, creationOptions, creationDisposition, fileAttributes, impersonationLevel = SMB2_IL_IMPERSONATION, securityFlags = 0, oplockLevel = SMB2_OPLOCK_LEVEL_NONE, createContexts = None):
         fileName = string.replace(fileName, '/', '\\')
         if len(fileName) > 0:
             fileName = ntpath.normpath(fileName)
@@ -894,36 +1159,33 @@ class SMB3:
             smb2Create['CreateContextsLength'] = 0
 
         packet['Data'] = smb2Create
-
-        packetID = self.sendSMB(packet)
-        ans = self.recvSMB(packetID)
-        if ans.isValidAnswer(STATUS_SUCCESS):
-            createResponse = SMB2Create_Response(ans['Data'])
-
-            openFile = copy.deepcopy(OPEN)
-            openFile['FileID']      = createResponse['FileID']
-            openFile['TreeConnect'] = treeId
-            openFile['Oplocklevel'] = oplockLevel
-            openFile['Durable']     = False
-            openFile['ResilientHandle']    = False
-            openFile['LastDisconnectTime'] = 0
-            openFile['FileName'] = pathName
-
-            # ToDo: Complete the OperationBuckets
-            if self._Connection['Dialect'] == SMB2_DIALECT_30:
-                openFile['DesiredAccess']     = oplockLevel
-                openFile['ShareMode']         = oplockLevel
-                openFile['CreateOptions']     = oplockLevel
-                openFile['FileAttributes']    = oplockLevel
-                openFile['CreateDisposition'] = oplockLevel
-
-            # ToDo: Process the contexts            
-            self._Session['OpenTable'][str(createResponse['FileID'])] = openFile
-
-            # The client MUST generate a handle for the Open, and it MUST 
-            # return success and the generated handle to the calling application.
-            # In our case, str(FileID)
-            return str(createResponse['FileID'])
+        return packet, pathName
+
+    def __addOpen(self, createResponse, treeId, oplockLevel, pathName):
+        openFile = copy.deepcopy(OPEN)
+        openFile['FileID']      = createResponse['FileID']
+        openFile['TreeConnect'] = treeId
+        openFile['Oplocklevel'] = oplockLevel
+        openFile['Durable']     = False
+        openFile['ResilientHandle']    = False
+        openFile['LastDisconnectTime'] = 0
+        openFile['FileName'] = pathName
+
+        # ToDo: Complete the OperationBuckets
+        if self._Connection['Dialect'] == SMB2_DIALECT_30:
+            openFile['DesiredAccess']     = oplockLevel
+            openFile['ShareMode']         = oplockLevel
+            openFile['CreateOptions']     = oplockLevel
+            openFile['FileAttributes']    = oplockLevel
+            openFile['CreateDisposition'] = oplockLevel
+
+        # ToDo: Process the contexts            
+        self._Session['OpenTable'][str(createResponse['FileID'])] = openFile
+
+        # The client MUST generate a handle for the Open, and it MUST 
+        # return success and the generated handle to the calling application.
+        # In our case, str(FileID)
+        return str(createResponse['FileID'])
 
     def close(self, treeId, fileId):
         if self._Session['TreeConnectTable'].has_key(treeId) is False:
@@ -931,6 +1193,20 @@ class SMB3:
         if self._Session['OpenTable'].has_key(fileId) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
+        packetID = self.sendSMB(self.__closePacket(treeId, fileId))
+        ans = self.recvSMB(packetID)
+
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            # The same file might have been opened more than once (e.g. by another thread)
+            fileName = self._Session['OpenTable'][fileId]['FileName']
+            if self.GlobalFileTable.has_key(fileName):
+                del(self.GlobalFileTable[fileName])
+            del(self._Session['OpenTable'][fileId])
+             
+            # ToDo Remove stuff from GlobalFileTable
+            return True
+
+    def __closePacket(self, treeId, fileId):
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_CLOSE
         packet['TreeID']  = treeId
@@ -940,16 +1216,7 @@ class SMB3:
         smbClose['FileID'] = fileId
         
         packet['Data'] = smbClose
-
-        packetID = self.sendSMB(packet)
-        ans = self.recvSMB(packetID)
-
-        if ans.isValidAnswer(STATUS_SUCCESS):
-            del(self.GlobalFileTable[self._Session['OpenTable'][fileId]['FileName']])
-            del(self._Session['OpenTable'][fileId])
-             
-            # ToDo Remove stuff from GlobalFileTable
-            return True
+        return packet
 
     def read(self, treeId, fileId, offset = 0, bytesToRead = 0, waitAnswer = True):
         # IMPORTANT NOTE: As you can see, this was coded as a recursive function
@@ -962,19 +1229,38 @@ class SMB3:
         if self._Session['OpenTable'].has_key(fileId) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
+        packetID = self.__sendRead(treeId, fileId, offset, bytesToRead)[0]
+        ans = self.recvSMB(packetID)
+
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            readResponse = SMB2Read_Response(ans['Data'])
+            retData = readResponse['Buffer']
+            if readResponse['DataRemaining'] > 0:
+                retData += self.read(treeId, fileId, offset+len(retData), readResponse['DataRemaining'], waitAnswer)
+            return retData
+       
+    def __readLength(self, bytesToRead, credits = None):
+        # What a READ for bytesToRead will ask for, and the credits it will be charged.
+        # If credits is given, the READ is charged no more than that (but at least 1)
+        if self._Connection['Dialect'] != SMB2_DIALECT_002 and self._Connection['SupportsMultiCredit'] is True:
+            maxBytesToRead = min(self._Connection['MaxReadSize'], bytesToRead)
+            if credits is not None:
+                maxBytesToRead = min(maxBytesToRead, max(1, credits) * 65536)
+            return maxBytesToRead, ( 1 + (maxBytesToRead - 1) / 65536)
+        return min(65536,bytesToRead), 1
+
+    def __sendRead(self, treeId, fileId, offset, bytesToRead, credits = None):
+        packet, maxBytesToRead = self.__readPacket(treeId, fileId, offset, bytesToRead, credits)
+        return self.sendSMB(packet), maxBytesToRead
+
+    def __readPacket(self, treeId, fileId, offset, bytesToRead, credits = None):
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_READ
         packet['TreeID']  = treeId
 
-        if self._Connection['MaxReadSize'] < bytesToRead:
-            maxBytesToRead = self._Connection['MaxReadSize']
-        else: 
-            maxBytesToRead = bytesToRead
-
+        maxBytesToRead, creditCharge = self.__readLength(bytesToRead, credits)
         if self._Connection['Dialect'] != SMB2_DIALECT_002 and self._Connection['SupportsMultiCredit'] is True:
-            packet['CreditCharge'] = ( 1 + (maxBytesToRead - 1) / 65536)
-        else: 
-            maxBytesToRead = min(65536,bytesToRead)
+            packet['CreditCharge'] = creditCharge
 
         smbRead = SMB2Read()
         smbRead['Padding']  = 0x50
@@ -983,16 +1269,47 @@ class SMB3:
         smbRead['Offset']   = offset
         packet['Data'] = smbRead
 
-        packetID = self.sendSMB(packet)
-        ans = self.recvSMB(packetID)
+        return packet, maxBytesToRead
+
+    def __readPipelined(self, treeId, fileId, offset, bytesToRead, callback):
+        # Keeps up to self._pipelineDepth READs in flight, as long as the server granted
+        # the credits for them. What they read goes to callback in file order
+        end = offset + bytesToRead
+        # (MessageID, offset, length) of the READs sent, in file order
+        inFlight = []
+        try:
+            while offset < end or len(inFlight) > 0:
+                while offset < end and len(inFlight) < self._pipelineDepth:
+                    # More READs wait for the credits a whole one takes. The first one goes
+                    # anyway, asking for no more than the credits left
+                    credits = self._Connection['Credits']
+                    if len(inFlight) > 0 and credits < self.__readLength(end-offset)[1]:
+                        break
+                    packetID, length = self.__sendRead(treeId, fileId, offset, end-offset, credits)
+                    inFlight.append((packetID, offset, length))
+                    offset += length
+
+                packetID, chunkOffset, length = inFlight.pop(0)
+                ans = self.recvSMB(packetID)
+                ans.isValidAnswer(STATUS_SUCCESS)
+                data = SMB2Read_Response(ans['Data'])['Buffer']
+                while 0 < len(data) < length:
+                    # Short read, the rest of this chunk goes before the next ones
+                    more = self.read(treeId, fileId, chunkOffset+len(data), length-len(data))
+                    if not more:
+                        break
+                    data += more
+                callback(data)
+        except:
+            # Don't leave their answers behind for whoever reads next
+            error = sys.exc_info()
+            for packetID, chunkOffset, length in inFlight:
+                try:
+                    self.recvSMB(packetID)
+                except:
+                    pass
+            raise error[0], error[1], error[2]
 
-        if ans.isValidAnswer(STATUS_SUCCESS):
-            readResponse = SMB2Read_Response(ans['Data'])
-            retData = readResponse['Buffer']
-            if readResponse['DataRemaining'] > 0:
-                retData += self.read(treeId, fileId, offset+len(retData), readResponse['DataRemaining'], waitAnswer)
-            return retData
-       
     def write(self, treeId, fileId, data, offset = 0, bytesToWrite = 0, waitAnswer = True):
         # IMPORTANT NOTE: As you can see, this was coded as a recursive function
         # Hence, you can exhaust the memory pretty easy ( large bytesToWrite )
@@ -1004,40 +1321,97 @@ class SMB3:
         if self._Session['OpenTable'].has_key(fileId) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
+        packetID, maxBytesToWrite = self.__sendWrite(treeId, fileId, data, offset, bytesToWrite)
+        if waitAnswer == True:
+            ans = self.recvSMB(packetID)
+        else:
+            return maxBytesToWrite
+
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            writeResponse = SMB2Write_Response(ans['Data'])
+            bytesWritten = writeResponse['Count']
+            if bytesWritten < bytesToWrite:
+                bytesWritten += self.write(treeId, fileId, buffer(data, bytesWritten), offset+bytesWritten, bytesToWrite-bytesWritten, waitAnswer)
+            return bytesWritten
+
+    def __writeLength(self, bytesToWrite, credits = None):
+        # What a WRITE of bytesToWrite will send, and the credits it will be charged.
+        # If credits is given, the WRITE is charged no more than that (but at least 1)
+        if self._Connection['Dialect'] != SMB2_DIALECT_002 and self._Connection['SupportsMultiCredit'] is True:
+            maxBytesToWrite = min(self._Connection['MaxWriteSize'], bytesToWrite)
+            if credits is not None:
+                maxBytesToWrite = min(maxBytesToWrite, max(1, credits) * 65536)
+            return maxBytesToWrite, ( 1 + (maxBytesToWrite - 1) / 65536)
+        return min(65536,bytesToWrite), 1
+
+    def __sendWrite(self, treeId, fileId, data, offset, bytesToWrite, credits = None):
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_WRITE
         packet['TreeID']  = treeId
 
-        if self._Connection['MaxWriteSize'] < bytesToWrite:
-            maxBytesToWrite = self._Connection['MaxWriteSize']
-        else: 
-            maxBytesToWrite = bytesToWrite
-
+        maxBytesToWrite, creditCharge = self.__writeLength(bytesToWrite, credits)
         if self._Connection['Dialect'] != SMB2_DIALECT_002 and self._Connection['SupportsMultiCredit'] is True:
-            packet['CreditCharge'] = ( 1 + (maxBytesToWrite - 1) / 65536)
-        else: 
-            maxBytesToWrite = min(65536,bytesToWrite)
+            packet['CreditCharge'] = creditCharge
 
         smbWrite = SMB2Write()
         smbWrite['FileID'] = fileId
         smbWrite['Length'] = maxBytesToWrite
         smbWrite['Offset'] = offset
         smbWrite['WriteChannelInfoOffset'] = 0
-        smbWrite['Buffer'] = data[:maxBytesToWrite]
+        smbWrite['Buffer'] = ''
         packet['Data'] = smbWrite
 
-        packetID = self.sendSMB(packet)
-        if waitAnswer == True:
-            ans = self.recvSMB(packetID)
-        else:
-            return maxBytesToWrite
-
-        if ans.isValidAnswer(STATUS_SUCCESS):
-            writeResponse = SMB2Write_Response(ans['Data'])
-            bytesWritten = writeResponse['Count']
-            if bytesWritten < bytesToWrite:
-                bytesWritten += self.write(treeId, fileId, data[bytesWritten:], offset+bytesWritten, bytesToWrite-bytesWritten, waitAnswer)
-            return bytesWritten
+        # The data goes right after the packet, as it is
+        return self.sendSMB(packet, buffer(data, 0, maxBytesToWrite)), maxBytesToWrite
+
+    def __writePipelined(self, treeId, fileId, offset, callback):
+        # Writes what callback(size) returns until it returns nothing, keeping up to
+        # self._pipelineDepth WRITEs in flight as long as the server granted the credits
+        # for them. If a WRITE fails, the error raised is the one for the first chunk
+        # that failed, once every WRITE sent got its answer
+        # (MessageID, offset, data) of the WRITEs sent, in file order
+        inFlight = []
+        # Returned by callback but not sent yet
+        data = ''
+        finished = False
+        written = 0
+        try:
+            while finished is False or len(inFlight) > 0:
+                while finished is False and len(inFlight) < self._pipelineDepth:
+                    if len(data) == 0:
+                        data = callback(self._Connection['MaxWriteSize'])
+                        if len(data) == 0:
+                            finished = True
+                            break
+                    # As with READs, only the first WRITE goes whatever the credits left
+                    credits = self._Connection['Credits']
+                    if len(inFlight) > 0 and credits < self.__writeLength(len(data))[1]:
+                        break
+                    packetID, length = self.__sendWrite(treeId, fileId, data, offset, len(data), credits)
+                    inFlight.append((packetID, offset, buffer(data, 0, length)))
+                    offset += length
+                    data = buffer(data, length)
+
+                if len(inFlight) == 0:
+                    break
+                packetID, chunkOffset, chunk = inFlight.pop(0)
+                ans = self.recvSMB(packetID)
+                ans.isValidAnswer(STATUS_SUCCESS)
+                count = SMB2Write_Response(ans['Data'])['Count']
+                if count < len(chunk):
+                    # Short write, the rest of this chunk is written before going on
+                    count += self.write(treeId, fileId, buffer(chunk, count), chunkOffset+count, len(chunk)-count)
+                written += count
+        except:
+            # Don't leave their answers behind for whoever reads next
+            error = sys.exc_info()
+            for packetID, chunkOffset, chunk in inFlight:
+                try:
+                    self.recvSMB(packetID)
+                except:
+                    pass
+            raise error[0], error[1], error[2]
+        return written
 
     def queryDirectory(self, treeId, fileId, searchString = '*', resumeIndex = 0, informationClass = FILENAMES_INFORMATION, maxBufferSize = None, enumRestart = False, singleEntry = False):
         if self._Session['TreeConnectTable'].has_key(treeId) is False:
@@ -1045,6 +1419,13 @@ class SMB3:
         if self._Session['OpenTable'].has_key(fileId) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
+        packetID = self.sendSMB(self.__queryDirectoryPacket(treeId, fileId, searchString, resumeIndex, informationClass, maxBufferSize, enumRestart, singleEntry))
+        ans = self.recvSMB(packetID)
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            queryDirectoryResponse = SMB2QueryDirectory_Response(ans['Data'])
+            return queryDirectoryResponse['Buffer']
+
+    def __queryDirectoryPacket(self, treeId, fileId, searchString = '*', resumeIndex = 0, informationClass = FILENAMES_INFORMATION, maxBufferSize = None, enumRestart = False, singleEntry = False):
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_QUERY_DIRECTORY
         packet['TreeID']  = treeId
@@ -1066,11 +1447,7 @@ class SMB3:
         if self._Connection['Dialect'] != SMB2_DIALECT_002 and self._Connection['SupportsMultiCredit'] is True:
             packet['CreditCharge'] = ( 1 + (maxBufferSize - 1) / 65536)
 
-        packetID = self.sendSMB(packet)
-        ans = self.recvSMB(packetID)
-        if ans.isValidAnswer(STATUS_SUCCESS):
-            queryDirectoryResponse = SMB2QueryDirectory_Response(ans['Data'])
-            return queryDirectoryResponse['Buffer']
+        return packet
 
     def echo(self):
         packet = self.SMB_PACKET()
@@ -1204,6 +1581,8 @@ class SMB3:
 
         packetID = self.sendSMB(packet)
         ans = self.recvSMB(packetID)
+        # Nothing else is coming for this session
+        self.stopDispatcher()
 
         if ans.isValidAnswer(STATUS_SUCCESS):
             return True
@@ -1214,6 +1593,14 @@ class SMB3:
         if self._Session['OpenTable'].has_key(fileId) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
+        packetID = self.sendSMB(self.__queryInfoPacket(treeId, fileId, inputBlob, infoType, fileInfoClass, additionalInformation, flags))
+        ans = self.recvSMB(packetID)
+
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            queryResponse = SMB2QueryInfo_Response(ans['Data'])
+            return queryResponse['Buffer']
+
+    def __queryInfoPacket(self, treeId, fileId, inputBlob = '', infoType = SMB2_0_INFO_FILE, fileInfoClass = SMB2_FILE_STANDARD_INFO, additionalInformation = 0, flags = 0 ):
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_QUERY_INFO
         packet['TreeID']  = treeId
@@ -1233,12 +1620,7 @@ class SMB3:
         queryInfo['Flags']                 = flags
 
         packet['Data'] = queryInfo
-        packetID = self.sendSMB(packet)
-        ans = self.recvSMB(packetID)
-
-        if ans.isValidAnswer(STATUS_SUCCESS):
-            queryResponse = SMB2QueryInfo_Response(ans['Data'])
-            return queryResponse['Buffer']
+        return packet
 
     def setInfo(self, treeId, fileId, inputBlob = '', infoType = SMB2_0_INFO_FILE, fileInfoClass = SMB2_FILE_STANDARD_INFO, additionalInformation = 0 ):
         if self._Session['TreeConnectTable'].has_key(treeId) is False:
@@ -1309,17 +1691,102 @@ class SMB3:
         return True
 
     def writeFile(self, treeId, fileId, data, offset = 0):
-        finished = False
+        position = 0
         writeOffset = offset
-        while not finished:
-            if len(data) == 0:
-                break
-            writeData = data[:self._Connection['MaxWriteSize']]
-            data = data[self._Connection['MaxWriteSize']:]
+        while position < len(data):
+            writeData = buffer(data, position, self._Connection['MaxWriteSize'])
+            position += len(writeData)
             written = self.write(treeId, fileId, writeData, writeOffset, len(writeData))
             writeOffset += written
         return writeOffset - offset
 
+    def queryPathInfo(self, treeId, path, fileInfoClass = SMB2_FILE_STANDARD_INFO):
+        """
+        queryInfo() on a path instead of an open file. Opening the file, querying it and
+        closing it go in a single compound request
+
+        :param HANDLE treeId: a valid handle for the share where the file is
+        :param string path: the file or directory to query
+        :param integer fileInfoClass: the information wanted, SMB2_FILE_*_INFO
+
+        :return: the information, as queryInfo() returns it
+        """
+        if self._Session['TreeConnectTable'].has_key(treeId) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+
+        create, pathName = self.__createPacket(treeId, path, FILE_READ_ATTRIBUTES, FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE, 0, FILE_OPEN, 0)
+        answers = self.__openAndClose(pathName, [create, self.__queryInfoPacket(treeId, SMB2_RELATED_FILEID, fileInfoClass = fileInfoClass), self.__closePacket(treeId, SMB2_RELATED_FILEID)])
+        answers[1].isValidAnswer(STATUS_SUCCESS)
+        return SMB2QueryInfo_Response(answers[1]['Data'])['Buffer']
+
+    def readSmallFile(self, treeId, path, offset = 0, bytesToRead = None, shareAccessMode = FILE_SHARE_READ):
+        """
+        reads a file at once. Opening the file, reading it and closing it go in a single
+        compound request. For files larger than MaxReadSize use retrieveFile()
+
+        :param HANDLE treeId: a valid handle for the share where the file is
+        :param string path: the file to read
+        :param integer offset: where to start reading
+        :param integer bytesToRead: how much to read, MaxReadSize if None
+
+        :return: what was read, less than bytesToRead if the file is shorter
+        """
+        if self._Session['TreeConnectTable'].has_key(treeId) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+        if bytesToRead is None:
+            bytesToRead = self._Connection['MaxReadSize']
+
+        data = ''
+        while True:
+            # The READ asks for no more than what the CREATE and CLOSE leave of the credits.
+            # If that cuts it short, the rest goes in another chain
+            create, pathName = self.__createPacket(treeId, path, FILE_READ_DATA, shareAccessMode, FILE_NON_DIRECTORY_FILE, FILE_OPEN, 0)
+            read, length = self.__readPacket(treeId, SMB2_RELATED_FILEID, offset, bytesToRead, self._Connection['Credits'] - 2)
+            answers = self.__openAndClose(pathName, [create, read, self.__closePacket(treeId, SMB2_RELATED_FILEID)])
+            chunk = self.__readAnswer(answers[1])
+            data += chunk
+            if len(chunk) < length or length == bytesToRead:
+                return data
+            offset += length
+            bytesToRead -= length
+
+    def __sendChain(self, packets):
+        # Sends a related chain, in a single compound request if the credits granted cover
+        # all of it. Otherwise one by one, the FileID the CREATE answer brings going in the
+        # ones after it. Returns the answers
+        charge = 0
+        for packet in packets:
+            charge += max(1, packet.fields.get('CreditCharge', 1))
+        if charge <= self._Connection['Credits']:
+            return [self.recvSMB(packetID) for packetID in self.sendCompound(packets)]
+
+        answers = [self.recvSMB(self.sendSMB(packets[0]))]
+        if answers[0]['Status'] != STATUS_SUCCESS:
+            # Nothing to go on with, the caller checks the CREATE answer first
+            return answers
+        fileId = SMB2Create_Response(answers[0]['Data'])['FileID']
+        for packet in packets[1:]:
+            packet['Data']['FileID'] = fileId
+            answers.append(self.recvSMB(self.sendSMB(packet)))
+        return answers
+
+    def __openAndClose(self, pathName, packets):
+        # Sends a related chain that opens pathName, does something with it and closes it.
+        # Returns the answers, once the CREATE and CLOSE ones are checked
+        answers = self.__sendChain(packets)
+        if self.GlobalFileTable.has_key(pathName):
+            del(self.GlobalFileTable[pathName])
+        answers[0].isValidAnswer(STATUS_SUCCESS)
+        answers[-1].isValidAnswer(STATUS_SUCCESS)
+        return answers
+
+    def __readAnswer(self, ans):
+        # The data a READ answer brings, nothing if it was past the end of the file
+        if ans['Status'] == STATUS_END_OF_FILE:
+            return ''
+        ans.isValidAnswer(STATUS_SUCCESS)
+        return SMB2Read_Response(ans['Data'])['Buffer']
+
     def listPath(self, shareName, path, password = None):
         # ToDo: Handle situations where share is password protected
         path = string.replace(path,'/', '\\')
@@ -1332,24 +1799,28 @@ class SMB3:
         fileId = None
         try:
             # ToDo, we're assuming it's a directory, we should check what the file type is
-            fileId = self.create(treeId, ntpath.dirname(path), FILE_READ_ATTRIBUTES | FILE_READ_DATA ,FILE_SHARE_READ | FILE_SHARE_WRITE |FILE_SHARE_DELETE, FILE_DIRECTORY_FILE | FILE_SYNCHRONOUS_IO_NONALERT, FILE_OPEN, 0) 
-            res = ''
+            # Opening it and the first QUERY_DIRECTORY go together
+            create, pathName = self.__createPacket(treeId, ntpath.dirname(path), FILE_READ_ATTRIBUTES | FILE_READ_DATA ,FILE_SHARE_READ | FILE_SHARE_WRITE |FILE_SHARE_DELETE, FILE_DIRECTORY_FILE | FILE_SYNCHRONOUS_IO_NONALERT, FILE_OPEN, 0) 
+            query = self.__queryDirectoryPacket(treeId, SMB2_RELATED_FILEID, ntpath.basename(path), maxBufferSize = 65535, informationClass = FILE_FULL_DIRECTORY_INFORMATION)
+            answers = self.__sendChain([create, query])
+            answers[0].isValidAnswer(STATUS_SUCCESS)
+            fileId = self.__addOpen(SMB2Create_Response(answers[0]['Data']), treeId, SMB2_OPLOCK_LEVEL_NONE, pathName)
+
+            ans = answers[1]
             files = []
             from impacket import smb
-            while True:
-                try:
-                    res = self.queryDirectory( treeId, fileId, ntpath.basename(path), maxBufferSize = 65535, informationClass = FILE_FULL_DIRECTORY_INFORMATION )
-                    nextOffset = 1
-                    while nextOffset != 0:
-                        fileInfo = smb.SMBFindFileFullDirectoryInfo(smb.SMB.FLAGS2_UNICODE)
-                        fileInfo.fromString(res)
-                        files.append(smb.SharedFile(fileInfo['CreationTime'],fileInfo['LastAccessTime'],fileInfo['LastChangeTime'],fileInfo['EndOfFile'],fileInfo['AllocationSize'],fileInfo['ExtFileAttributes'],fileInfo['FileName'].decode('utf-16le'), fileInfo['FileName'].decode('utf-16le')))
-                        nextOffset = fileInfo['NextEntryOffset']
-                        res = res[nextOffset:]
-                except SessionError, e:
-                    if (e.get_error_code()) != STATUS_NO_MORE_FILES:
-                        raise
-                    break 
+            while ans['Status'] != STATUS_NO_MORE_FILES:
+                ans.isValidAnswer(STATUS_SUCCESS)
+                res = SMB2QueryDirectory_Response(ans['Data'])['Buffer']
+                nextOffset = 1
+                while nextOffset != 0:
+                    fileInfo = smb.SMBFindFileFullDirectoryInfo(smb.SMB.FLAGS2_UNICODE)
+                    fileInfo.fromString(res)
+                    files.append(smb.SharedFile(fileInfo['CreationTime'],fileInfo['LastAccessTime'],fileInfo['LastChangeTime'],fileInfo['EndOfFile'],fileInfo['AllocationSize'],fileInfo['ExtFileAttributes'],fileInfo['FileName'].decode('utf-16le'), fileInfo['FileName'].decode('utf-16le')))
+                    nextOffset = fileInfo['NextEntryOffset']
+                    res = res[nextOffset:]
+                packetID = self.sendSMB(self.__queryDirectoryPacket(treeId, fileId, ntpath.basename(path), maxBufferSize = 65535, informationClass = FILE_FULL_DIRECTORY_INFORMATION))
+                ans = self.recvSMB(packetID)
         finally:
             if fileId is not None:
                 self.close(treeId, fileId)
@@ -1423,25 +1894,30 @@ class SMB3:
 
         treeId = self.connectTree(shareName)
         fileId = None
-        from impacket import smb
         try:
-            fileId = self.create(treeId, path, FILE_READ_DATA, shareAccessMode, FILE_NON_DIRECTORY_FILE, mode, 0)
-            res = self.queryInfo(treeId, fileId)
-            fileInfo = smb.SMBQueryFileStandardInfo(res)
-            fileSize = fileInfo['EndOfFile']
-            if (fileSize-offset) < self._Connection['MaxReadSize']:
-                # Skip reading 0 bytes files. 
-                if (fileSize-offset) > 0:
-                    data = self.read(treeId, fileId, offset, fileSize-offset)
-                    callback(data)
+            # Opening the file and reading its first chunk go together, if the server granted
+            # the credits for both. The READ asks for no more than what the CREATE leaves of
+            # them. The CREATE answer tells how large the file is
+            create, pathName = self.__createPacket(treeId, path, FILE_READ_DATA, shareAccessMode, FILE_NON_DIRECTORY_FILE, mode, 0)
+            credits = self._Connection['Credits'] - 1
+            if credits >= 1:
+                read = self.__readPacket(treeId, SMB2_RELATED_FILEID, offset, self._Connection['MaxReadSize'], credits)[0]
+                answers = [self.recvSMB(packetID) for packetID in self.sendCompound([create, read])]
             else:
-                written = 0
-                toBeRead = fileSize-offset
-                while written < (toBeRead):
-                    data = self.read(treeId, fileId, offset, self._Connection['MaxReadSize'])
-                    written += len(data)
-                    offset  += len(data)
-                    callback(data)
+                answers = [self.recvSMB(self.sendSMB(create))]
+            answers[0].isValidAnswer(STATUS_SUCCESS)
+            createResponse = SMB2Create_Response(answers[0]['Data'])
+            fileId = self.__addOpen(createResponse, treeId, SMB2_OPLOCK_LEVEL_NONE, pathName)
+            fileSize = createResponse['EndOfFile']
+
+            data = ''
+            if len(answers) > 1:
+                data = self.__readAnswer(answers[1])
+            # Skip reading 0 bytes files. 
+            if len(data) > 0:
+                callback(data)
+            if offset + len(data) < fileSize:
+                self.__readPipelined(treeId, fileId, offset + len(data), fileSize - offset - len(data), callback)
         finally:
             if fileId is not None:
                 self.close(treeId, fileId)
@@ -1458,14 +1934,7 @@ class SMB3:
         fileId = None
         try:
             fileId = self.create(treeId, path, FILE_WRITE_DATA, shareAccessMode, FILE_NON_DIRECTORY_FILE, mode, 0)
-            finished = False
-            writeOffset = offset
-            while not finished:
-                data = callback(self._Connection['MaxWriteSize'])
-                if len(data) == 0:
-                    break
-                written = self.write(treeId, fileId, data, writeOffset, len(data))
-                writeOffset += written
+            self.__writePipelined(treeId, fileId, offset, callback)
         finally:
             if fileId is not None:
                 self.close(treeId, fileId)
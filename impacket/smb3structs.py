@@ -715,6 +715,9 @@ class SMB2_FILEID(Structure):
         ('Volatile','<Q=0'),
     )
 
+# FileID of the requests in a related compound chain acting on what the previous one opened
+SMB2_RELATED_FILEID = '\xff' * 16
+
 class SMB2Create_Response(Structure):
     structure = (
         ('StructureSize','<H=89'),
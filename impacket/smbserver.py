@@ -1962,8 +1962,13 @@ class SMBCommands():
                                mode |= os.O_BINARY
                             if smbServer.getRegisteredNamedPipes().has_key(unicode(pathName)):
                                 fid = PIPE_FILE_DESCRIPTOR
-                                sock = socket.socket()
-                                sock.connect(smbServer.getRegisteredNamedPipes()[unicode(pathName)])
+                                endpoint = smbServer.getRegisteredNamedPipes()[unicode(pathName)]
+                                if isinstance(endpoint, tuple):
+                                    sock = socket.socket()
+                                    sock.connect(endpoint)
+                                else:
+                                    # In-process, no socket in the middle
+                                    sock = endpoint.openPipe()
                             else:
                                 fid = os.open(pathName, mode)
                      except Exception, e:
@@ -2622,6 +2627,16 @@ smb.SMB.TRANS_TRANSACT_NMPIPE          :self.__smbTransHandler.transactNamedPipe
         return self.__registeredNamedPipes
 
     def registerNamedPipe(self, pipeName, address):
+        """
+        serves a named pipe from somewhere else
+
+        :param string pipeName: the pipe's name, e.g. srvsvc
+        :param tuple/object address: either an (ip, port) tuple to relay the pipe's traffic to, over TCP,
+         or an in-process endpoint: anything with an openPipe() method returning an object with
+         send(data), recv(count) and close() methods, as rpcrt.DCERPCServer does
+
+        :return: True
+        """
         self.__registeredNamedPipes[unicode(pipeName)] = address
         return True
 
@@ -3078,11 +3093,9 @@ class SimpleSMBServer():
         # ask for shares using MS-RAP.
 
         self.__srvsServer = SRVSServer()
-        self.__srvsServer.daemon = True
-        self.__server.registerNamedPipe('srvsvc',('127.0.0.1',self.__srvsServer.getListenPort()))
+        self.__server.registerNamedPipe('srvsvc',self.__srvsServer)
 
     def start(self):
-        self.__srvsServer.start()
         self.__server.serve_forever()
 
     def addShare(self, shareName, sharePath, shareComment='', shareType = 0, readOnly = 'no'):
@@ -7,7 +7,625 @@
 # $Id$
 #
 
-from struct import pack, unpack, calcsize
+from struct import pack, unpack, unpack_from, calcsize, Struct, error as StructError
+import time
+import weakref
+
+# Format kinds, resolved once per format string by _FieldCodec
+_VOID, _QUOTE, _CODE, _ADDRESS, _LENGTH, _ARRAY, _PRINTF, _ASCIIZ, _UNICODE, _NDRSTRING, _LITERAL, _STRUCT = range(12)
+
+def _formatKind(format, codeFirst, exactLeaves):
+    # Mirrors the order in which Structure checks the specifiers. pack() looks
+    # for '=' before '&', everybody else looks for '&' first. unpack() compares
+    # the z/u/w/: specifiers as a whole, the rest just look at the prefix.
+    if format[:1] == '_':
+        return _VOID
+    if format[:1] == "'" or format[:1] == '"':
+        return _QUOTE
+    if codeFirst:
+        if len(format.split('=')) >= 2:
+            return _CODE
+        if len(format.split('&')) == 2:
+            return _ADDRESS
+    else:
+        if len(format.split('&')) == 2:
+            return _ADDRESS
+        if len(format.split('=')) >= 2:
+            return _CODE
+    if len(format.split('-')) == 2:
+        return _LENGTH
+    if len(format.split('*')) == 2:
+        return _ARRAY
+    if format[:1] == '%':
+        return _PRINTF
+    if exactLeaves:
+        leaf = format
+    else:
+        leaf = format[:1]
+    if leaf == 'z':
+        return _ASCIIZ
+    if leaf == 'u':
+        return _UNICODE
+    if leaf == 'w':
+        return _NDRSTRING
+    if leaf == ':':
+        return _LITERAL
+    return _STRUCT
+
+_codecs = {}
+
+def _codecFor(format):
+    try:
+        return _codecs[format]
+    except KeyError:
+        codec = _codecs[format] = _FieldCodec(format)
+        return codec
+
+_compiled = {}
+
+def _evaluate(code, namespace):
+    # eval() for the '=' and '_' specifiers, compiling each expression once
+    if isinstance(code, basestring):
+        try:
+            code = _compiled[code]
+        except KeyError:
+            code = _compiled[code] = compile(code, '<string>', 'eval')
+    return eval(code, {}, namespace)
+
+class _FieldsView:
+    """
+    The names seen by '=' and '_' expressions: the fields of the structure,
+    'self' and, when unpacking, 'inputDataLeft'. Looked up on the structure
+    itself, instead of copying its fields for every evaluation.
+    """
+    def __init__(self, structure, inputDataLeft = None):
+        self.structure = structure
+        self.inputDataLeft = inputDataLeft
+
+    def __getitem__(self, key):
+        try:
+            return self.structure.fields[key]
+        except KeyError:
+            if key == 'self':
+                return self.structure
+            if key == 'inputDataLeft' and self.inputDataLeft is not None:
+                return self.inputDataLeft
+            raise
+
+def _bounds(length, start, stop):
+    # Offsets of data[start:stop] relative to data, len(data) == length
+    start, stop, step = slice(start, stop).indices(length)
+    return start, max(start, stop)
+
+def _slice(data, start, end):
+    # data[start:end] as a string. data may be a str, bytearray, memoryview,
+    # buffer or mmap; only the requested bytes are copied.
+    if start >= end:
+        return ''
+    if isinstance(data, memoryview):
+        return data[start:end].tobytes()
+    if isinstance(data, bytearray):
+        return str(buffer(data, start, end-start))
+    return data[start:end]
+
+def _index(data, sub, start, end):
+    # data[start:end].index(sub), without copying data when it can be helped
+    if isinstance(data, (memoryview, buffer)):
+        # No find() here, look for it chunk by chunk
+        i = start
+        while i < end:
+            chunk = _slice(data, i, min(i+4096+len(sub)-1, end))
+            j = chunk.find(sub)
+            if j >= 0:
+                return i - start + j
+            i += 4096
+        raise ValueError('substring not found')
+    i = data.find(sub, start, end)
+    if i < 0:
+        raise ValueError('substring not found')
+    return i - start
+
+class _FieldCodec:
+    """
+    A format specifier (see Structure) parsed ahead of time. The splits and
+    the struct.Struct objects are computed once per format string and shared
+    by every Structure using it. The semantics are exactly the ones Structure
+    had while interpreting the format on every call.
+    """
+    def __init__(self, format):
+        self.format = format
+        self.packKind = _formatKind(format, True, False)
+        self.unpackKind = _formatKind(format, False, True)
+        self.sizeKind = _formatKind(format, False, False)
+
+        kinds = (self.packKind, self.unpackKind, self.sizeKind)
+        if _CODE in kinds:
+            two = format.split('=')
+            self.codeLeft = _codecFor(two[0])
+            self.code = two[1]
+        if _ADDRESS in kinds:
+            two = format.split('&')
+            self.addressLeft = _codecFor(two[0])
+            self.addressTarget = two[1]
+        if _LENGTH in kinds:
+            two = format.split('-')
+            self.lengthLeft = _codecFor(two[0])
+            self.lengthTarget = two[1]
+        if _ARRAY in kinds:
+            two = format.split('*')
+            self.countFormat = two[0]
+            self.countIsDigit = two[0].isdigit()
+            if two[0] and not self.countIsDigit:
+                self.countCodec = _codecFor(two[0])
+            else:
+                self.countCodec = None
+            self.itemCodec = _codecFor(two[1])
+            self.bulkFormat = None
+            self.bulkItem = None
+            itemCodec = self.itemCodec
+            if itemCodec.unpackKind == _STRUCT and itemCodec.sizeKind == _STRUCT and itemCodec.struct is not None \
+               and itemCodec.struct.size and len(itemCodec.struct.unpack('\x00'*itemCodec.struct.size)) == 1:
+                # Arrays of fixed size primitives are decoded all at once
+                if itemCodec.format[:1] in '@=<>!':
+                    prefix, body = itemCodec.format[:1], itemCodec.format[1:]
+                else:
+                    prefix, body = '', itemCodec.format
+                if len(body) == 1 and body not in 'sp':
+                    self.bulkFormat = prefix + '%d' + body
+                else:
+                    self.bulkFormat = prefix + '%s'
+                    self.bulkItem = body
+        if _QUOTE in kinds:
+            self.literal = format[1:]
+
+        self.struct = None
+        if _STRUCT in kinds:
+            try:
+                self.struct = Struct(format)
+            except StructError:
+                # Leave it to pack/unpack to raise when (if ever) used
+                pass
+
+    def pack(self, structure, data):
+        kind = self.packKind
+        if kind == _STRUCT:
+            if data is None:
+                raise Exception, "Trying to pack None"
+            if self.struct is not None:
+                return self.struct.pack(data)
+            return pack(self.format, data)
+
+        # void specifier
+        if kind == _VOID:
+            return ''
+
+        # quote specifier
+        if kind == _QUOTE:
+            return self.literal
+
+        # code specifier
+        if kind == _CODE:
+            try:
+                return self.codeLeft.pack(structure, data)
+            except:
+                return self.codeLeft.pack(structure, _evaluate(self.code, _FieldsView(structure)))
+
+        # address specifier
+        if kind == _ADDRESS:
+            try:
+                return self.addressLeft.pack(structure, data)
+            except:
+                target = self.addressTarget
+                if (structure.fields.has_key(target)) and (structure[target] is not None):
+                    return self.addressLeft.pack(structure, id(structure[target]) & ((1<<(calcsize(self.addressLeft.format)*8))-1) )
+                else:
+                    return self.addressLeft.pack(structure, 0)
+
+        # length specifier
+        if kind == _LENGTH:
+            try:
+                return self.lengthLeft.pack(structure, data)
+            except:
+                return self.lengthLeft.pack(structure, structure.calcPackFieldSize(self.lengthTarget))
+
+        # array specifier
+        if kind == _ARRAY:
+            itemCodec = self.itemCodec
+            answer = ''.join([itemCodec.pack(structure, each) for each in data])
+            if self.countFormat:
+                if self.countIsDigit:
+                    if int(self.countFormat) != len(data):
+                        raise Exception, "Array field has a constant size, and it doesn't match the actual value"
+                else:
+                    return self.countCodec.pack(structure, len(data))+answer
+            return answer
+
+        # "printf" string specifier
+        if kind == _PRINTF:
+            # format string like specifier
+            return self.format % data
+
+        # asciiz specifier
+        if kind == _ASCIIZ:
+            return str(data)+'\0'
+
+        # unicode specifier
+        if kind == _UNICODE:
+            return str(data)+'\0\0' + (len(data) & 1 and '\0' or '')
+
+        # DCE-RPC/NDR string specifier
+        if kind == _NDRSTRING:
+            if len(data) == 0:
+                data = '\0\0'
+            elif len(data) % 2:
+                data += '\0'
+            l = pack('<L', len(data)/2)
+            return '%s\0\0\0\0%s%s' % (l,l,data)
+
+        if data is None:
+            raise Exception, "Trying to pack None"
+
+        # literal specifier
+        return str(data)
+
+    def unpack(self, structure, data, dataClassOrCode = str, field = None):
+        return self.unpackFrom(structure, data, 0, len(data), dataClassOrCode, field)
+
+    def unpackFrom(self, structure, data, offset, end, dataClassOrCode = str, field = None):
+        # Same as unpack(structure, data[offset:end]), but only the bytes
+        # this field ends up holding get copied out of data.
+        kind = self.unpackKind
+        if kind == _STRUCT:
+            if self.struct is not None:
+                if end - offset == self.struct.size:
+                    return self.struct.unpack_from(data, offset)[0]
+                return self.struct.unpack(_slice(data, offset, end))[0]
+            return unpack(self.format, _slice(data, offset, end))[0]
+
+        # address specifier
+        if kind == _ADDRESS:
+            return self.addressLeft.unpackFrom(structure, data, offset, end)
+
+        # code specifier
+        if kind == _CODE:
+            return self.codeLeft.unpackFrom(structure, data, offset, end)
+
+        # length specifier
+        if kind == _LENGTH:
+            return self.lengthLeft.unpackFrom(structure, data, offset, end)
+
+        # array specifier
+        if kind == _ARRAY:
+            answer = []
+            sofar = 0
+            length = end - offset
+            if self.countIsDigit:
+                number = int(self.countFormat)
+            elif self.countCodec is not None:
+                sofar += self.countCodec.calcUnpackSizeFrom(structure, data, offset, end)
+                start, stop = _bounds(length, 0, sofar)
+                number = self.countCodec.unpackFrom(structure, data, offset+start, offset+stop)
+            else:
+                number = -1
+
+            if self.bulkFormat is not None:
+                if sofar >= length:
+                    return answer
+                answer = self.unpackBulk(data, offset+sofar, end, number)
+                if answer is not None:
+                    return answer
+                answer = []
+
+            itemCodec = self.itemCodec
+            while number and sofar < length:
+                start = _bounds(length, sofar, None)[0]
+                nsofar = sofar + itemCodec.calcUnpackSizeFrom(structure, data, offset+start, end)
+                start, stop = _bounds(length, sofar, nsofar)
+                answer.append(itemCodec.unpackFrom(structure, data, offset+start, offset+stop, dataClassOrCode))
+                number -= 1
+                sofar = nsofar
+            return answer
+
+        data = _slice(data, offset, end)
+
+        # void specifier
+        if kind == _VOID:
+            if dataClassOrCode != str:
+                return _evaluate(dataClassOrCode, _FieldsView(structure, data))
+            else:
+                return None
+
+        # quote specifier
+        if kind == _QUOTE:
+            answer = self.literal
+            if answer != data:
+                raise Exception, "Unpacked data doesn't match constant value '%r' should be '%r'" % (data, answer)
+            return answer
+
+        # "printf" string specifier
+        if kind == _PRINTF:
+            # format string like specifier
+            return self.format % data
+
+        # asciiz specifier
+        if kind == _ASCIIZ:
+            if data[-1] != '\x00':
+                raise Exception, ("%s 'z' field is not NUL terminated: %r" % (field, data))
+            return data[:-1] # remove trailing NUL
+
+        # unicode specifier
+        if kind == _UNICODE:
+            if data[-2:] != '\x00\x00':
+                raise Exception, ("%s 'u' field is not NUL-NUL terminated: %r" % (field, data))
+            return data[:-2] # remove trailing NUL
+
+        # DCE-RPC/NDR string specifier
+        if kind == _NDRSTRING:
+            l = unpack('<L', data[:4])[0]
+            return data[12:12+l*2]
+
+        # literal specifier
+        return dataClassOrCode(data)
+
+    def unpackBulk(self, data, offset, end, number):
+        # The '*' specifier for fixed size items, in a single unpack_from().
+        # Returns None when the data doesn't hold a whole number of items,
+        # so the element by element path gets to raise (or stop) as usual.
+        if not isinstance(number, (int, long)):
+            return None
+        size = self.itemCodec.struct.size
+        available = end - offset
+        if number < 0:
+            if available % size:
+                return None
+            number = available / size
+        elif number * size > available:
+            return None
+        if self.bulkItem is None:
+            return list(unpack_from(self.bulkFormat % number, data, offset))
+        return list(unpack_from(self.bulkFormat % (self.bulkItem*number), data, offset))
+
+    def calcPackSize(self, structure, data):
+        kind = self.sizeKind
+        if kind == _STRUCT:
+            if self.struct is not None:
+                return self.struct.size
+            return calcsize(self.format)
+
+        # void specifier
+        if kind == _VOID:
+            return 0
+
+        # quote specifier
+        if kind == _QUOTE:
+            return len(self.literal)
+
+        # address specifier
+        if kind == _ADDRESS:
+            return self.addressLeft.calcPackSize(structure, data)
+
+        # code specifier
+        if kind == _CODE:
+            return self.codeLeft.calcPackSize(structure, data)
+
+        # length specifier
+        if kind == _LENGTH:
+            return self.lengthLeft.calcPackSize(structure, data)
+
+        # array specifier
+        if kind == _ARRAY:
+            answer = 0
+            if self.countIsDigit:
+                if int(self.countFormat) != len(data):
+                    raise Exception, "Array field has a constant size, and it doesn't match the actual value"
+            elif self.countCodec is not None:
+                answer += self.countCodec.calcPackSize(structure, len(data))
+
+            itemCodec = self.itemCodec
+            for each in data:
+                answer += itemCodec.calcPackSize(structure, each)
+            return answer
+
+        # "printf" string specifier
+        if kind == _PRINTF:
+            # format string like specifier
+            return len(self.format % data)
+
+        # asciiz specifier
+        if kind == _ASCIIZ:
+            return len(data)+1
+
+        # unicode specifier
+        if kind == _UNICODE:
+            l = len(data)
+            return l + (l & 1 and 3 or 2)
+
+        # DCE-RPC/NDR string specifier
+        if kind == _NDRSTRING:
+            l = len(data)
+            return 12+l+l % 2
+
+        # literal specifier
+        return len(data)
+
+    def calcUnpackSize(self, structure, data):
+        return self.calcUnpackSizeFrom(structure, data, 0, len(data))
+
+    def calcUnpackSizeFrom(self, structure, data, offset, end):
+        # Same as calcUnpackSize(structure, data[offset:end])
+        kind = self.sizeKind
+        if kind == _STRUCT:
+            if self.struct is not None:
+                return self.struct.size
+            return calcsize(self.format)
+
+        # void specifier
+        if kind == _VOID:
+            return 0
+
+        # quote specifier
+        if kind == _QUOTE:
+            return len(self.literal)
+
+        # address specifier
+        if kind == _ADDRESS:
+            return self.addressLeft.calcUnpackSizeFrom(structure, data, offset, end)
+
+        # code specifier
+        if kind == _CODE:
+            return self.codeLeft.calcUnpackSizeFrom(structure, data, offset, end)
+
+        # length specifier
+        if kind == _LENGTH:
+            return self.lengthLeft.calcUnpackSizeFrom(structure, data, offset, end)
+
+        # array specifier
+        if kind == _ARRAY:
+            answer = 0
+            length = end - offset
+            itemCodec = self.itemCodec
+            if self.countFormat:
+                if self.countIsDigit:
+                    number = int(self.countFormat)
+                else:
+                    answer += self.countCodec.calcUnpackSizeFrom(structure, data, offset, end)
+                    start, stop = _bounds(length, 0, answer)
+                    number = self.countCodec.unpackFrom(structure, data, offset+start, offset+stop)
+
+                if self.bulkFormat is not None and isinstance(number, (int, long)) and number >= 0:
+                    return answer + number * itemCodec.struct.size
+
+                while number:
+                    number -= 1
+                    start = _bounds(length, answer, None)[0]
+                    answer += itemCodec.calcUnpackSizeFrom(structure, data, offset+start, end)
+            else:
+                while answer < length:
+                    start = _bounds(length, answer, None)[0]
+                    answer += itemCodec.calcUnpackSizeFrom(structure, data, offset+start, end)
+            return answer
+
+        # "printf" string specifier
+        if kind == _PRINTF:
+            raise Exception, "Can't guess the size of a printf like specifier for unpacking"
+
+        # asciiz specifier
+        if kind == _ASCIIZ:
+            return _index(data, '\x00', offset, end)+1
+
+        # unicode specifier
+        if kind == _UNICODE:
+            l = _index(data, '\x00\x00', offset, end)
+            return l + (l & 1 and 3 or 2)
+
+        # DCE-RPC/NDR string specifier
+        if kind == _NDRSTRING:
+            l = unpack('<L', _slice(data, offset, min(offset+4, end)))[0]
+            return 12+l*2
+
+        # literal specifier
+        return end - offset
+
+class _StructurePlan:
+    """
+    Compiled form of commonHdr+structure: the list of fields with their
+    codecs, plus the lookup tables for formatForField, findAddressFieldFor
+    and findLengthFieldFor. Built once per layout, see Structure._getPlan().
+    """
+    def __init__(self, commonHdr, structure):
+        self.commonHdr = commonHdr
+        self.structure = structure
+        self.formats = {}
+        self.addressFields = {}
+        self.lengthFields = {}
+        for field in commonHdr+structure:
+            fieldName, format = field[0], field[1]
+            self.formats.setdefault(fieldName, format)
+            # A format ending in '&name' ('-name') is the address (length) field of
+            # name. Every '&' ('-') in the format is a candidate, first field wins.
+            for table, specifier in ((self.addressFields, '&'), (self.lengthFields, '-')):
+                i = format.find(specifier)
+                while i >= 0:
+                    table.setdefault(format[i+1:], fieldName)
+                    i = format.find(specifier, i+1)
+
+        # (fieldName, format, codec, dataClassOrCode, addressField, lengthField)
+        self.fields = []
+        for field in commonHdr+structure:
+            fieldName, format = field[0], field[1]
+            if len(field) > 2:
+                dataClassOrCode = field[2]
+            else:
+                dataClassOrCode = str
+            self.fields.append((fieldName, format, _codecFor(format), dataClassOrCode,
+                                self.addressFields.get('%s' % fieldName), self.lengthFields.get('%s' % fieldName)))
+
+_plans = {}
+
+_IMMUTABLE = (int, long, float, bool, str, unicode, type(None))
+
+def _trackValue(owner, value, lists):
+    # Called when owner caches its size, for every value reachable from its
+    # fields. Structures (and NDRs) get owner registered, so they invalidate
+    # it when they change. Lists can't tell, a copy of their items is kept in
+    # lists to compare against. Returns False if value can't be tracked.
+    if isinstance(value, _IMMUTABLE):
+        return True
+    if isinstance(value, (list, tuple)):
+        if isinstance(value, list):
+            lists.append((value, tuple(value)))
+        for each in value:
+            if not _trackValue(owner, each, lists):
+                return False
+        return True
+    trackSize = getattr(value, '_trackSize', None)
+    if trackSize is None:
+        return False
+    return trackSize(owner, lists)
+
+def _listsUnchanged(lists):
+    for value, items in lists:
+        if len(value) != len(items) or tuple(value) != items:
+            return False
+    return True
+
+def _invalidateOwners(owners):
+    for ref in owners.itervalues():
+        owner = ref()
+        if owner is not None:
+            owner._invalidate()
+
+_trackable = {}
+
+def _sizeTrackable(cls):
+    # The cached size can only be trusted if the class serializes its fields
+    # the Structure way, and changes them through Structure.__setitem__
+    try:
+        return _trackable[cls]
+    except KeyError:
+        answer = True
+        for name in ('getData', 'setData', '__setitem__', '__delitem__'):
+            if getattr(cls, name).im_func is not getattr(Structure, name).im_func:
+                answer = False
+        _trackable[cls] = answer
+        return answer
+
+_plainPacking = {}
+_plainUnpacking = {}
+
+def _usesCodecs(cls, hooks, cache):
+    # Whether cls leaves alone the hooks getData (fromString) goes through,
+    # so the codecs can be called directly
+    try:
+        return cache[cls]
+    except KeyError:
+        answer = True
+        for name in hooks:
+            if getattr(cls, name).im_func is not getattr(Structure, name).im_func:
+                answer = False
+        cache[cls] = answer
+        return answer
+
 
 class Structure:
     """ sublcasses can define commonHdr and/or structure.
@@ -73,6 +691,9 @@ class Structure:
     commonHdr = ()
     structure = ()
     debug = 0
+    # Cached __len__ and the structures whose cached __len__ depends on us
+    _size = None
+    _owners = None
 
     def __init__(self, data = None, alignment = 0):
         if not hasattr(self, 'alignment'):
@@ -93,9 +714,30 @@ class Structure:
 
     def setAlignment(self, alignment):
         self.alignment = alignment
+        self._invalidate()
 
     def setData(self, data):
         self.data = data
+        self._invalidate()
+
+    def _getPlan(self):
+        # The plan is cached in the class, as long as commonHdr and structure
+        # are the class ones. Instances changing their layout on the fly
+        # (e.g. depending on flags) get theirs from the _plans cache.
+        plan = self.__class__.__dict__.get('_plan')
+        if plan is not None and plan.commonHdr is self.commonHdr and plan.structure is self.structure:
+            return plan
+        key = (self.commonHdr, self.structure)
+        try:
+            plan = _plans[key]
+        except KeyError:
+            plan = _plans[key] = _StructurePlan(self.commonHdr, self.structure)
+        except TypeError:
+            # Unhashable layout, don't cache it
+            return _StructurePlan(self.commonHdr, self.structure)
+        if not (self.__dict__.has_key('commonHdr') or self.__dict__.has_key('structure')):
+            self.__class__._plan = plan
+        return plan
 
     def packField(self, fieldName, format = None):
         if self.debug:
@@ -117,6 +759,40 @@ class Structure:
     def getData(self):
         if self.data is not None:
             return self.data
+        if not _usesCodecs(self.__class__, ('pack', 'packField'), _plainPacking):
+            return self._getDataByHooks()
+        data = []
+        dataLen = 0
+        fields = self.fields
+        for fieldName, format, codec, dataClassOrCode, addressField, lengthField in self._getPlan().fields:
+            try:
+                if self.debug:
+                    res = self.packField(fieldName, format)
+                else:
+                    value = fields.get(fieldName)
+                    if fieldName and (addressField is not None) and (value is None):
+                        res = ''
+                    else:
+                        res = codec.pack(self, value)
+            except Exception, e:
+                if self.fields.has_key(fieldName):
+                    e.args += ("When packing field '%s | %s | %r' in %s" % (fieldName, format, self[fieldName], self.__class__),)
+                else:
+                    e.args += ("When packing field '%s | %s' in %s" % (fieldName, format, self.__class__),)
+                raise
+            data.append(res)
+            dataLen += len(res)
+            if self.alignment:
+                if dataLen % self.alignment:
+                    pad = ('\x00'*self.alignment)[:-(dataLen % self.alignment)]
+                    data.append(pad)
+                    dataLen += len(pad)
+            
+        #if len(data) % self.alignment: data += ('\x00'*self.alignment)[:-(len(data) % self.alignment)]
+        return ''.join(data)
+
+    def _getDataByHooks(self):
+        # getData() for subclasses overriding pack() or packField()
         data = ''
         for field in self.commonHdr+self.structure:
             try:
@@ -130,12 +806,53 @@ class Structure:
             if self.alignment:
                 if len(data) % self.alignment:
                     data += ('\x00'*self.alignment)[:-(len(data) % self.alignment)]
-            
-        #if len(data) % self.alignment: data += ('\x00'*self.alignment)[:-(len(data) % self.alignment)]
         return data
 
     def fromString(self, data):
+        # data may be anything sliceable as bytes (str, bytearray, memoryview,
+        # buffer, mmap). It's walked with an offset, the only copies made are
+        # the bytes of each field.
+        if not _usesCodecs(self.__class__, ('unpack', 'calcUnpackSize', 'calcPackSize'), _plainUnpacking):
+            return self._fromStringByHooks(data)
         self.rawData = data
+        offset = 0
+        length = len(data)
+        for fieldName, format, codec, dataClassOrCode, addressField, lengthField in self._getPlan().fields:
+            if self.debug:
+                print "fromString( %s | %s | %r )" % (fieldName, format, _slice(data, offset, length))
+            # An optional field (see the & specifier) not present in the data
+            if addressField is None or (not fieldName and codec.sizeKind == _VOID):
+                present = True
+            else:
+                present = self[addressField]
+            size = self._calcUnpackSize(codec, data, present, lengthField, offset, length)
+            if self.debug:
+                print "  size = %d" % size
+            try:
+                if fieldName and not present:
+                    self[fieldName] = None
+                else:
+                    start, stop = _bounds(length - offset, 0, size)
+                    self[fieldName] = codec.unpackFrom(self, data, offset+start, offset+stop, dataClassOrCode, fieldName)
+            except Exception,e:
+                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, format, _slice(data, offset, length), size),)
+                raise
+
+            if fieldName and not present:
+                size = 0
+            else:
+                size = codec.calcPackSize(self, self[fieldName])
+            if self.alignment and size % self.alignment:
+                size += self.alignment - (size % self.alignment)
+            offset += _bounds(length - offset, size, None)[0]
+
+        return self
+
+    def _fromStringByHooks(self, data):
+        # fromString() for subclasses overriding unpack(), calcUnpackSize()
+        # or calcPackSize()
+        self.rawData = data
+        data = _slice(data, 0, len(data))
         for field in self.commonHdr+self.structure:
             if self.debug:
                 print "fromString( %s | %s | %r )" % (field[0], field[1], data)
@@ -161,19 +878,60 @@ class Structure:
     def __setitem__(self, key, value):
         self.fields[key] = value
         self.data = None        # force recompute
+        if self._size is not None or self._owners:
+            self._invalidate()
 
     def __getitem__(self, key):
         return self.fields[key]
 
     def __delitem__(self, key):
         del self.fields[key]
+        if self._size is not None or self._owners:
+            self._invalidate()
         
     def __str__(self):
         return self.getData()
 
     def __len__(self):
-        # XXX: improve
-        return len(self.getData())
+        cached = self._size
+        if cached is not None:
+            size, lists, data, commonHdr, structure, alignment = cached
+            if data is self.data and commonHdr is self.commonHdr and structure is self.structure \
+               and alignment == self.alignment and _listsUnchanged(lists):
+                return size
+            self._size = None
+
+        size = len(self.getData())
+        lists = []
+        if self._trackSize(self, lists):
+            self._size = (size, lists, self.data, self.commonHdr, self.structure, self.alignment)
+        return size
+
+    def _trackSize(self, owner, lists):
+        if not _sizeTrackable(self.__class__):
+            return False
+        if owner is not self:
+            if self._owners is None:
+                self._owners = {}
+            self._owners[id(owner)] = weakref.ref(owner)
+        for value in self.fields.itervalues():
+            if not _trackValue(owner, value, lists):
+                return False
+        return True
+
+    def _invalidate(self):
+        self._size = None
+        owners = self._owners
+        if owners:
+            self._owners = None
+            _invalidateOwners(owners)
+
+    def __getstate__(self):
+        # Copies start without a cached size
+        state = self.__dict__.copy()
+        state.pop('_size', None)
+        state.pop('_owners', None)
+        return state
 
     def pack(self, format, data, field = None):
         if self.debug:
@@ -184,88 +942,7 @@ class Structure:
             if (addressField is not None) and (data is None):
                 return ''
 
-        # void specifier
-        if format[:1] == '_':
-            return ''
-
-        # quote specifier
-        if format[:1] == "'" or format[:1] == '"':
-            return format[1:]
-
-        # code specifier
-        two = format.split('=')
-        if len(two) >= 2:
-            try:
-                return self.pack(two[0], data)
-            except:
-                fields = {'self':self}
-                fields.update(self.fields)
-                return self.pack(two[0], eval(two[1], {}, fields))
-
-        # address specifier
-        two = format.split('&')
-        if len(two) == 2:
-            try:
-                return self.pack(two[0], data)
-            except:
-                if (self.fields.has_key(two[1])) and (self[two[1]] is not None):
-                    return self.pack(two[0], id(self[two[1]]) & ((1<<(calcsize(two[0])*8))-1) )
-                else:
-                    return self.pack(two[0], 0)
-
-        # length specifier
-        two = format.split('-')
-        if len(two) == 2:
-            try:
-                return self.pack(two[0],data)
-            except:
-                return self.pack(two[0], self.calcPackFieldSize(two[1]))
-
-        # array specifier
-        two = format.split('*')
-        if len(two) == 2:
-            answer = ''
-            for each in data:
-                answer += self.pack(two[1], each)
-            if two[0]:
-                if two[0].isdigit():
-                    if int(two[0]) != len(data):
-                        raise Exception, "Array field has a constant size, and it doesn't match the actual value"
-                else:
-                    return self.pack(two[0], len(data))+answer
-            return answer
-
-        # "printf" string specifier
-        if format[:1] == '%':
-            # format string like specifier
-            return format % data
-
-        # asciiz specifier
-        if format[:1] == 'z':
-            return str(data)+'\0'
-
-        # unicode specifier
-        if format[:1] == 'u':
-            return str(data)+'\0\0' + (len(data) & 1 and '\0' or '')
-
-        # DCE-RPC/NDR string specifier
-        if format[:1] == 'w':
-            if len(data) == 0:
-                data = '\0\0'
-            elif len(data) % 2:
-                data += '\0'
-            l = pack('<L', len(data)/2)
-            return '%s\0\0\0\0%s%s' % (l,l,data)
-                    
-        if data is None:
-            raise Exception, "Trying to pack None"
-        
-        # literal specifier
-        if format[:1] == ':':
-            return str(data)
-
-        # struct like specifier
-        return pack(format, data)
+        return _codecFor(format).pack(self, data)
 
     def unpack(self, format, data, dataClassOrCode = str, field = None):
         if self.debug:
@@ -277,85 +954,7 @@ class Structure:
                 if not self[addressField]:
                     return
 
-        # void specifier
-        if format[:1] == '_':
-            if dataClassOrCode != str:
-                fields = {'self':self, 'inputDataLeft':data}
-                fields.update(self.fields)
-                return eval(dataClassOrCode, {}, fields)
-            else:
-                return None
-
-        # quote specifier
-        if format[:1] == "'" or format[:1] == '"':
-            answer = format[1:]
-            if answer != data:
-                raise Exception, "Unpacked data doesn't match constant value '%r' should be '%r'" % (data, answer)
-            return answer
-
-        # address specifier
-        two = format.split('&')
-        if len(two) == 2:
-            return self.unpack(two[0],data)
-
-        # code specifier
-        two = format.split('=')
-        if len(two) >= 2:
-            return self.unpack(two[0],data)
-
-        # length specifier
-        two = format.split('-')
-        if len(two) == 2:
-            return self.unpack(two[0],data)
-
-        # array specifier
-        two = format.split('*')
-        if len(two) == 2:
-            answer = []
-            sofar = 0
-            if two[0].isdigit():
-                number = int(two[0])
-            elif two[0]:
-                sofar += self.calcUnpackSize(two[0], data)
-                number = self.unpack(two[0], data[:sofar])
-            else:
-                number = -1
-
-            while number and sofar < len(data):
-                nsofar = sofar + self.calcUnpackSize(two[1],data[sofar:])
-                answer.append(self.unpack(two[1], data[sofar:nsofar], dataClassOrCode))
-                number -= 1
-                sofar = nsofar
-            return answer
-
-        # "printf" string specifier
-        if format[:1] == '%':
-            # format string like specifier
-            return format % data
-
-        # asciiz specifier
-        if format == 'z':
-            if data[-1] != '\x00':
-                raise Exception, ("%s 'z' field is not NUL terminated: %r" % (field, data))
-            return data[:-1] # remove trailing NUL
-
-        # unicode specifier
-        if format == 'u':
-            if data[-2:] != '\x00\x00':
-                raise Exception, ("%s 'u' field is not NUL-NUL terminated: %r" % (field, data))
-            return data[:-2] # remove trailing NUL
-
-        # DCE-RPC/NDR string specifier
-        if format == 'w':
-            l = unpack('<L', data[:4])[0]
-            return data[12:12+l*2]
-
-        # literal specifier
-        if format == ':':
-            return dataClassOrCode(data)
-
-        # struct like specifier
-        return unpack(format, data)[0]
+        return _codecFor(format).unpack(self, data, dataClassOrCode, field)
 
     def calcPackSize(self, format, data, field = None):
 #        # print "  calcPackSize  %s:%r" %  (format, data)
@@ -365,152 +964,33 @@ class Structure:
                 if not self[addressField]:
                     return 0
 
-        # void specifier
-        if format[:1] == '_':
-            return 0
-
-        # quote specifier
-        if format[:1] == "'" or format[:1] == '"':
-            return len(format)-1
-
-        # address specifier
-        two = format.split('&')
-        if len(two) == 2:
-            return self.calcPackSize(two[0], data)
-
-        # code specifier
-        two = format.split('=')
-        if len(two) >= 2:
-            return self.calcPackSize(two[0], data)
-
-        # length specifier
-        two = format.split('-')
-        if len(two) == 2:
-            return self.calcPackSize(two[0], data)
-
-        # array specifier
-        two = format.split('*')
-        if len(two) == 2:
-            answer = 0
-            if two[0].isdigit():
-                    if int(two[0]) != len(data):
-                        raise Exception, "Array field has a constant size, and it doesn't match the actual value"
-            elif two[0]:
-                answer += self.calcPackSize(two[0], len(data))
-
-            for each in data:
-                answer += self.calcPackSize(two[1], each)
-            return answer
-
-        # "printf" string specifier
-        if format[:1] == '%':
-            # format string like specifier
-            return len(format % data)
-
-        # asciiz specifier
-        if format[:1] == 'z':
-            return len(data)+1
-
-        # asciiz specifier
-        if format[:1] == 'u':
-            l = len(data)
-            return l + (l & 1 and 3 or 2)
-
-        # DCE-RPC/NDR string specifier
-        if format[:1] == 'w':
-            l = len(data)
-            return 12+l+l % 2
-
-        # literal specifier
-        if format[:1] == ':':
-            return len(data)
-
-        # struct like specifier
-        return calcsize(format)
+        return _codecFor(format).calcPackSize(self, data)
 
     def calcUnpackSize(self, format, data, field = None):
         if self.debug:
             print "  calcUnpackSize( %s | %s | %r)" %  (field, format, data)
 
-        # void specifier
-        if format[:1] == '_':
+        codec = _codecFor(format)
+        if codec.sizeKind == _VOID:
             return 0
-
         addressField = self.findAddressFieldFor(field)
-        if addressField is not None:
-            if not self[addressField]:
-                return 0
-
-        try:
-            lengthField = self.findLengthFieldFor(field)
-            return self[lengthField]
-        except:
-            pass
-
-        # XXX: Try to match to actual values, raise if no match
-        
-        # quote specifier
-        if format[:1] == "'" or format[:1] == '"':
-            return len(format)-1
-
-        # address specifier
-        two = format.split('&')
-        if len(two) == 2:
-            return self.calcUnpackSize(two[0], data)
-
-        # code specifier
-        two = format.split('=')
-        if len(two) >= 2:
-            return self.calcUnpackSize(two[0], data)
-
-        # length specifier
-        two = format.split('-')
-        if len(two) == 2:
-            return self.calcUnpackSize(two[0], data)
-
-        # array specifier
-        two = format.split('*')
-        if len(two) == 2:
-            answer = 0
-            if two[0]:
-                if two[0].isdigit():
-                    number = int(two[0])
-                else:
-                    answer += self.calcUnpackSize(two[0], data)
-                    number = self.unpack(two[0], data[:answer])
-
-                while number:
-                    number -= 1
-                    answer += self.calcUnpackSize(two[1], data[answer:])
-            else:
-                while answer < len(data):
-                    answer += self.calcUnpackSize(two[1], data[answer:])
-            return answer
+        return self._calcUnpackSize(codec, data, (addressField is None) or self[addressField], self.findLengthFieldFor(field), 0, len(data))
 
-        # "printf" string specifier
-        if format[:1] == '%':
-            raise Exception, "Can't guess the size of a printf like specifier for unpacking"
-
-        # asciiz specifier
-        if format[:1] == 'z':
-            return data.index('\x00')+1
-
-        # asciiz specifier
-        if format[:1] == 'u':
-            l = data.index('\x00\x00')
-            return l + (l & 1 and 3 or 2)
+    def _calcUnpackSize(self, codec, data, present, lengthField, offset, end):
+        # void specifier
+        if codec.sizeKind == _VOID:
+            return 0
 
-        # DCE-RPC/NDR string specifier
-        if format[:1] == 'w':
-            l = unpack('<L', data[:4])[0]
-            return 12+l*2
+        if not present:
+            return 0
 
-        # literal specifier
-        if format[:1] == ':':
-            return len(data)
+        if lengthField is not None:
+            try:
+                return self[lengthField]
+            except:
+                pass
 
-        # struct like specifier
-        return calcsize(format)
+        return codec.calcUnpackSizeFrom(self, data, offset, end)
 
     def calcPackFieldSize(self, fieldName, format = None):
         if format is None:
@@ -519,26 +999,16 @@ class Structure:
         return self.calcPackSize(format, self[fieldName])
 
     def formatForField(self, fieldName):
-        for field in self.commonHdr+self.structure:
-            if field[0] == fieldName:
-                return field[1]
-        raise Exception, ("Field %s not found" % fieldName)
+        try:
+            return self._getPlan().formats[fieldName]
+        except KeyError:
+            raise Exception, ("Field %s not found" % fieldName)
 
     def findAddressFieldFor(self, fieldName):
-        descriptor = '&%s' % fieldName
-        l = len(descriptor)
-        for field in self.commonHdr+self.structure:
-            if field[1][-l:] == descriptor:
-                return field[0]
-        return None
+        return self._getPlan().addressFields.get('%s' % fieldName)
         
     def findLengthFieldFor(self, fieldName):
-        descriptor = '-%s' % fieldName
-        l = len(descriptor)
-        for field in self.commonHdr+self.structure:
-            if field[1][-l:] == descriptor:
-                return field[0]
-        return None
+        return self._getPlan().lengthFields.get('%s' % fieldName)
         
     def zeroValue(self, format):
         two = format.split('*')
@@ -609,6 +1079,34 @@ class _StructureTest:
         if b_str != a_str:
             print "ERROR: original packed and repacked don't match"
             print "packed: %r" % b_str
+        self.throughput(a_str)
+
+    def throughput(self, a_str, count = 2000):
+        # Rough numbers on how many times per second we can pack/unpack this
+        # structure. Handy to compare changes in the codec.
+        b = self.create(a_str)
+        start = time.time()
+        for i in xrange(count):
+            b.data = None
+            b.getData()
+        packTime = max(time.time() - start, 1e-6)
+        start = time.time()
+        for i in xrange(count):
+            self.create(a_str)
+        unpackTime = max(time.time() - start, 1e-6)
+        print "throughput: %d packs/sec, %d unpacks/sec" % (count/packTime, count/unpackTime)
+
+    def check(self, what, value, expected):
+        if value != expected:
+            print "ERROR: %s is %r, should be %r" % (what, value, expected)
+            raise Exception(self.__class__.__name__)
+
+    def outcome(self, call, *args):
+        # What call(*args) returns, or the class of what it raises
+        try:
+            return call(*args)
+        except Exception, e:
+            return e.__class__
 
 class _Test_simple(_StructureTest):
     class theClass(Structure):
@@ -707,6 +1205,210 @@ class _Test_UnpackCode(_StructureTest):
         a['uno'] = 'soy un loco!'
         a['dos'] = 'que haces fiera'
 
+class _Test_packHooks(_StructureTest):
+    # pack() and unpack() overridden in a subclass get called for every field
+    class theClass(Structure):
+        structure = (
+            ('len','<H-data'),
+            ('data',':'),
+            ('tail','<L'),
+        )
+
+        def pack(self, format, data, field = None):
+            if field == 'data':
+                data = data.encode('rot13')
+            return Structure.pack(self, format, data, field)
+
+        def unpack(self, format, data, dataClassOrCode = str, field = None):
+            answer = Structure.unpack(self, format, data, dataClassOrCode, field)
+            if field == 'data':
+                answer = answer.decode('rot13')
+            return answer
+
+    def populate(self, a):
+        a['data'] = 'hola manola'
+        a['tail'] = 0x12345678
+
+    def run(self):
+        _StructureTest.run(self)
+        a = self.create()
+        self.populate(a)
+        self.check('packed', str(a), pack('<H', 11) + 'ubyn znabyn' + pack('<L', 0x12345678))
+        b = self.create(buffer(str(a)))
+        self.check('unpacked', b['data'], 'hola manola')
+        self.check('unpacked tail', b['tail'], 0x12345678)
+
+class _Test_unpackFrom(_StructureTest):
+    # Fields unpacked out of a bigger buffer, at an offset, must come out
+    # the same as when unpacked out of a copy of their own bytes
+    class theClass(Structure):
+        class _Inner(Structure):
+            structure = (
+                ('len','<H-data'),
+                ('data',':'),
+                ('name','z'),
+            )
+
+        structure = (
+            ('head','<L'),
+            ('nest1', ':', _Inner),
+            ('nest2', ':', _Inner),
+            ('list','<H*<L'),
+            ('tail','z'),
+        )
+
+    def populate(self, a):
+        a['head'] = 0x12345678
+        a['nest1'] = _Test_unpackFrom.theClass._Inner()
+        a['nest1']['data'] = 'hola'
+        a['nest1']['name'] = 'manola'
+        a['nest2'] = _Test_unpackFrom.theClass._Inner()
+        a['nest2']['data'] = ''
+        a['nest2']['name'] = 'te traje'
+        a['list'] = (1,2,3)
+        a['tail'] = 'chau'
+
+    def run(self):
+        _StructureTest.run(self)
+        a = self.create()
+        self.populate(a)
+        a_str = str(a)
+        for kind in (bytearray, buffer, memoryview):
+            b = self.create(kind(a_str))
+            self.check('%s repacked' % kind.__name__, str(b), a_str)
+            self.check('%s nest2 name' % kind.__name__, b['nest2']['name'], 'te traje')
+
+        buf = 'pre' + a_str + 'post'
+        end = 3 + len(a_str)
+        for format, dataClass in ((':', self.theClass._Inner), (':', self.theClass), ('z', str), ('<H-data', str), ('<H*<L', str), ('*<L', str)):
+            codec = _codecFor(format)
+            for offset in range(end+1):
+                what = '%r at %d' % (format, offset)
+                self.check('size of ' + what, self.outcome(codec.calcUnpackSizeFrom, a, buf, offset, end),
+                           self.outcome(codec.calcUnpackSize, a, buf[offset:end]))
+                value = self.outcome(codec.unpackFrom, a, buf, offset, end, dataClass)
+                expected = self.outcome(codec.unpack, a, buf[offset:end], dataClass)
+                if isinstance(expected, Structure):
+                    self.check(what, str(value), str(expected))
+                else:
+                    self.check(what, value, expected)
+        b = _codecFor(':').unpackFrom(a, buf, 3, end, self.theClass)
+        self.check('nested at 3', str(b), a_str)
+        self.check('nested at 3 nest1 data', b['nest1']['data'], 'hola')
+
+class _Test_bulkArrays(_StructureTest):
+    # Arrays of fixed size items are unpacked all at once. Whatever the data,
+    # they must come out as they did element by element
+    class theClass(Structure):
+        structure = (
+            ('list','<H*<L'),
+            ('rest','*<3s'),
+        )
+
+    def populate(self, a):
+        a['list'] = (1,2,3)
+        a['rest'] = ('abc','def')
+
+    def run(self):
+        _StructureTest.run(self)
+        a = self.create()
+        data = ''.join(map(chr, range(64)))
+        for format in ('*<L', '*B', '*<3s', '3*<L', '<H*<H', 'B*>L'):
+            bulk = _codecFor(format)
+            itemByItem = _FieldCodec(format)
+            itemByItem.bulkFormat = None
+            if bulk.countCodec is not None:
+                counts = range(10)
+            else:
+                counts = (None,)
+            for count in counts:
+                # Counts up to larger than the data, bodies ending in a
+                # partial item
+                for length in range(14):
+                    if count is None:
+                        buf = 'xyz' + data[:length]
+                    else:
+                        buf = 'xyz' + bulk.countCodec.pack(a, count) + data[:length]
+                    what = '%r count %r length %d' % (format, count, length)
+                    self.check(what, self.outcome(bulk.unpackFrom, a, buf, 3, len(buf)),
+                               self.outcome(itemByItem.unpackFrom, a, buf, 3, len(buf)))
+                    self.check(what, self.outcome(bulk.unpack, a, buf[3:]),
+                               self.outcome(itemByItem.unpack, a, buf[3:]))
+                    self.check('size of ' + what, self.outcome(bulk.calcUnpackSizeFrom, a, buf, 3, len(buf)),
+                               self.outcome(itemByItem.calcUnpackSizeFrom, a, buf, 3, len(buf)))
+
+        # Structures with a partial trailing item, or a count past the data
+        b = self.create(pack('<H', 2) + pack('<LL', 7, 8) + 'abcdef')
+        self.check('list', b['list'], [7, 8])
+        self.check('rest', b['rest'], ['abc', 'def'])
+        self.check('partial item', self.outcome(self.create, pack('<H', 2) + pack('<LL', 7, 8) + 'abcdefgh'), StructError)
+        b = self.create(pack('<H', 5) + pack('<LL', 7, 8))
+        self.check('list past the data', b['list'], [7, 8])
+        self.check('rest past the data', b['rest'], [])
+
+class _Test_cachedSize(_StructureTest):
+    # len() is cached, getData() and len() must follow every change made
+    # after it was
+    class theClass(Structure):
+        class _Inner(Structure):
+            structure = (
+                ('len','<H-data'),
+                ('data',':'),
+                ('list','B*B'),
+            )
+
+        structure = (
+            ('list','<H*<L'),
+            ('nest', ':', _Inner),
+            ('name','z'),
+        )
+
+    def inner(self, data, list):
+        answer = self.theClass._Inner()
+        answer['data'] = data
+        answer['list'] = list
+        return answer
+
+    def populate(self, a):
+        a['list'] = [1,2,3]
+        a['nest'] = self.inner('hola', [4,5])
+        a['name'] = 'manola'
+
+    def expected(self, a):
+        nest = a['nest']
+        answer = pack('<H', len(a['list'])) + ''.join(pack('<L', x) for x in a['list'])
+        answer += pack('<H', len(nest['data'])) + nest['data'] + pack('B', len(nest['list'])) + ''.join(map(chr, nest['list']))
+        return answer + a['name'] + '\x00'
+
+    def run(self):
+        _StructureTest.run(self)
+        a = self.create()
+        self.populate(a)
+        old = a['nest']
+        for what, change in (
+            ('field set', lambda: a.__setitem__('name', 'te traje')),
+            ('list appended to', lambda: a['list'].append(4)),
+            ('list item set', lambda: a['list'].__setitem__(0, 0x41414141)),
+            ('list emptied', lambda: a['list'].__delslice__(0, 10)),
+            ('nested field set', lambda: a['nest'].__setitem__('data', 'chau loco')),
+            ('nested list appended to', lambda: a['nest']['list'].append(6)),
+            ('nested replaced', lambda: a.__setitem__('nest', self.inner('x', [9]))),
+            ('new nested field set', lambda: a['nest'].__setitem__('data', 'que haces fiera')),
+            ('new nested list set', lambda: a['nest'].__setitem__('list', [])),
+            ('old nested field set', lambda: old.__setitem__('data', 'not packed anymore')),
+        ):
+            len(a)
+            change()
+            self.check('len() after ' + what, len(a), len(self.expected(a)))
+            self.check('getData() after ' + what, a.getData(), self.expected(a))
+
+        len(a)
+        a.setAlignment(4)
+        self.check('len() after setAlignment', len(a), len(a.getData()))
+        a.setData('raw')
+        self.check('len() after setData', len(a), 3)
+        self.check('getData() after setData', a.getData(), 'raw')
+
 class _Test_AAA(_StructureTest):
     class theClass(Structure):
         commonHdr = ()
@@ -743,4 +1445,8 @@ if __name__ == '__main__':
     _Test_Optional_sparse().run()
     _Test_AsciiZArray().run()
     _Test_UnpackCode().run()
+    _Test_packHooks().run()
+    _Test_unpackFrom().run()
+    _Test_bulkArrays().run()
+    _Test_cachedSize().run()
     _Test_AAA().run()
@@ -1,6 +1,10 @@
 import unittest
 import ConfigParser
-from impacket.dcerpc.v5 import transport, epm, rpcrt
+import time
+import socket
+import threading
+from impacket import smb, smbserver
+from impacket.dcerpc.v5 import transport, epm, rpcrt, asyncrpc, pool, mgmt, samr, srvs, instrumentation
 from impacket.dcerpc.v5.dtypes import NULL
 
 # aimed at testing just the DCERPC engine, not the particular
@@ -431,6 +435,155 @@ class DCERPCTests(unittest.TestCase):
         resp = epm.hept_lookup(self.machine)
         dce.disconnect()
 
+    def test_pipelinedCalls(self):
+        rpctransport = transport.DCERPCTransportFactory(self.stringBinding)
+        if hasattr(rpctransport, 'set_credentials'):
+            # This method exists only for selected protocol sequences.
+            rpctransport.set_credentials(self.username, self.password, self.domain)
+        dce = rpctransport.get_dce_rpc()
+        dce.connect()
+        dce.bind(epm.MSRPC_UUID_PORTMAP)
+        requests = []
+        for i in range(20):
+            request = epm.ept_lookup()
+            request['inquiry_type'] = epm.RPC_C_EP_ALL_ELTS
+            request['object'] = NULL
+            request['Ifid'] = NULL
+            request['vers_option'] = epm.RPC_C_VERS_ALL
+            request['max_ents'] = 1
+            requests.append(request)
+        dce.set_max_pending(5)
+        calls = dce.batch(requests)
+        for call in calls:
+            resp = call.result()
+            self.assertTrue(resp['num_ents'] == 1)
+        resp = dce.request(requests[0])
+        dce.disconnect()
+
+    def test_pipelinedCallsWINNTPacketPrivacy(self):
+        rpctransport = transport.DCERPCTransportFactory(self.stringBinding)
+        if hasattr(rpctransport, 'set_credentials'):
+            # This method exists only for selected protocol sequences.
+            rpctransport.set_credentials(self.username, self.password, self.domain)
+        dce = rpctransport.get_dce_rpc()
+        dce.set_credentials(*(rpctransport.get_credentials()))
+        dce.connect()
+        dce.set_auth_type(rpcrt.RPC_C_AUTHN_WINNT)
+        dce.set_auth_level(rpcrt.RPC_C_AUTHN_LEVEL_PKT_PRIVACY)
+        dce.bind(epm.MSRPC_UUID_PORTMAP)
+        calls = []
+        for i in range(5):
+            request = epm.ept_lookup()
+            request['inquiry_type'] = epm.RPC_C_EP_ALL_ELTS
+            request['object'] = NULL
+            request['Ifid'] = NULL
+            request['vers_option'] = epm.RPC_C_VERS_ALL
+            request['max_ents'] = 1
+            calls.append(dce.submit(request))
+        for call in dce.collect(calls):
+            resp = call.result()
+            self.assertTrue(resp['num_ents'] == 1)
+        dce.disconnect()
+
+    def test_bindMultipleInterfaces(self):
+        rpctransport = transport.DCERPCTransportFactory(self.stringBinding)
+        if hasattr(rpctransport, 'set_credentials'):
+            # This method exists only for selected protocol sequences.
+            rpctransport.set_credentials(self.username, self.password, self.domain)
+        dce = rpctransport.get_dce_rpc()
+        dce.connect()
+        dce.bind(epm.MSRPC_UUID_PORTMAP, extra_uuids = [mgmt.MSRPC_UUID_MGMT])
+        self.assertTrue(dce.has_interface(mgmt.MSRPC_UUID_MGMT))
+        dce.set_interface(mgmt.MSRPC_UUID_MGMT)
+        resp = mgmt.hinq_if_ids(dce)
+        dce.set_interface(epm.MSRPC_UUID_PORTMAP)
+        request = epm.ept_lookup()
+        request['inquiry_type'] = epm.RPC_C_EP_ALL_ELTS
+        request['object'] = NULL
+        request['Ifid'] = NULL
+        request['vers_option'] = epm.RPC_C_VERS_ALL
+        request['max_ents'] = 1
+        resp = dce.request(request)
+        dce.disconnect()
+
+    def test_pool(self):
+        rpcPool = pool.DCERPCPool()
+        dce = rpcPool.get(self.stringBinding, epm.MSRPC_UUID_PORTMAP, self.username, self.password, self.domain)
+        request = epm.ept_lookup()
+        request['inquiry_type'] = epm.RPC_C_EP_ALL_ELTS
+        request['object'] = NULL
+        request['Ifid'] = NULL
+        request['vers_option'] = epm.RPC_C_VERS_ALL
+        request['max_ents'] = 1
+        resp = dce.request(request)
+        rpcPool.release(dce)
+        dce2 = rpcPool.get(self.stringBinding, epm.MSRPC_UUID_PORTMAP, self.username, self.password, self.domain)
+        self.assertTrue(dce is dce2)
+        resp = dce2.request(request)
+        rpcPool.release(dce2)
+        rpcPool.close()
+
+    def test_poolAlterCtx(self):
+        rpcPool = pool.DCERPCPool()
+        dce = rpcPool.get(self.stringBinding, epm.MSRPC_UUID_PORTMAP, self.username, self.password, self.domain)
+        rpcPool.release(dce)
+        dce2 = rpcPool.get(self.stringBinding, mgmt.MSRPC_UUID_MGMT, self.username, self.password, self.domain)
+        self.assertTrue(dce2 is not dce)
+        self.assertTrue(dce2.get_rpc_transport() is dce.get_rpc_transport())
+        resp = mgmt.hinq_if_ids(dce2)
+        rpcPool.release(dce2)
+        dce3 = rpcPool.get(self.stringBinding, epm.MSRPC_UUID_PORTMAP, self.username, self.password, self.domain)
+        self.assertTrue(dce3 is dce)
+        rpcPool.release(dce3)
+        rpcPool.close()
+
+    def test_poolDiscard(self):
+        rpcPool = pool.DCERPCPool()
+        dce = rpcPool.get(self.stringBinding, epm.MSRPC_UUID_PORTMAP, self.username, self.password, self.domain)
+        rpcPool.discard(dce)
+        dce2 = rpcPool.get(self.stringBinding, epm.MSRPC_UUID_PORTMAP, self.username, self.password, self.domain)
+        self.assertTrue(dce2 is not dce)
+        resp = mgmt.hinq_if_ids(dce2.alter_ctx(mgmt.MSRPC_UUID_MGMT))
+        rpcPool.release(dce2)
+        rpcPool.close()
+
+    def test_poolEviction(self):
+        rpcPool = pool.DCERPCPool(maxIdleTime = 1)
+        dce = rpcPool.get(self.stringBinding, epm.MSRPC_UUID_PORTMAP, self.username, self.password, self.domain)
+        rpcPool.release(dce)
+        time.sleep(2)
+        dce2 = rpcPool.get(self.stringBinding, epm.MSRPC_UUID_PORTMAP, self.username, self.password, self.domain)
+        self.assertTrue(dce2 is not dce)
+        rpcPool.release(dce2)
+        rpcPool.evict(0)
+        dce3 = rpcPool.get(self.stringBinding, epm.MSRPC_UUID_PORTMAP, self.username, self.password, self.domain)
+        self.assertTrue(dce3 is not dce2)
+        rpcPool.release(dce3)
+        rpcPool.close()
+
+    def test_instrumentation(self):
+        stats = instrumentation.RPCStats()
+        rpctransport = transport.DCERPCTransportFactory(self.stringBinding)
+        dce = rpctransport.get_dce_rpc()
+        dce.set_instrumentation(stats)
+        dce.connect()
+        dce.bind(epm.MSRPC_UUID_PORTMAP)
+        request = epm.ept_lookup()
+        request['inquiry_type'] = epm.RPC_C_EP_ALL_ELTS
+        request['object'] = NULL
+        request['Ifid'] = NULL
+        request['vers_option'] = epm.RPC_C_VERS_ALL
+        request['max_ents'] = 1
+        for i in range(3):
+            resp = dce.request(request)
+        dce.disconnect()
+        data = stats.getData()
+        self.assertTrue(data['binds'][0]['binds'] == 1)
+        self.assertTrue(data['calls'][0]['opnum'] == request.opnum)
+        self.assertTrue(data['calls'][0]['calls'] == 3)
+        self.assertTrue(data['calls'][0]['latency']['count'] == 3)
+        self.assertTrue('impacket_dcerpc_calls_total{' in stats.toPrometheus())
+
 class TCPTransport(DCERPCTests):
     def setUp(self):
         DCERPCTests.setUp(self)
@@ -447,6 +600,197 @@ class TCPTransport(DCERPCTests):
         self.aesKey128= configFile.get('TCPTransport', 'aesKey128')
         self.stringBinding = r'ncacn_ip_tcp:%s' % self.machine
 
+    def test_asyncCalls(self):
+        def lookups(loop, answers):
+            rpctransport = asyncrpc.DCERPCTransportFactory(loop, self.stringBinding)
+            dce = rpctransport.get_dce_rpc()
+            yield dce.connect()
+            yield dce.bind(epm.MSRPC_UUID_PORTMAP)
+            futures = []
+            for i in range(5):
+                request = epm.ept_lookup()
+                request['inquiry_type'] = epm.RPC_C_EP_ALL_ELTS
+                request['object'] = NULL
+                request['Ifid'] = NULL
+                request['vers_option'] = epm.RPC_C_VERS_ALL
+                request['max_ents'] = 1
+                futures.append(dce.request(request))
+            for future in futures:
+                resp = yield future
+                answers.append(resp['num_ents'])
+            yield dce.disconnect()
+
+        loop = asyncrpc.EventLoop()
+        answers = []
+        tasks = [loop.spawn(lookups(loop, answers)) for i in range(3)]
+        loop.run()
+        for task in tasks:
+            task.result()
+        self.assertTrue(answers == [1]*15)
+
+    def test_serverConcurrentClients(self):
+        # A local server this time, answering SamrCloseHandle with the handle it got
+        def closeHandle(data):
+            return data[:20] + '\x00\x00\x00\x00'
+        server = rpcrt.DCERPCServer()
+        server.addCallbacks(('12345778-1234-ABCD-EF00-0123456789AC', '1.0'), '\\PIPE\\samr', {1: closeHandle})
+        server.daemon = True
+        server.start()
+        time.sleep(0.1)
+
+        def closes(loop, client, answers):
+            rpctransport = asyncrpc.TCPTransport(loop, '127.0.0.1', server.getListenPort())
+            dce = rpctransport.get_dce_rpc()
+            yield dce.connect()
+            yield dce.bind(samr.MSRPC_UUID_SAMR)
+            futures = []
+            for i in range(10):
+                request = samr.SamrCloseHandle()
+                request['SamHandle'] = chr(client) + chr(i) * 19
+                futures.append(dce.request(request))
+            for future in futures:
+                resp = yield future
+                answers.append(resp['SamHandle'][:2])
+            yield dce.disconnect()
+
+        loop = asyncrpc.EventLoop()
+        answers = []
+        tasks = [loop.spawn(closes(loop, client, answers)) for client in range(50)]
+        loop.run()
+        for task in tasks:
+            task.result()
+        self.assertTrue(sorted(answers) == sorted([chr(client) + chr(i) for client in range(50) for i in range(10)]))
+
+    def test_serverNamedPipe(self):
+        # A local SMB server this time, serving \srvsvc from its SRVSServer in-process
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        server = smbserver.SimpleSMBServer('127.0.0.1', port)
+        for i in range(50):
+            server.addShare('SHARE%d' % i, '.', 'Share number %d' % i)
+        serverThread = threading.Thread(target = server.start)
+        serverThread.daemon = True
+        serverThread.start()
+        time.sleep(0.1)
+
+        rpctransport = transport.SMBTransport('127.0.0.1', port, r'\srvsvc')
+        rpctransport.preferred_dialect(smb.SMB_DIALECT)
+        dce = rpctransport.get_dce_rpc()
+        dce.connect()
+        dce.bind(srvs.MSRPC_UUID_SRVS)
+        resp = srvs.hNetrShareEnum(dce, 1)
+        names = [share['shi1_netname'][:-1] for share in resp['InfoStruct']['ShareInfo']['Level1']['Buffer']]
+        self.assertTrue(sorted(names) == sorted(['IPC$'] + ['SHARE%d' % i for i in range(50)]))
+        # The same, the request split in fragments
+        dce.set_max_fragment_size(16)
+        resp = srvs.hNetrShareEnum(dce, 1)
+        self.assertTrue(resp['TotalEntries'] == 51)
+        dce.disconnect()
+
+    def test_serverAlterCtxRejected(self):
+        server = rpcrt.DCERPCServer()
+        server.addCallbacks(('12345778-1234-ABCD-EF00-0123456789AC', '1.0'), '\\PIPE\\samr', {1: lambda data: data[:20] + '\x00\x00\x00\x00'})
+        server.daemon = True
+        server.start()
+        time.sleep(0.1)
+        rpctransport = transport.TCPTransport('127.0.0.1', server.getListenPort())
+        dce = rpctransport.get_dce_rpc()
+        dce.connect()
+        dce.bind(samr.MSRPC_UUID_SAMR)
+        # Answered with the context rejected, the association goes on
+        self.assertRaises(rpcrt.Exception, dce.alter_ctx, mgmt.MSRPC_UUID_MGMT)
+        request = samr.SamrCloseHandle()
+        request['SamHandle'] = 'A' * 20
+        resp = dce.request(request)
+        self.assertTrue(resp['SamHandle'] == 'A' * 20)
+        dce.disconnect()
+
+    def test_serverWithoutAssociation(self):
+        # bind() and processRequest() as subclasses of the one client server
+        # call them: raw PDUs, no association
+        server = rpcrt.DCERPCServer()
+        server.addCallbacks(('12345778-1234-ABCD-EF00-0123456789AC', '1.0'), '\\PIPE\\samr', {1: lambda data: data[:20] + '\x00\x00\x00\x00'})
+        bind = rpcrt.MSRPCBind()
+        item = rpcrt.CtxItem()
+        item['AbstractSyntax'] = samr.MSRPC_UUID_SAMR
+        item['TransferSyntax'] = rpcrt.uuidtup_to_bin(('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0'))
+        item['ContextID'] = 0
+        item['TransItems'] = 1
+        bind.addCtxItem(item)
+        packet = rpcrt.MSRPCHeader()
+        packet['type'] = rpcrt.MSRPC_BIND
+        packet['pduData'] = str(bind)
+        packet['call_id'] = 1
+        resp = server.processRequest(packet.get_packet())
+        self.assertTrue(resp['type'] == rpcrt.MSRPC_BINDACK)
+        self.assertTrue(server._boundUUID == samr.MSRPC_UUID_SAMR)
+        request = rpcrt.MSRPCRequestHeader()
+        request['type'] = rpcrt.MSRPC_REQUEST
+        request['call_id'] = 2
+        request['ctx_id'] = 0
+        request['op_num'] = 1
+        request['pduData'] = 'A' * 20
+        resp = server.processRequest(request.get_packet())
+        self.assertTrue(resp['type'] == rpcrt.MSRPC_RESPONSE)
+        self.assertTrue(resp['pduData'] == 'A' * 20 + '\x00\x00\x00\x00')
+
+    def test_errorAnswer(self):
+        # SamrEnumerateUsersInDomain answered with just an error code, too
+        # short to unpack as a response
+        server = rpcrt.DCERPCServer()
+        server.addCallbacks(('12345778-1234-ABCD-EF00-0123456789AC', '1.0'), '\\PIPE\\samr', {13: lambda data: '\x22\x00\x00\xc0'})
+        server.daemon = True
+        server.start()
+        time.sleep(0.1)
+        rpctransport = transport.TCPTransport('127.0.0.1', server.getListenPort())
+        dce = rpctransport.get_dce_rpc()
+        dce.connect()
+        dce.bind(samr.MSRPC_UUID_SAMR)
+        request = samr.SamrEnumerateUsersInDomain()
+        request['DomainHandle'] = 'A' * 20
+        request['EnumerationContext'] = 0
+        request['UserAccountControl'] = 0
+        request['PreferedMaximumLength'] = 0xffffffff
+        try:
+            dce.request(request)
+        except samr.DCERPCSessionError, e:
+            self.assertTrue(e.get_error_code() == 0xC0000022)
+        else:
+            self.fail('no DCERPCSessionError raised')
+        dce.disconnect()
+
+    def test_serverAsyncAlterCtx(self):
+        server = rpcrt.DCERPCServer()
+        server.addCallbacks(('12345778-1234-ABCD-EF00-0123456789AC', '1.0'), '\\PIPE\\samr', {1: lambda data: data[:20] + '\x00\x00\x00\x00'})
+        server.addCallbacks(('AFA8BD80-7D8A-11C9-BEF4-08002B102989', '1.0'), '\\PIPE\\mgmt', {1: lambda data: 'M' * 20 + '\x00\x00\x00\x00'})
+        server.daemon = True
+        server.start()
+        time.sleep(0.1)
+
+        def closes(loop, answers):
+            rpctransport = asyncrpc.TCPTransport(loop, '127.0.0.1', server.getListenPort())
+            dce = rpctransport.get_dce_rpc()
+            yield dce.connect()
+            yield dce.bind(samr.MSRPC_UUID_SAMR)
+            context = yield dce.alter_ctx(mgmt.MSRPC_UUID_MGMT)
+            request = samr.SamrCloseHandle()
+            request['SamHandle'] = 'A' * 20
+            # Each one to the interface it was asked for
+            futures = [context.request(request), dce.request(request)]
+            for future in futures:
+                resp = yield future
+                answers.append(resp['SamHandle'])
+            yield dce.disconnect()
+
+        loop = asyncrpc.EventLoop()
+        answers = []
+        task = loop.spawn(closes(loop, answers))
+        loop.run()
+        task.result()
+        self.assertTrue(answers == ['M' * 20, 'A' * 20])
+
 class SMBTransport(DCERPCTests):
     def setUp(self):
         # Put specific configuration for target machine with SMB_002
@@ -463,6 +807,24 @@ class SMBTransport(DCERPCTests):
         self.aesKey128= configFile.get('SMBTransport', 'aesKey128')
         self.stringBinding = r'ncacn_np:%s[\pipe\epmapper]' % self.machine
 
+    def test_poolSMBSession(self):
+        rpcPool = pool.DCERPCPool()
+        dce = rpcPool.get(self.stringBinding, epm.MSRPC_UUID_PORTMAP, self.username, self.password, self.domain)
+        dce2 = rpcPool.get(r'ncacn_np:%s[\pipe\samr]' % self.machine, samr.MSRPC_UUID_SAMR, self.username, self.password, self.domain)
+        smbConnection = dce.get_rpc_transport().get_smb_connection()
+        smbConnection2 = dce2.get_rpc_transport().get_smb_connection()
+        if smbConnection.getDialect() == smb.SMB_DIALECT:
+            # No dispatcher for SMB1 sessions, they aren't shared
+            self.assertTrue(smbConnection is not smbConnection2)
+        else:
+            self.assertTrue(smbConnection is smbConnection2)
+            self.assertTrue(smbConnection.getSMBServer().isDispatching())
+        # The session must outlive the association discarded
+        rpcPool.discard(dce)
+        resp = samr.hSamrConnect(dce2)
+        rpcPool.release(dce2)
+        rpcPool.close()
+
 if __name__ == "__main__":
     import sys
     if len(sys.argv) > 1:
@@ -1,8 +1,10 @@
 import unittest
-from impacket import smb
+from impacket import smb, smb3, nmb, crypto
 from impacket.smbconnection import *
 from impacket.smb3structs import *
-import time, ntpath
+from impacket.nt_errors import STATUS_SUCCESS, STATUS_INVALID_SIGNATURE
+import time, ntpath, os, StringIO, threading, hmac, hashlib, socket
+from struct import pack, unpack
 
 # IMPORTANT NOTE:
 # For some reason, under Windows 8, you cannot switch between
@@ -103,6 +105,49 @@ class SMBTests(unittest.TestCase):
         
         smb.logoff()
          
+    def test_compoundRequests(self):
+        smb = SMBConnection('*SMBSERVER', self.machine, preferredDialect = self.dialects)
+        if smb.getDialect() == SMB_DIALECT:
+            # SMB2 and up only
+            return
+        smb.login(self.username, self.password, self.domain)
+        tid = smb.connectTree(self.share)
+        fid = smb.createFile(tid, self.file)
+        smb.writeFile(tid, fid, "A"*1000)
+        smb.closeFile(tid,fid)
+        data = smb.getSMBServer().readSmallFile(tid, self.file)
+        self.assertTrue(data == "A"*1000)
+        # SMB2_FILE_STANDARD_INFO, EndOfFile after AllocationSize
+        info = smb.getSMBServer().queryPathInfo(tid, self.file)
+        self.assertTrue(info[8:16] == pack('<Q', 1000))
+        smb.deleteFile(self.share, self.file)
+        smb.disconnectTree(tid)
+        smb.logoff()
+
+    def test_sharedSession(self):
+        smb = SMBConnection('*SMBSERVER', self.machine, preferredDialect = self.dialects)
+        if smb.getDialect() == SMB_DIALECT:
+            # SMB2 and up only
+            return
+        smb.login(self.username, self.password, self.domain)
+        data = os.urandom(300000)
+        smb.putFile(self.share, self.file, StringIO.StringIO(data).read)
+        smb.getSMBServer().startDispatcher()
+        results = []
+        def download():
+            out = []
+            smb.getFile(self.share, self.file, out.append)
+            results.append(''.join(out) == data)
+        threads = [threading.Thread(target = download) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(results == [True]*4)
+        smb.getSMBServer().stopDispatcher()
+        smb.deleteFile(self.share, self.file)
+        smb.logoff()
+
     def test_createdeleteDirectory(self):
         smb = SMBConnection('*SMBSERVER', self.machine, preferredDialect = self.dialects)
         smb.login(self.username, self.password, self.domain)
@@ -162,6 +207,18 @@ class SMBTests(unittest.TestCase):
         smb.deleteFile(self.share, self.file)
         smb.logoff()
 
+    def test_uploadDownloadLarge(self):
+        # Larger than MaxReadSize and MaxWriteSize, so it goes with several READs (and WRITEs) in flight
+        data = os.urandom(9*1024*1024+1234)
+        smb = SMBConnection('*SMBSERVER', self.machine, preferredDialect = self.dialects)
+        smb.login(self.username, self.password, self.domain)
+        smb.putFile(self.share, self.file, StringIO.StringIO(data).read)
+        received = []
+        smb.getFile(self.share, self.file, received.append)
+        smb.deleteFile(self.share, self.file)
+        smb.logoff()
+        self.assertTrue(''.join(received) == data)
+
     def test_listShares(self):
         smb = SMBConnection('*SMBSERVER', self.machine, preferredDialect = self.dialects)
         smb.login(self.username, self.password, self.domain)
@@ -242,9 +299,323 @@ class SMB3Tests(SMBTests):
         self.upload   = '../../nt_errors.py'
         self.dialects = SMB2_DIALECT_30
 
+class ScriptedSession:
+    # Stands for the NetBIOS session of an SMB3 connection. Keeps what is sent
+    # and answers with the messages lined up in answers
+    def __init__(self, answers):
+        self.answers = answers
+        self.sent = []
+
+    def send_packet(self, data):
+        self.sent.append(data)
+
+    def recv_packet(self, timeout = None):
+        packet = nmb.NetBIOSSessionPacket()
+        packet.set_trailer(self.answers.pop(0))
+        return packet
+
+    def close(self):
+        pass
+
+class SMB3SigningTests(unittest.TestCase):
+    # Signed answers are verified against the session keys. No server needed,
+    # the connection talks to a ScriptedSession
+    sessionKey = 'K' * 16
+    signingKey = 'S' * 16
+
+    def connect(self, dialect):
+        negotiate = SMB2Negotiate_Response()
+        negotiate['DialectRevision'] = dialect
+        negotiate['SecurityBufferOffset'] = 128
+        negotiate['Buffer'] = ''
+        answer = SMB2Packet()
+        answer['Command'] = SMB2_NEGOTIATE
+        answer['Flags'] = SMB2_FLAGS_SERVER_TO_REDIR
+        answer['CreditRequestResponse'] = 127
+        answer['MessageID'] = 1
+        answer['Data'] = str(negotiate)
+        session = ScriptedSession([str(answer)])
+        connection = smb3.SMB3('*SMBSERVER', '127.0.0.1', session = session)
+        connection._Session['SessionID'] = 0x1234
+        connection._Session['SessionKey'] = self.sessionKey
+        connection._Session['SigningKey'] = self.signingKey
+        connection._Session['SigningActivated'] = True
+        return connection, session
+
+    def echoAnswer(self, dialect, messageID, pad = 0):
+        # A signed ECHO answer, followed by pad octets
+        answer = SMB2Packet()
+        answer['Command'] = SMB2_ECHO
+        answer['Flags'] = SMB2_FLAGS_SERVER_TO_REDIR | SMB2_FLAGS_SIGNED
+        answer['CreditRequestResponse'] = 1
+        answer['MessageID'] = messageID
+        answer['SessionID'] = 0x1234
+        answer['Signature'] = '\x00' * 16
+        answer['Data'] = str(SMB2Echo_Response())
+        if pad > 0:
+            answer['NextCommand'] = len(str(answer)) + pad
+        data = str(answer) + '\x00' * pad
+        if dialect == SMB2_DIALECT_30:
+            signature = crypto.AES_CMAC(self.signingKey, data, len(data))
+        else:
+            signature = hmac.new(self.sessionKey, data, hashlib.sha256).digest()[:16]
+        return data[:48] + signature + data[64:]
+
+    def test_signedAnswer(self):
+        for dialect in (SMB2_DIALECT_002, SMB2_DIALECT_21, SMB2_DIALECT_30):
+            connection, session = self.connect(dialect)
+            messageID = connection._Connection['SequenceWindow']
+            session.answers.append(self.echoAnswer(dialect, messageID))
+            self.assertTrue(connection.echo() is True)
+
+    def test_signedCompoundAnswer(self):
+        for dialect in (SMB2_DIALECT_21, SMB2_DIALECT_30):
+            connection, session = self.connect(dialect)
+            packets = []
+            for i in range(2):
+                packet = connection.SMB_PACKET()
+                packet['Command'] = SMB2_ECHO
+                packet['Data'] = SMB2Echo()
+                packets.append(packet)
+            messageIDs = connection.sendCompound(packets, related = False)
+            # The first one padded to 8 octets, signed padding included
+            session.answers.append(self.echoAnswer(dialect, messageIDs[0], 4) + self.echoAnswer(dialect, messageIDs[1]))
+            for messageID in messageIDs:
+                self.assertTrue(connection.recvSMB(messageID).isValidAnswer(STATUS_SUCCESS))
+
+    def test_tamperedAnswer(self):
+        for dialect in (SMB2_DIALECT_21, SMB2_DIALECT_30):
+            connection, session = self.connect(dialect)
+            messageID = connection._Connection['SequenceWindow']
+            answer = self.echoAnswer(dialect, messageID)
+            # CreditRequestResponse
+            session.answers.append(answer[:14] + '\x02' + answer[15:])
+            try:
+                connection.echo()
+            except smb3.SessionError, e:
+                self.assertTrue(e.get_error_code() == STATUS_INVALID_SIGNATURE)
+            else:
+                self.fail('Tampered answer accepted')
+
+class CreditedSession:
+    # Stands for the NetBIOS session of an SMB3 connection, answering like a server
+    # serving a single file. Every answer grants the client credits credits, requests
+    # charged more than the client has left are kept in overruns
+    def __init__(self, dialect, credits, data = ''):
+        self.dialect = dialect
+        self.credits = credits
+        self.balance = 1
+        self.data = data
+        self.overruns = []
+        self.requests = []
+        self.messages = []
+
+    def send_packet(self, data):
+        if isinstance(data, (list, tuple)):
+            data = ''.join([str(buf) for buf in data])
+        requests = []
+        offset = 0
+        while True:
+            request = SMB2Packet(data[offset:])
+            charge = max(1, request['CreditCharge'])
+            if request['Command'] != SMB2_NEGOTIATE and charge > self.balance:
+                self.overruns.append((request['Command'], charge, self.balance))
+            self.balance -= charge
+            self.requests.append((request['Command'], charge))
+            requests.append(request)
+            if request['NextCommand'] == 0:
+                break
+            offset += request['NextCommand']
+        # Every request in a compound one is charged before any of them is answered
+        answers = [self.answer(request) for request in requests]
+        for answer in answers[:-1]:
+            answer['NextCommand'] = len(str(answer))
+        self.messages.append(''.join([str(answer) for answer in answers]))
+
+    def answer(self, request):
+        answer = SMB2Packet()
+        answer['Command'] = request['Command']
+        answer['Flags'] = SMB2_FLAGS_SERVER_TO_REDIR
+        answer['MessageID'] = request['MessageID']
+        answer['SessionID'] = request['SessionID']
+        answer['TreeID'] = 1
+        answer['CreditRequestResponse'] = self.credits
+        self.balance += self.credits
+        if request['Command'] == SMB2_NEGOTIATE:
+            response = SMB2Negotiate_Response()
+            response['DialectRevision'] = self.dialect
+            response['Capabilities'] = SMB2_GLOBAL_CAP_LARGE_MTU
+            response['MaxReadSize'] = 0x100000
+            response['MaxWriteSize'] = 0x100000
+            response['SecurityBufferOffset'] = 128
+            response['Buffer'] = ''
+        elif request['Command'] == SMB2_TREE_CONNECT:
+            response = SMB2TreeConnect_Response()
+        elif request['Command'] == SMB2_CREATE:
+            response = SMB2Create_Response()
+            response['FileID'] = '\x01' * 16
+            response['EndOfFile'] = len(self.data)
+            response['Buffer'] = ''
+        elif request['Command'] == SMB2_READ:
+            read = SMB2Read(request['Data'])
+            response = SMB2Read_Response()
+            response['DataOffset'] = 80
+            response['Buffer'] = self.data[read['Offset']:read['Offset']+read['Length']]
+            response['DataLength'] = len(response['Buffer'])
+        elif request['Command'] == SMB2_WRITE:
+            write = SMB2Write(request['Data'])
+            self.data = self.data[:write['Offset']] + write['Buffer'][:write['Length']] + self.data[write['Offset']+write['Length']:]
+            response = SMB2Write_Response()
+            response['Count'] = write['Length']
+        elif request['Command'] == SMB2_QUERY_INFO:
+            response = SMB2QueryInfo_Response()
+            response['OutputBufferOffset'] = 72
+            response['Buffer'] = pack('<QQL', len(self.data), len(self.data), 1) + '\x00' * 4
+            response['OutputBufferLength'] = len(response['Buffer'])
+        elif request['Command'] == SMB2_CLOSE:
+            response = SMB2Close_Response()
+        else:
+            response = SMB2TreeDisconnect_Response()
+        answer['Data'] = str(response)
+        return answer
+
+    def recv_packet(self, timeout = None):
+        packet = nmb.NetBIOSSessionPacket()
+        packet.set_trailer(self.messages.pop(0))
+        return packet
+
+    def close(self):
+        pass
+
+class QueuedSession(CreditedSession):
+    # A CreditedSession whose answers arrive through a socket, for the dispatcher to
+    # select() on. While hold is True they're kept until release()
+    def __init__(self, dialect, credits, data = ''):
+        CreditedSession.__init__(self, dialect, credits, data)
+        self.reader, self.writer = socket.socketpair()
+        self.hold = False
+        self.held = 0
+
+    def send_packet(self, data):
+        CreditedSession.send_packet(self, data)
+        if self.hold is True:
+            self.held += 1
+        else:
+            self.writer.send('\x00')
+
+    def release(self):
+        self.writer.send('\x00' * self.held)
+        self.held = 0
+
+    def get_socket(self):
+        return self.reader
+
+    def recv_packet(self, timeout = None):
+        self.reader.recv(1)
+        return CreditedSession.recv_packet(self, timeout)
+
+class SMB3DispatcherTests(unittest.TestCase):
+    def test_waitingForAny(self):
+        # Two threads waiting for whatever answer comes next both get one, right away
+        session = QueuedSession(SMB2_DIALECT_21, 10)
+        connection = smb3.SMB3('*SMBSERVER', '127.0.0.1', session = session)
+        connection._Session['SessionID'] = 0x1234
+        connection.startDispatcher()
+        try:
+            answers = []
+            threads = [threading.Thread(target = lambda: answers.append(connection.recvSMB(None))) for i in range(2)]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            time.sleep(0.1)
+            session.hold = True
+            for i in range(2):
+                packet = connection.SMB_PACKET()
+                packet['Command'] = SMB2_CLOSE
+                packet['Data'] = SMB2Close()
+                connection.sendSMB(packet)
+            start = time.time()
+            session.release()
+            for thread in threads:
+                thread.join(5)
+            # Not left for the dispatcher's once a second wake up
+            self.assertTrue(len(answers) == 2)
+            self.assertTrue(time.time() - start < 0.5)
+        finally:
+            connection.stopDispatcher()
+
+class SMB3CreditTests(unittest.TestCase):
+    # Transfers stay within the credits the server granted. No server needed,
+    # the connection talks to a CreditedSession
+    def connect(self, dialect, credits, data = ''):
+        session = CreditedSession(dialect, credits, data)
+        connection = smb3.SMB3('*SMBSERVER', '127.0.0.1', session = session)
+        connection._Session['SessionID'] = 0x1234
+        return connection, session
+
+    def test_retrieveFileOneCredit(self):
+        data = os.urandom(300000)
+        for dialect in (SMB2_DIALECT_002, SMB2_DIALECT_21):
+            connection, session = self.connect(dialect, 1, data)
+            output = StringIO.StringIO()
+            connection.retrieveFile('C$', 'TEST', output.write)
+            self.assertTrue(output.getvalue() == data)
+            self.assertTrue(session.overruns == [])
+            # Without the credits for both, the CREATE went alone
+            self.assertTrue(session.requests[2] == (SMB2_CREATE, 1))
+
+    def test_retrieveFileCredits(self):
+        data = os.urandom(300000)
+        for dialect in (SMB2_DIALECT_002, SMB2_DIALECT_21):
+            connection, session = self.connect(dialect, 3, data)
+            output = StringIO.StringIO()
+            connection.retrieveFile('C$', 'TEST', output.write)
+            self.assertTrue(output.getvalue() == data)
+            self.assertTrue(session.overruns == [])
+            # The first READ goes along with the CREATE, taking the credits left
+            self.assertTrue(session.requests[3][0] == SMB2_READ)
+
+    def test_storeFileOneCredit(self):
+        data = os.urandom(300000)
+        for dialect in (SMB2_DIALECT_002, SMB2_DIALECT_21):
+            connection, session = self.connect(dialect, 1)
+            connection.storeFile('C$', 'TEST', StringIO.StringIO(data).read)
+            self.assertTrue(session.data == data)
+            self.assertTrue(session.overruns == [])
+
+    def test_readSmallFileOneCredit(self):
+        data = os.urandom(300000)
+        for dialect in (SMB2_DIALECT_002, SMB2_DIALECT_21):
+            connection, session = self.connect(dialect, 1, data)
+            treeId = connection.connectTree('C$')
+            self.assertTrue(connection.readSmallFile(treeId, 'TEST') == data)
+            self.assertTrue(connection.readSmallFile(treeId, 'TEST', 1000, 70000) == data[1000:71000])
+            self.assertTrue(session.overruns == [])
+            self.assertTrue(connection._Connection['Credits'] >= 0)
+
+    def test_readSmallFileCredits(self):
+        data = os.urandom(300000)
+        connection, session = self.connect(SMB2_DIALECT_21, 20, data)
+        treeId = connection.connectTree('C$')
+        self.assertTrue(connection.readSmallFile(treeId, 'TEST') == data)
+        self.assertTrue(session.overruns == [])
+        # A single chain, the READ asking for MaxReadSize
+        self.assertTrue(session.requests[2:] == [(SMB2_CREATE, 1), (SMB2_READ, 16), (SMB2_CLOSE, 1)])
+
+    def test_queryPathInfoOneCredit(self):
+        connection, session = self.connect(SMB2_DIALECT_21, 1, 'A' * 1000)
+        treeId = connection.connectTree('C$')
+        info = connection.queryPathInfo(treeId, 'TEST')
+        # AllocationSize, EndOfFile
+        self.assertTrue(unpack('<QQ', info[:16]) == (1000, 1000))
+        self.assertTrue(session.overruns == [])
+
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromTestCase(SMB1Tests)
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(SMB002Tests))
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(SMB21Tests))
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(SMB3Tests))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(SMB3SigningTests))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(SMB3CreditTests))
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(SMB3DispatcherTests))
     unittest.TextTestRunner(verbosity=1).run(suite)
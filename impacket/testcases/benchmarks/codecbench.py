@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# Copyright (c) 2003-2015 CORE Security Technologies
+#
+# This software is provided under under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Micro-benchmarks for the codec layer (Structure and NDR) every protocol
+#   sits on. For each case it measures pack, unpack and construction (new)
+#   throughput and the number of objects making up an unpacked instance.
+#   Nothing touches the network.
+#
+#   Results are compared against the baseline stored in codecbench.json
+#   (next to this file), cases running slower (or allocating more) than
+#   the baseline allows for are flagged as REGRESSION. Throughputs are
+#   stored relative to a calibration case run in the same process, plain
+#   interpreter work, so a baseline taken on another host still applies.
+#   A case looking slower is measured again (-retries) before it's flagged,
+#   run to run noise easily reaches 30% on a busy host.
+#
+#   codecbench.py                 run all the cases, compare with the baseline
+#   codecbench.py -k samr,ntlm    only the cases matching any of the patterns
+#   codecbench.py --save          store the results as the new baseline
+#   codecbench.py --check         exit with 1 if anything regressed
+#
+#   Run it with the tree to measure in PYTHONPATH (see runbench.sh)
+#
+
+import sys
+import os
+import gc
+import time
+import json
+import argparse
+from struct import pack, unpack
+
+from impacket import smb, smb3structs, ntlm, ese
+from impacket.dcerpc.v5 import samr, lsat, srvs, dtypes
+from impacket.dcerpc.v5.ndr import NULL
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codecbench.json')
+
+class CodecBenchmark:
+    # Subclasses set name, and build the instance to benchmark in setUp().
+    # pack() serializes it, unpack() builds a new one out of the packed data.
+    name = None
+    def pack(self):
+        return str(self.instance)
+
+    def unpack(self, data):
+        return self.instance.__class__(data)
+
+    def new(self):
+        return self.instance.__class__()
+
+################################################################################
+# Structure based
+
+class NewSMBPacketBenchmark(CodecBenchmark):
+    name = 'smb.NewSMBPacket'
+    def setUp(self):
+        packet = smb.NewSMBPacket()
+        packet['Flags1'] = smb.SMB.FLAGS1_CANONICALIZED_PATHS | smb.SMB.FLAGS1_PATHCASELESS
+        packet['Flags2'] = smb.SMB.FLAGS2_EXTENDED_SECURITY | smb.SMB.FLAGS2_NT_STATUS | smb.SMB.FLAGS2_UNICODE
+        packet['Tid'] = 0x800
+        packet['Mid'] = 0x20
+        readAndX = smb.SMBCommand(smb.SMB.SMB_COM_READ_ANDX)
+        readAndX['Parameters'] = smb.SMBReadAndX_Parameters()
+        readAndX['Parameters']['Fid'] = 0x4000
+        readAndX['Parameters']['Offset'] = 0x10000
+        readAndX['Parameters']['MaxCount'] = 65000
+        packet.addCommand(readAndX)
+        self.instance = packet
+
+    def unpack(self, data):
+        packet = smb.NewSMBPacket(data = data)
+        readAndX = smb.SMBCommand(packet['Data'][0])
+        smb.SMBReadAndX_Parameters(readAndX['Parameters'])
+        return packet
+
+class SMB2PacketBenchmark(CodecBenchmark):
+    name = 'smb3structs.SMB2Packet'
+    def setUp(self):
+        packet = smb3structs.SMB2Packet()
+        packet['Command'] = smb3structs.SMB2_READ
+        packet['MessageID'] = 0x1234
+        packet['TreeID'] = 5
+        packet['SessionID'] = 0x1122334455667788
+        read = smb3structs.SMB2Read()
+        read['FileID'] = '\x01'*16
+        read['Length'] = 65536
+        read['Offset'] = 0x100000
+        read['Buffer'] = '\x00'
+        packet['Data'] = read
+        self.instance = packet
+
+    def unpack(self, data):
+        packet = smb3structs.SMB2Packet(data)
+        smb3structs.SMB2Read(packet['Data'])
+        return packet
+
+class NTLMAuthChallengeResponseBenchmark(CodecBenchmark):
+    name = 'ntlm.NTLMAuthChallengeResponse'
+    def setUp(self):
+        response = ntlm.NTLMAuthChallengeResponse('Administrator', 'Passw0rd', '\x11'*8)
+        response['domain_name'] = 'WORKGROUP'.encode('utf-16le')
+        response['user_name'] = 'Administrator'.encode('utf-16le')
+        response['host_name'] = 'WORKSTATION'.encode('utf-16le')
+        response['ntlm'] = '\x22'*200
+        response['session_key'] = '\x33'*16
+        self.instance = response
+
+    def unpack(self, data):
+        response = ntlm.NTLMAuthChallengeResponse()
+        response.fromString(data)
+        return response
+
+class ESENTPageHeaderBenchmark(CodecBenchmark):
+    name = 'ese.ESENT_PAGE_HEADER'
+    def setUp(self):
+        header = ese.ESENT_PAGE_HEADER(0x620, 0x14, 8192)
+        header['CheckSum'] = 0x1122334455667788
+        header['PreviousPageNumber'] = 10
+        header['NextPageNumber'] = 12
+        header['FatherDataPage'] = 4
+        header['AvailableDataSize'] = 0x1000
+        header['FirstAvailableDataOffset'] = 0x200
+        header['FirstAvailablePageTag'] = 0x20
+        header['PageFlags'] = 0x2803
+        self.instance = header
+
+    def unpack(self, data):
+        return ese.ESENT_PAGE_HEADER(0x620, 0x14, 8192, data)
+
+    def new(self):
+        return ese.ESENT_PAGE_HEADER(0x620, 0x14, 8192)
+
+class TDSPacketBenchmark(CodecBenchmark):
+    name = 'tds.TDSPacket'
+    def setUp(self):
+        # tds needs pyOpenSSL and exits when it's missing, check it first
+        # so the case is skipped instead
+        import OpenSSL
+        from impacket import tds
+        packet = tds.TDSPacket()
+        packet['Type'] = tds.TDS_SQL_BATCH
+        packet['Data'] = 'select name from sys.databases'.encode('utf-16le') * 20
+        self.instance = packet
+
+################################################################################
+# NDR based. Large conformant arrays, the way enumerations come back.
+
+ENTRIES = 1000
+
+class SamrLookupNamesInDomainBenchmark(CodecBenchmark):
+    name = 'samr.SamrLookupNamesInDomain'
+    def setUp(self):
+        request = samr.SamrLookupNamesInDomain()
+        request['DomainHandle'] = '\x00'*20
+        request['Count'] = ENTRIES
+        for i in range(ENTRIES):
+            name = dtypes.RPC_UNICODE_STRING()
+            name['Data'] = u'user%04d' % i
+            request['Names'].append(name)
+        request.fields['Names'].fields['MaximumCount'] = 1000
+        self.instance = request
+
+class SamrEnumerateUsersInDomainResponseBenchmark(CodecBenchmark):
+    name = 'samr.SamrEnumerateUsersInDomainResponse'
+    def setUp(self):
+        response = samr.SamrEnumerateUsersInDomainResponse()
+        response['EnumerationContext'] = 0
+        response['Buffer']['EntriesRead'] = ENTRIES
+        for i in range(ENTRIES):
+            entry = samr.SAMPR_RID_ENUMERATION()
+            entry['RelativeId'] = 1000 + i
+            entry['Name'] = u'user%04d' % i
+            response['Buffer']['Buffer'].append(entry)
+        response['CountReturned'] = ENTRIES
+        response['ErrorCode'] = 0
+        self.instance = response
+
+class LsarLookupSidsBenchmark(CodecBenchmark):
+    name = 'lsat.LsarLookupSids'
+    def setUp(self):
+        request = lsat.LsarLookupSids()
+        request['PolicyHandle'] = '\x00'*20
+        request['SidEnumBuffer']['Entries'] = ENTRIES
+        for i in range(ENTRIES):
+            sid = lsat.LSAPR_SID_INFORMATION()
+            sid['Sid'].fromCanonical('S-1-5-21-3623811015-3361044348-30300820-%d' % (1000 + i))
+            request['SidEnumBuffer']['SidInfo'].append(sid)
+        request['TranslatedNames']['Names'] = NULL
+        request['LookupLevel'] = lsat.LSAP_LOOKUP_LEVEL.LsapLookupWksta
+        self.instance = request
+
+class NetrShareEnumResponseBenchmark(CodecBenchmark):
+    name = 'srvs.NetrShareEnumResponse'
+    def setUp(self):
+        response = srvs.NetrShareEnumResponse()
+        response['InfoStruct']['Level'] = 1
+        response['InfoStruct']['ShareInfo']['tag'] = 1
+        response['InfoStruct']['ShareInfo']['Level1']['EntriesRead'] = ENTRIES
+        for i in range(ENTRIES):
+            share = srvs.SHARE_INFO_1()
+            share['shi1_netname'] = u'SHARE%04d\x00' % i
+            share['shi1_type'] = 0
+            share['shi1_remark'] = u'Remark %d\x00' % i
+            response['InfoStruct']['ShareInfo']['Level1']['Buffer'].append(share)
+        response['TotalEntries'] = ENTRIES
+        response['ResumeHandle'] = NULL
+        response['ErrorCode'] = 0
+        self.instance = response
+
+class SamrQueryInformationUser2ResponseBenchmark(CodecBenchmark):
+    # Few items, but deep: every field a structure of its own
+    name = 'samr.SamrQueryInformationUser2Response'
+    def setUp(self):
+        response = samr.SamrQueryInformationUser2Response()
+        response['Buffer']['tag'] = samr.USER_INFORMATION_CLASS.UserAllInformation
+        info = response['Buffer']['All']
+        info['UserName'] = u'Administrator'
+        info['FullName'] = u'Built-in account for administering the computer/domain'
+        info['HomeDirectory'] = u'\\\\server\\home\\administrator'
+        info['UserId'] = 500
+        info['PrimaryGroupId'] = 513
+        info['UserAccountControl'] = samr.USER_NORMAL_ACCOUNT
+        info['LogonHours']['UnitsPerWeek'] = 168
+        info['LogonHours']['LogonHours'] = '\xff'*21
+        response['ErrorCode'] = 0
+        self.instance = response
+
+    def new(self):
+        return samr.SAMPR_USER_ALL_INFORMATION()
+
+BENCHMARKS = (
+    NewSMBPacketBenchmark,
+    SMB2PacketBenchmark,
+    NTLMAuthChallengeResponseBenchmark,
+    ESENTPageHeaderBenchmark,
+    TDSPacketBenchmark,
+    SamrLookupNamesInDomainBenchmark,
+    SamrEnumerateUsersInDomainResponseBenchmark,
+    LsarLookupSidsBenchmark,
+    NetrShareEnumResponseBenchmark,
+    SamrQueryInformationUser2ResponseBenchmark,
+)
+
+################################################################################
+
+def measure(function, minTime, repeat):
+    # Best ops/sec out of repeat runs of (at least) minTime seconds each
+    loops = 1
+    while True:
+        start = time.time()
+        for i in xrange(loops):
+            function()
+        elapsed = time.time() - start
+        if elapsed >= minTime / 10:
+            break
+        loops *= 10
+    loops = max(1, int(loops * minTime / max(elapsed, 1e-6)))
+    best = 0
+    for i in range(repeat):
+        start = time.time()
+        for i in xrange(loops):
+            function()
+        elapsed = time.time() - start
+        best = max(best, loops / max(elapsed, 1e-9))
+    return best
+
+def calibration():
+    # Plain interpreter work, the kind codecs spend their time on (struct,
+    # dict and string operations). Throughputs are stored relative to it
+    fields = {}
+    for i in range(50):
+        fields['f%d' % i] = pack('<HL', i, i * 3)
+    data = ''.join([fields[key] for key in sorted(fields)])
+    for i in range(0, len(data), 6):
+        unpack('<HL', data[i:i+6])
+
+def countObjects(function):
+    # Number of (gc tracked) objects held by what function returns. Python 2
+    # has no way to count every allocation, this is what's left after them.
+    gc.collect()
+    before = len(gc.get_objects())
+    result = function()
+    gc.collect()
+    answer = len(gc.get_objects()) - before
+    del result
+    return answer
+
+def run(benchmark, minTime, repeat):
+    benchmark.setUp()
+    data = benchmark.pack()
+    # Make sure what we measure actually round trips
+    if str(benchmark.unpack(data)) != data:
+        raise Exception("%s doesn't repack to the same data" % benchmark.name)
+    result = {}
+    result['size'] = len(data)
+    result['pack'] = measure(benchmark.pack, minTime, repeat)
+    result['unpack'] = measure(lambda: benchmark.unpack(data), minTime, repeat)
+    result['new'] = measure(benchmark.new, minTime, repeat)
+    result['objects'] = countObjects(lambda: benchmark.unpack(data))
+    return result
+
+def relative(result, calibrated):
+    # result with its throughputs as a fraction of the calibration case's
+    answer = dict(result)
+    for what in ('pack', 'unpack', 'new'):
+        answer[what] = float('%.6g' % (result[what] / calibrated))
+    return answer
+
+def compare(name, result, baseline, tolerance):
+    # Returns the list of regressions against baseline, both relative()
+    regressions = []
+    if baseline is None:
+        return regressions
+    for what in ('pack', 'unpack', 'new'):
+        # Baselines taken before a measurement existed don't have it
+        if what in baseline and result[what] < baseline[what] * (1 - tolerance):
+            regressions.append('%s %s %.3g of calibration, baseline %.3g' % (name, what, result[what], baseline[what]))
+    if result['objects'] > baseline['objects']:
+        regressions.append('%s objects %d, baseline %d' % (name, result['objects'], baseline['objects']))
+    return regressions
+
+def ratio(value, baseline):
+    if baseline is None:
+        return '      -'
+    return '%6.2fx' % (value / baseline)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Structure/NDR codec micro-benchmarks")
+    parser.add_argument('-k', action='store', metavar = 'patterns', help='comma separated substrings, only run the matching cases')
+    parser.add_argument('-baseline', action='store', default = BASELINE, help='baseline file (default %s)' % BASELINE)
+    parser.add_argument('-tolerance', action='store', type = float, default = 0.4, help='allowed slowdown before flagging a regression (default 0.4)')
+    parser.add_argument('-time', action='store', type = float, default = 0.2, help='seconds per measurement (default 0.2)')
+    parser.add_argument('-repeat', action='store', type = int, default = 5, help='measurements per case, the best one is kept (default 5)')
+    parser.add_argument('-retries', action='store', type = int, default = 2, help='times a case looking slower is measured again before flagging it (default 2)')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--check', action='store_true', help='exit with 1 if anything regressed')
+    options = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(options.baseline):
+        baselines = json.load(open(options.baseline))
+
+    calibrated = measure(calibration, options.time, options.repeat)
+    print "calibration: %.0f/s" % calibrated
+    print "%-42s %8s %12s %8s %12s %8s %12s %8s %8s" % ('case', 'bytes', 'pack/s', '', 'unpack/s', '', 'new/s', '', 'objects')
+    results = {}
+    regressions = []
+    for benchmarkClass in BENCHMARKS:
+        benchmark = benchmarkClass()
+        if options.k is not None and not [x for x in options.k.split(',') if x in benchmark.name]:
+            continue
+        try:
+            result = run(benchmark, options.time, options.repeat)
+        except ImportError, e:
+            print "%-42s skipped (%s)" % (benchmark.name, e)
+            continue
+        baseline = baselines.get(benchmark.name)
+        # Ratios are taken on the relative figures, comparable across hosts
+        scores = relative(result, calibrated)
+        caseRegressions = compare(benchmark.name, scores, baseline, options.tolerance)
+        retries = 0
+        while caseRegressions and retries < options.retries:
+            # Mostly noise, the host running slower for a while. Calibrate
+            # and measure again, keeping the best figures of every run
+            retries += 1
+            calibrated = measure(calibration, options.time, options.repeat)
+            again = relative(run(benchmark, options.time, options.repeat), calibrated)
+            for what in ('pack', 'unpack', 'new'):
+                scores[what] = max(scores[what], again[what])
+            scores['objects'] = min(scores['objects'], again['objects'])
+            caseRegressions = compare(benchmark.name, scores, baseline, options.tolerance)
+        results[benchmark.name] = scores
+        print "%-42s %8d %12.0f %8s %12.0f %8s %12.0f %8s %8d" % (benchmark.name, result['size'],
+              result['pack'], ratio(scores['pack'], baseline and baseline['pack']),
+              result['unpack'], ratio(scores['unpack'], baseline and baseline['unpack']),
+              result['new'], ratio(scores['new'], baseline and baseline.get('new')), result['objects'])
+        regressions += caseRegressions
+        sys.stdout.flush()
+
+    for regression in regressions:
+        print "REGRESSION: %s" % regression
+
+    if options.save:
+        baselines.update(results)
+        out = open(options.baseline, 'w')
+        json.dump(baselines, out, indent = 4, sort_keys = True, separators = (',', ': '))
+        out.write('\n')
+        out.close()
+        print "Baseline saved to %s" % options.baseline
+
+    if options.check and regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
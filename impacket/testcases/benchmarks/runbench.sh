@@ -0,0 +1,6 @@
+#!/bin/bash
+# Runs the codec benchmarks against this tree. Arguments are passed along,
+# e.g. ./runbench.sh --save to refresh the baseline
+export PYTHONPATH=../../..:$PYTHONPATH
+
+python codecbench.py "$@"